@@ -1,48 +1,83 @@
-from typing import List, Optional, Sequence
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+from uuid import UUID, uuid4
 
-from sqlalchemy import select
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import Text, case, cast, func, literal_column, select, tuple_, update
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, selectinload
 
 import schema
-from chat.engine import get_conversation_headline
+from api.serialization import (
+    MESSAGE_FIELDS,
+    SUB_PROCESS_FIELDS,
+    construct_chat_conversation,
+    construct_conversation,
+    construct_document,
+    construct_message,
+    encode_message_cursor,
+    row_values,
+)
+from chat.headline import headline_service
 from libs.models.chatdb import (
     Conversation,
     ConversationDocument,
     Document,
     HumanFeedback,
     Message,
+    MessageRoleEnum,
+    MessageStatusEnum,
+    MessageSubProcess,
+    MessageSubProcessSourceEnum,
+    MessageSubProcessStatusEnum,
 )
 
 
 async def update_conversation_headline(
     db: AsyncSession, conversation_id: str
-) -> Optional[schema.Conversation]:
+) -> Optional[schema.ConversationHeadline]:
     """
-    Fetch a conversation with its first messages and
-    Update the headline
+    Return the headline of a conversation, scheduling its generation
+    from the first message in the background if it has none yet
     """
-    # Eagerly load required relationships
-    stmt = (
-        select(Conversation)
-        .options(joinedload(Conversation.messages))
-        .options(joinedload(Conversation.conversation_documents))
-        .where(Conversation.id == conversation_id)
-    )
-    result = await db.execute(stmt)  # execute the statement
-    conversation = result.scalars().first()  # get the first result
-
-    if conversation is not None:
-        messages = conversation.messages[0].content
-        headline = get_conversation_headline(messages)
+    stmt = select(Conversation.headline).where(Conversation.id == conversation_id)
+    result = await db.execute(stmt)
+    row = result.first()
+    if row is None:
+        return None
 
-        conversation.headline = headline  # type: ignore
-        await db.commit()
+    if row.headline:
+        return schema.ConversationHeadline(
+            conversation_id=conversation_id,  # type: ignore
+            headline=row.headline,
+            status=schema.HeadlineStatusEnum.READY,
+        )
 
-        return conversation  # type: ignore
+    stmt = (
+        select(Message.content)
+        .where(Message.conversation_id == conversation_id)
+        .where(Message.role == MessageRoleEnum.user)
+        .order_by(Message.created_at)
+        .limit(1)
+    )
+    result = await db.execute(stmt)
+    first_question = result.scalars().first()
+    if not first_question:
+        return schema.ConversationHeadline(
+            conversation_id=conversation_id,  # type: ignore
+            status=schema.HeadlineStatusEnum.UNAVAILABLE,
+        )
 
-    return None
+    headline = headline_service.schedule(conversation_id, first_question)
+    return schema.ConversationHeadline(
+        conversation_id=conversation_id,  # type: ignore
+        headline=headline,
+        status=(
+            schema.HeadlineStatusEnum.READY
+            if headline is not None
+            else schema.HeadlineStatusEnum.PENDING
+        ),
+    )
 
 
 def find_previous_message(
@@ -127,29 +162,219 @@ async def fetch_conversation_with_messages(
     result = await db.execute(stmt)  # execute the statement
     conversation = result.scalars().first()  # get the first result
     if conversation is not None:
-        # Prepare the dictionary for the conversation
-        convo_dict = {
-            **conversation.__dict__,
-            "messages": [],
-            "documents": [
-                convo_doc.document.__dict__
+        # the rows are trusted, the schemas are built without validating them again
+        return construct_conversation(
+            conversation,
+            messages=[construct_message(msg) for msg in conversation.messages],
+            documents=[
+                construct_document(convo_doc.document)
                 for convo_doc in conversation.conversation_documents
             ],
-        }
+        )
 
-        # Iterate through each message and validate
-        for msg in conversation.messages:
-            # Validate and convert sub_processes if necessary
-            validated_sub_processes = [sp.__dict__ for sp in msg.sub_processes]
+    return None
 
-            # Update the message dictionary with validated sub_processes
-            msg_dict = {**msg.__dict__, "sub_processes": validated_sub_processes}
 
-            convo_dict["messages"].append(schema.Message.model_validate(msg_dict))
+def _enum_value(column, enum_class):
+    """
+    SQL expression of the value of an enum column, as serialized by the schemas.
+    Postgres stores the names of the members, which differ from their values for some enums.
+    """
+    if all(member.name == member.value for member in enum_class):
+        return cast(column, Text)
+    return case(
+        {member.name: member.value for member in enum_class}, value=cast(column, Text)
+    )
 
-        return schema.Conversation.model_validate(convo_dict)
 
-    return None
+def _json_array(element, *order_by):
+    """json_agg of the element in the given order, or an empty array when there are no rows."""
+    return func.coalesce(
+        func.json_agg(aggregate_order_by(element, *order_by)),
+        literal_column("'[]'::json"),
+    )
+
+
+async def fetch_conversation_json(
+    db: AsyncSession, conversation_id: str
+) -> Optional[str]:
+    """
+    Fetch a conversation with its messages + messagesubprocesses + documents as a JSON document built by Postgres,
+    in the shape of schema.Conversation, with a single statement and without hydrating any ORM object.
+    return None if the conversation with the given id does not exist
+    """
+    sub_processes = (
+        select(
+            _json_array(
+                func.json_build_object(
+                    "id", MessageSubProcess.id,
+                    "created_at", MessageSubProcess.created_at,
+                    "updated_at", MessageSubProcess.updated_at,
+                    "message_id", MessageSubProcess.message_id,
+                    "source", _enum_value(MessageSubProcess.source, MessageSubProcessSourceEnum),
+                    "status", _enum_value(MessageSubProcess.status, MessageSubProcessStatusEnum),
+                    "metadata_map", MessageSubProcess.metadata_map,
+                ),
+                MessageSubProcess.created_at,
+            )
+        )
+        .where(MessageSubProcess.message_id == Message.id)
+        .correlate(Message)
+        .scalar_subquery()
+    )
+    messages = (
+        select(
+            _json_array(
+                func.json_build_object(
+                    "id", Message.id,
+                    "created_at", Message.created_at,
+                    "updated_at", Message.updated_at,
+                    "conversation_id", Message.conversation_id,
+                    "content", Message.content,
+                    "role", _enum_value(Message.role, MessageRoleEnum),
+                    "temperature", Message.temperature,
+                    "status", _enum_value(Message.status, MessageStatusEnum),
+                    "sub_processes", sub_processes,
+                ),
+                Message.created_at,
+            )
+        )
+        .where(Message.conversation_id == Conversation.id)
+        .correlate(Conversation)
+        .scalar_subquery()
+    )
+    documents = (
+        select(
+            _json_array(
+                func.json_build_object(
+                    "id", Document.id,
+                    "created_at", Document.created_at,
+                    "updated_at", Document.updated_at,
+                    "table_name", Document.table_name,
+                    "metadata_map", Document.metadata_map,
+                ),
+                ConversationDocument.created_at,
+            )
+        )
+        .select_from(ConversationDocument)
+        .join(Document, Document.id == ConversationDocument.document_id)
+        .where(ConversationDocument.conversation_id == Conversation.id)
+        .correlate(Conversation)
+        .scalar_subquery()
+    )
+    stmt = select(
+        # cast to text so the driver hands the document over as is instead of decoding it
+        cast(
+            func.json_build_object(
+                "id", Conversation.id,
+                "created_at", Conversation.created_at,
+                "updated_at", Conversation.updated_at,
+                "headline", Conversation.headline,
+                "messages", messages,
+                "documents", documents,
+            ),
+            Text,
+        )
+    ).where(Conversation.id == conversation_id)
+
+    result = await db.execute(stmt)
+    return result.scalar_one_or_none()
+
+
+async def fetch_conversation_for_chat(
+    db: AsyncSession,
+    conversation_id: str,
+    history_window: int,
+    fold_limit: int,
+    exclude_message_id: Optional[str] = None,
+) -> Optional[schema.ChatConversation]:
+    """
+    Fetch a conversation with only the last `history_window` successful messages
+    that are not yet folded into its history summary,
+    without their sub processes nor the conversation documents.
+    The oldest `fold_limit` unfolded messages older than the window are fetched as well, to be folded into the summary.
+    This is all the chat path needs to build the chat history, and its cost does not grow with the conversation.
+    return None if the conversation with the given id does not exist
+    """
+    stmt = select(Conversation).where(Conversation.id == conversation_id)
+    result = await db.execute(stmt)
+    conversation = result.scalars().first()
+    if conversation is None:
+        return None
+
+    unfolded = (
+        select(Message)
+        .where(Message.conversation_id == conversation_id)
+        .where(Message.status == MessageStatusEnum.SUCCESS)
+        .where(Message.content != "")
+    )
+    if exclude_message_id is not None:
+        unfolded = unfolded.where(Message.id != exclude_message_id)
+    if conversation.history_summary_until is not None:
+        unfolded = unfolded.where(
+            Message.created_at > conversation.history_summary_until
+        )
+    result = await db.execute(
+        unfolded.order_by(Message.created_at.desc(), Message.id.desc()).limit(
+            history_window
+        )
+    )
+    messages = list(reversed(result.scalars().all()))
+
+    messages_to_fold: Sequence[Message] = []
+    if len(messages) == history_window:
+        # one more than the limit tells whether the fold reaches the window
+        result = await db.execute(
+            unfolded.where(
+                tuple_(Message.created_at, Message.id)
+                < tuple_(messages[0].created_at, messages[0].id)
+            )
+            .order_by(Message.created_at, Message.id)
+            .limit(fold_limit + 1)
+        )
+        messages_to_fold = result.scalars().all()
+
+    return construct_chat_conversation(
+        conversation,
+        messages=[construct_message(msg, with_sub_processes=False) for msg in messages],
+        messages_to_fold=[
+            construct_message(msg, with_sub_processes=False)
+            for msg in messages_to_fold[:fold_limit]
+        ],
+        more_to_fold=len(messages_to_fold) > fold_limit,
+    )
+
+
+async def fetch_messages_page(
+    db: AsyncSession,
+    conversation_id: str,
+    limit: int,
+    before: Optional[Tuple[datetime, UUID]] = None,
+) -> schema.MessagePage:
+    """
+    Fetch a page of the messages of a conversation, with their sub processes, going back in time.
+    Messages are returned in chronological order; pass the decoded `next_cursor` as `before` to get the previous page.
+    Pages are keyed by (created_at, id), so messages created at the same time are never split out of both pages.
+    """
+    stmt = (
+        select(Message)
+        .options(selectinload(Message.sub_processes))
+        .where(Message.conversation_id == conversation_id)
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(limit + 1)
+    )
+    if before is not None:
+        stmt = stmt.where(tuple_(Message.created_at, Message.id) < tuple_(*before))
+    result = await db.execute(stmt)
+    messages = list(result.scalars().all())
+
+    has_more = len(messages) > limit
+    messages = list(reversed(messages[:limit]))
+
+    return schema.MessagePage(
+        messages=[construct_message(msg) for msg in messages],
+        next_cursor=encode_message_cursor(messages[0]) if has_more else None,
+    )
 
 
 async def create_conversation(
@@ -167,6 +392,100 @@ async def create_conversation(
     return await fetch_conversation_with_messages(db, conversation.id)  # type: ignore
 
 
+async def save_pending_message(
+    db: AsyncSession,
+    message: Message,
+    user_message: Optional[Message] = None,
+    replace: bool = False,
+) -> None:
+    """
+    Persist a PENDING assistant message before its generation starts, and the user message it answers if given.
+    The timestamps are filled in on the objects, so that they can be returned without fetching them again.
+
+    New messages are written with a single multi-row INSERT. With `replace`, the message is a regenerated one: it is
+    updated and the sub processes of its previous answer are detached from it.
+    """
+    now = datetime.utcnow()
+    if message.created_at is None:
+        message.created_at = now  # type: ignore
+    message.updated_at = now  # type: ignore
+
+    if replace:
+        await db.execute(
+            update(Message)
+            .where(Message.id == message.id)
+            .values(
+                updated_at=message.updated_at,
+                content=message.content,
+                temperature=message.temperature,
+                status=message.status,
+            )
+        )
+        await db.execute(
+            update(MessageSubProcess)
+            .where(MessageSubProcess.message_id == message.id)
+            .values(message_id=None)
+        )
+    else:
+        message_rows = [row_values(message, MESSAGE_FIELDS)]
+        if user_message is not None:
+            message_rows.insert(0, row_values(user_message, MESSAGE_FIELDS))
+        await db.execute(insert(Message).values(message_rows))
+    await db.commit()
+
+
+async def checkpoint_message(
+    db: AsyncSession,
+    message: Message,
+    sub_processes: Sequence[MessageSubProcess] = (),
+    update_message: bool = True,
+) -> None:
+    """
+    Persist the progress of an assistant message saved with `save_pending_message`: its content and status, unless
+    `update_message` is False, and the given sub processes, new or changed since the last checkpoint, with a single
+    multi-row upsert.
+
+    The last checkpoint, at the end of the stream, is the final write of the message: one UPDATE and one upsert of the
+    sub processes not checkpointed yet. No RETURNING is needed, since the ids and timestamps are set on the objects
+    beforehand and the final message is built from them.
+    """
+    now = datetime.utcnow()
+    for sub_process in sub_processes:
+        if sub_process.id is None:
+            sub_process.id = uuid4()  # type: ignore
+        if sub_process.created_at is None:
+            sub_process.created_at = now  # type: ignore
+        sub_process.updated_at = now  # type: ignore
+        sub_process.message_id = message.id  # type: ignore
+
+    if update_message:
+        message.updated_at = now  # type: ignore
+        await db.execute(
+            update(Message)
+            .where(Message.id == message.id)
+            .values(
+                updated_at=message.updated_at,
+                content=message.content,
+                temperature=message.temperature,
+                status=message.status,
+            )
+        )
+    if sub_processes:
+        stmt = insert(MessageSubProcess).values(
+            [row_values(sub_process, SUB_PROCESS_FIELDS) for sub_process in sub_processes]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[MessageSubProcess.id],
+            set_={
+                "updated_at": stmt.excluded.updated_at,
+                "status": stmt.excluded.status,
+                "metadata_map": stmt.excluded.metadata_map,
+            },
+        )
+        await db.execute(stmt)
+    await db.commit()
+
+
 async def fetch_message_with_sub_processes(
     db: AsyncSession, message_id: str
 ) -> Optional[schema.Message]:
@@ -183,17 +502,7 @@ async def fetch_message_with_sub_processes(
     result = await db.execute(stmt)  # execute the statement
     message = result.scalars().first()  # get the first result
     if message is not None:
-        return schema.Message.model_validate(
-            {
-                **message.__dict__,
-                "sub_processes": [
-                    schema.MessageSubProcess.model_validate(
-                        sp if isinstance(sp, dict) else sp.__dict__
-                    )
-                    for sp in message.sub_processes
-                ],
-            }
-        )
+        return construct_message(message)
     return None
 
 
@@ -215,6 +524,26 @@ async def get_message_with_sub_processes(
     return message
 
 
+async def fetch_asked_user_message(
+    db: AsyncSession, message: Message
+) -> Optional[Message]:
+    """
+    Fetch the user message answered by an assistant message, i.e. the last user message of its conversation
+    created before it
+    return None if there is no such message
+    """
+    stmt = (
+        select(Message)
+        .where(Message.conversation_id == message.conversation_id)
+        .where(Message.role == MessageRoleEnum.user)
+        .where(Message.created_at <= message.created_at)
+        .order_by(Message.created_at.desc())
+        .limit(1)
+    )
+    result = await db.execute(stmt)
+    return result.scalars().first()
+
+
 async def fetch_documents(
     db: AsyncSession,
     id: Optional[str] = None,
@@ -1,35 +1,47 @@
-import asyncio
-import datetime
 import logging
-from collections import OrderedDict
-from typing import Sequence
-from uuid import UUID, uuid4
+from typing import Optional, Sequence
+from uuid import UUID
 
-import anyio
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sse_starlette.sse import EventSourceResponse
 
 import schema
 from api import crud
 from api.deps import get_db
-from chat.messaging import (
-    StreamedMessage,
-    StreamedMessageSubProcess,
-    handle_chat_message,
-)
-from libs.models.chatdb import (
-    Message,
-    MessageRoleEnum,
-    MessageStatusEnum,
-    MessageSubProcess,
-    MessageSubProcessStatusEnum,
-)
+from api.jobs import follow_persisted_message, start_message_job
+from api.serialization import decode_message_cursor, json_response
+from api.streaming import generation_registry, parse_event_id
+from chat.checkpoints import workflow_checkpointer
+from core.config import settings
+from libs.models.chatdb import Message, MessageStatusEnum
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
 
+def resume_stream(
+    conversation_id: UUID,
+    last_event_id: Optional[str],
+    stream_mode: schema.StreamModeEnum,
+) -> Optional[EventSourceResponse]:
+    """
+    Returns the stream of the generation a Last-Event-ID belongs to: its events if it runs on this worker, its message
+    followed in the database otherwise. None if there is no Last-Event-ID to resume from.
+    """
+    resumed = generation_registry.resolve(last_event_id)
+    if resumed is not None and resumed[0].conversation_id == str(conversation_id):
+        generation, last_seq = resumed
+        return EventSourceResponse(generation.subscribe(last_seq))
+    parsed = parse_event_id(last_event_id)
+    if parsed is None:
+        return None
+    # the generation runs, or ran, on another worker
+    return EventSourceResponse(
+        follow_persisted_message(parsed[0], str(conversation_id), stream_mode)
+    )
+
+
 @router.post("/")
 async def create_conversation(
     payload: schema.ConversationCreate,
@@ -87,9 +99,10 @@ async def update_human_feedback(
 @router.put("/{conversation_id}")
 async def update_conversation(
     conversation_id: UUID, db: AsyncSession = Depends(get_db)
-) -> schema.Conversation:
+) -> schema.ConversationHeadline:
     """
-    Update a conversation by ID along with its first message.
+    Update the headline of a conversation from its first message.
+    Returns immediately with the cached headline, or a PENDING status while it is generated in the background.
     """
     conversation = await crud.update_conversation_headline(db, str(conversation_id))
 
@@ -98,17 +111,52 @@ async def update_conversation(
     return conversation
 
 
-@router.get("/{conversation_id}")
+@router.get("/{conversation_id}", response_model=schema.Conversation)
 async def get_conversation(
     conversation_id: UUID, db: AsyncSession = Depends(get_db)
-) -> schema.Conversation:
+) -> Response:
     """
     Get a conversation by ID along with its messages and message subprocesses.
     """
     conversation = await crud.fetch_conversation_with_messages(db, str(conversation_id))
     if conversation is None:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    return conversation
+    return json_response(conversation)
+
+
+@router.get("/{conversation_id}/json", response_model=schema.Conversation)
+async def get_conversation_json(
+    conversation_id: UUID, db: AsyncSession = Depends(get_db)
+) -> Response:
+    """
+    Get a conversation by ID along with its messages and message subprocesses, like GET /{conversation_id}.
+    The JSON document is built by Postgres in a single query and sent as is, which scales better to long conversations.
+    """
+    conversation_json = await crud.fetch_conversation_json(db, str(conversation_id))
+    if conversation_json is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return Response(content=conversation_json, media_type="application/json")
+
+
+@router.get("/{conversation_id}/messages", response_model=schema.MessagePage)
+async def get_conversation_messages(
+    conversation_id: UUID,
+    before: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_db),
+) -> Response:
+    """
+    Get a page of the messages of a conversation along with their subprocesses, newest page first.
+    Pass the `next_cursor` of a page as `before` to fetch the page preceding it.
+    """
+    try:
+        position = decode_message_cursor(before) if before is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    page = await crud.fetch_messages_page(
+        db, str(conversation_id), limit=limit, before=position
+    )
+    return json_response(page)
 
 
 @router.delete(
@@ -132,6 +180,8 @@ async def message_conversation(
     user_message: str,
     temperature: float,
     db: AsyncSession = Depends(get_db),
+    stream_mode: schema.StreamModeEnum = schema.StreamModeEnum.FULL,
+    last_event_id: Optional[str] = Header(None),
 ) -> EventSourceResponse:
     """
     Send a message from a user to a conversation, receive a SSE stream of the assistant's response.
@@ -139,109 +189,32 @@ async def message_conversation(
     the message object's sub_processes list and content string is appended to. While the message is being
     generated, the status of the message will be PENDING. Once the message is generated, the status will
     be SUCCESS. If there was an error in processing the message, the final status will be ERROR.
+    With `stream_mode=delta`, each event is instead a MessageDelta ("delta" event) carrying only what changed,
+    and the full Message is sent once, as the last ("message") event.
+    The generation goes on if the client disconnects: reconnecting with the Last-Event-ID header of the last event
+    received resumes the stream where it stopped, without generating the answer again. A reconnection reaching
+    another worker follows the message through its checkpoints instead (see follow_persisted_message). If no client
+    reconnects to its worker within GENERATION_ABANDON_GRACE_SECONDS, the generation is cancelled and the partial
+    message saved as ERROR: load balancers spreading the requests of a client over several workers should use the
+    /jobs endpoints, whose generations are never cancelled for lack of clients.
     """
-    conversation = await crud.fetch_conversation_with_messages(db, str(conversation_id))
+    resumed = resume_stream(conversation_id, last_event_id, stream_mode)
+    if resumed is not None:
+        return resumed
+
+    conversation = await crud.fetch_conversation_for_chat(
+        db,
+        str(conversation_id),
+        history_window=settings.CHAT_HISTORY_WINDOW,
+        fold_limit=settings.CHAT_HISTORY_FOLD_LIMIT,
+    )
     if conversation is None:
         raise HTTPException(status_code=404, detail="Conversation not found")
 
-    user_messages = Message(
-        created_at=datetime.datetime.utcnow(),  # type: ignore
-        updated_at=datetime.datetime.utcnow(),  # type: ignore
-        conversation_id=conversation_id,  # type: ignore
-        temperature=temperature,  # type: ignore
-        content=user_message,  # type: ignore
-        role=MessageRoleEnum.user,  # type: ignore
-        status=MessageStatusEnum.SUCCESS,  # type: ignore
-    )  # type: ignore
-
-    send_chan, recv_chan = anyio.create_memory_object_stream(1000)
-
-    async def event_publisher():
-        async with send_chan:
-            task = asyncio.create_task(
-                handle_chat_message(
-                    conversation,
-                    schema.UserMessageCreate(content=user_message),
-                    send_chan,
-                )
-            )
-            message_id = str(uuid4())
-            message = Message(
-                id=message_id,  # type: ignore
-                conversation_id=conversation_id,  # type: ignore
-                content="",  # type: ignore
-                temperature=temperature,  # type: ignore
-                role=MessageRoleEnum.assistant,  # type: ignore
-                status=MessageStatusEnum.PENDING,  # type: ignore
-                sub_processes=[],  # type: ignore
-            )  # type: ignore
-            final_status = MessageStatusEnum.ERROR
-            event_id_to_sub_process = OrderedDict()
-            try:
-                async for message_obj in recv_chan:
-                    if isinstance(message_obj, StreamedMessage):
-                        message.content = message_obj.content  # type: ignore
-                    elif isinstance(message_obj, StreamedMessageSubProcess):
-                        status = (
-                            MessageSubProcessStatusEnum.FINISHED
-                            if message_obj.has_ended
-                            else MessageSubProcessStatusEnum.PENDING
-                        )
-                        if message_obj.event_id in event_id_to_sub_process:
-                            created_at = event_id_to_sub_process[
-                                message_obj.event_id
-                            ].created_at
-                        else:
-                            created_at = datetime.datetime.utcnow()
-                        sub_process = MessageSubProcess(
-                            created_at=created_at,  # type: ignore
-                            message_id=message_id,  # type: ignore
-                            source=message_obj.source,  # type: ignore
-                            metadata_map=message_obj.metadata_map,  # type: ignore
-                            status=status,  # type: ignore
-                        )  # type: ignore
-                        event_id_to_sub_process[message_obj.event_id] = sub_process
-
-                        message.sub_processes = list(event_id_to_sub_process.values())
-                    else:
-                        logger.error(
-                            f"Unknown message object type: {type(message_obj)}"
-                        )
-                        continue
-
-                    validated_message = schema.Message.model_validate(
-                        {
-                            **message.__dict__,
-                            "sub_processes": [
-                                schema.MessageSubProcess.model_validate(
-                                    sp if isinstance(sp, dict) else sp.__dict__
-                                )
-                                for sp in message.sub_processes
-                            ],
-                        }
-                    )
-
-                    yield validated_message.model_dump_json()
-
-                await task
-                if task.exception():
-                    raise ValueError(
-                        "handle_chat_message task failed"
-                    ) from task.exception()
-                final_status = MessageStatusEnum.SUCCESS
-            except:
-                logger.error("Error in message publisher", exc_info=True)
-                final_status = MessageStatusEnum.ERROR
-
-            message.status = final_status  # type: ignore
-            db.add(user_messages)
-            db.add(message)
-            await db.commit()
-
-            final_message = await crud.fetch_message_with_sub_processes(db, message_id)
-            yield final_message.json()  # type: ignore
-
-    return EventSourceResponse(event_publisher())
+    generation = start_message_job(
+        conversation, user_message, temperature, stream_mode, cancel_on_abandon=True
+    )
+    return EventSourceResponse(generation.subscribe())
 
 
 @router.get("/{conversation_id}/regenerate")
@@ -251,6 +224,8 @@ async def regenerate_message(
     temperature: float,
     last_ai_message_id: str,
     db: AsyncSession = Depends(get_db),
+    stream_mode: schema.StreamModeEnum = schema.StreamModeEnum.FULL,
+    last_event_id: Optional[str] = Header(None),
 ) -> EventSourceResponse:
     """
     Send a message from a user to a conversation, receive a SSE stream of the assistant's response.
@@ -258,104 +233,227 @@ async def regenerate_message(
     the message object's sub_processes list and content string is appended to. While the message is being
     generated, the status of the message will be PENDING. Once the message is generated, the status will
     be SUCCESS. If there was an error in processing the message, the final status will be ERROR.
+    With `stream_mode=delta`, each event is instead a MessageDelta ("delta" event) carrying only what changed,
+    and the full Message is sent once, as the last ("message") event.
+    The generation goes on if the client disconnects: reconnecting with the Last-Event-ID header of the last event
+    received resumes the stream where it stopped, without generating the answer again. A reconnection reaching
+    another worker follows the message through its checkpoints instead (see follow_persisted_message). If no client
+    reconnects to its worker within GENERATION_ABANDON_GRACE_SECONDS, the generation is cancelled and the partial
+    message saved as ERROR: load balancers spreading the requests of a client over several workers should use the
+    /jobs endpoints, whose generations are never cancelled for lack of clients.
     """
-    conversation = await crud.fetch_conversation_with_messages(db, str(conversation_id))
+    resumed = resume_stream(conversation_id, last_event_id, stream_mode)
+    if resumed is not None:
+        return resumed
+
+    conversation = await crud.fetch_conversation_for_chat(
+        db,
+        str(conversation_id),
+        history_window=settings.CHAT_HISTORY_WINDOW,
+        fold_limit=settings.CHAT_HISTORY_FOLD_LIMIT,
+        exclude_message_id=last_ai_message_id,
+    )
     if conversation is None:
         raise HTTPException(status_code=404, detail="Conversation not found")
 
     message: Message | None = await crud.get_message_with_sub_processes(
         db, last_ai_message_id
     )
-    message.status = MessageStatusEnum.PENDING  # type: ignore
-    message.content = ""  # type: ignore
-    message.sub_processes = []  # type: ignore
-
-    send_chan, recv_chan = anyio.create_memory_object_stream(1000)
-
-    async def event_publisher():
-        async with send_chan:
-            task = asyncio.create_task(
-                handle_chat_message(
-                    conversation,
-                    schema.UserMessageCreate(content=user_message),
-                    send_chan,
-                    last_ai_message_id,
-                )
+    if message is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    # the job updates the message on its own, outside of the request session
+    db.expunge(message)
+
+    generation = start_message_job(
+        conversation,
+        user_message,
+        temperature,
+        stream_mode,
+        regenerated_message=message,
+        cancel_on_abandon=True,
+    )
+    return EventSourceResponse(generation.subscribe())
+
+
+@router.post("/{conversation_id}/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_message_job(
+    conversation_id: UUID,
+    payload: schema.MessageJobCreate,
+    db: AsyncSession = Depends(get_db),
+) -> schema.MessageJob:
+    """
+    Submit a message from a user to a conversation and return right away with the id of the assistant message.
+    The answer is generated in the background: follow it with GET /jobs/{message_id}/events (SSE, resumable with
+    Last-Event-ID) or poll GET /jobs/{message_id}. Set `last_ai_message_id` to regenerate an assistant message.
+    """
+    conversation = await crud.fetch_conversation_for_chat(
+        db,
+        str(conversation_id),
+        history_window=settings.CHAT_HISTORY_WINDOW,
+        fold_limit=settings.CHAT_HISTORY_FOLD_LIMIT,
+        exclude_message_id=(
+            str(payload.last_ai_message_id) if payload.last_ai_message_id else None
+        ),
+    )
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    regenerated_message = None
+    if payload.last_ai_message_id is not None:
+        regenerated_message = await crud.get_message_with_sub_processes(
+            db, str(payload.last_ai_message_id)
+        )
+        if regenerated_message is None:
+            raise HTTPException(status_code=404, detail="Message not found")
+        db.expunge(regenerated_message)
+
+    generation = start_message_job(
+        conversation,
+        payload.user_message,
+        payload.temperature,
+        payload.stream_mode,
+        regenerated_message=regenerated_message,
+    )
+    return schema.MessageJob(
+        message_id=generation.id,  # type: ignore
+        conversation_id=conversation_id,
+        status=MessageStatusEnum.PENDING,
+    )
+
+
+@router.post(
+    "/{conversation_id}/jobs/{message_id}/resume",
+    status_code=status.HTTP_202_ACCEPTED,
+)
+async def resume_message_job(
+    conversation_id: UUID,
+    message_id: UUID,
+    payload: schema.MessageJobResume,
+    db: AsyncSession = Depends(get_db),
+) -> schema.MessageJob:
+    """
+    Resume on this worker a message job whose worker is gone (recycled or crashed) from the last checkpoint of its
+    workflow, then follow it like any other job.
+    """
+    if generation_registry.get(str(message_id)) is not None:
+        raise HTTPException(status_code=409, detail="Job is running on this worker")
+    if not await workflow_checkpointer.ahas_checkpoint(str(message_id)):
+        raise HTTPException(status_code=404, detail="No checkpoint to resume the job from")
+
+    conversation = await crud.fetch_conversation_for_chat(
+        db,
+        str(conversation_id),
+        history_window=settings.CHAT_HISTORY_WINDOW,
+        fold_limit=settings.CHAT_HISTORY_FOLD_LIMIT,
+        exclude_message_id=str(message_id),
+    )
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    message = await crud.get_message_with_sub_processes(db, str(message_id))
+    if message is None or message.conversation_id != conversation_id:
+        raise HTTPException(status_code=404, detail="Message not found")
+    user_message = await crud.fetch_asked_user_message(db, message)
+    if user_message is None:
+        raise HTTPException(status_code=404, detail="User message not found")
+    db.expunge(message)
+
+    generation = start_message_job(
+        conversation,
+        user_message.content,  # type: ignore
+        message.temperature,  # type: ignore
+        payload.stream_mode,
+        regenerated_message=message,
+        resume=True,
+    )
+    return schema.MessageJob(
+        message_id=message_id,
+        conversation_id=conversation_id,
+        status=MessageStatusEnum.PENDING,
+    )
+
+
+@router.get("/{conversation_id}/jobs/{message_id}")
+async def get_message_job(
+    conversation_id: UUID, message_id: UUID, db: AsyncSession = Depends(get_db)
+) -> schema.MessageJob:
+    """
+    Poll a message job. Returns the current state of the message while it is generated by this worker, and the
+    persisted message otherwise.
+    """
+    generation = generation_registry.get(str(message_id))
+    if (
+        generation is not None
+        and generation.conversation_id == str(conversation_id)
+        and not generation.done
+        and generation.snapshot is not None
+    ):
+        return schema.MessageJob(
+            message_id=message_id,
+            conversation_id=conversation_id,
+            status=MessageStatusEnum.PENDING,
+            message=schema.Message.model_validate_json(generation.snapshot()),
+        )
+
+    message = await crud.fetch_message_with_sub_processes(db, str(message_id))
+    if message is None or str(message.conversation_id) != str(conversation_id):
+        if generation is not None and not generation.done:
+            # the job is waiting for a generation slot
+            return schema.MessageJob(
+                message_id=message_id,
+                conversation_id=conversation_id,
+                status=MessageStatusEnum.PENDING,
             )
-            final_status = MessageStatusEnum.ERROR
-            event_id_to_sub_process = OrderedDict()
-            try:
-                async for message_obj in recv_chan:
-                    if isinstance(message_obj, StreamedMessage):
-                        message.content = message_obj.content  # type: ignore
-                    elif isinstance(message_obj, StreamedMessageSubProcess):
-                        status = (
-                            MessageSubProcessStatusEnum.FINISHED
-                            if message_obj.has_ended
-                            else MessageSubProcessStatusEnum.PENDING
-                        )
-                        if message_obj.event_id in event_id_to_sub_process:
-                            created_at = event_id_to_sub_process[
-                                message_obj.event_id
-                            ].created_at
-                        else:
-                            created_at = datetime.datetime.utcnow()
-                        sub_process = MessageSubProcess(
-                            created_at=created_at,  # type: ignore
-                            message_id=message.id,  # type: ignore
-                            source=message_obj.source,  # type: ignore
-                            metadata_map=message_obj.metadata_map,  # type: ignore
-                            status=status,  # type: ignore
-                        )  # type: ignore
-                        event_id_to_sub_process[message_obj.event_id] = sub_process
-
-                        message.sub_processes = list(event_id_to_sub_process.values())  # type: ignore
-                    else:
-                        logger.error(
-                            f"Unknown message object type: {type(message_obj)}"
-                        )
-                        continue
-
-                    validated_message = schema.Message.model_validate(
-                        {
-                            **message.__dict__,
-                            "sub_processes": [
-                                schema.MessageSubProcess.model_validate(
-                                    sp if isinstance(sp, dict) else sp.__dict__
-                                )
-                                for sp in message.sub_processes  # type: ignore
-                            ],
-                        }
-                    )
-
-                    yield validated_message.model_dump_json()
-
-                await task
-                if task.exception():
-                    raise ValueError(
-                        "handle_chat_message task failed"
-                    ) from task.exception()
-
-                final_status = MessageStatusEnum.SUCCESS
-
-            except asyncio.CancelledError:
-                print("Stream canceled. Closing the channel gracefully.")
-                raise
-            except Exception as e:
-                print(f"Error in message publisher: {e}")
-                logger.error("Error in message publisher", exc_info=True)
-                final_status = MessageStatusEnum.ERROR
-                raise
-
-            message.status = final_status  # type: ignore
-            message.temperature = temperature  # type: ignore
-            await db.commit()
-
-            final_message = await crud.fetch_message_with_sub_processes(db, message_id=message.id)  # type: ignore
-
-            yield final_message.json()  # type: ignore
-
-    return EventSourceResponse(event_publisher())
+        raise HTTPException(status_code=404, detail="Message not found")
+    return schema.MessageJob(
+        message_id=message_id,
+        conversation_id=conversation_id,
+        status=message.status,
+        message=message,
+    )
+
+
+@router.get("/{conversation_id}/jobs/{message_id}/events")
+async def get_message_job_events(
+    conversation_id: UUID,
+    message_id: UUID,
+    last_event_id: Optional[str] = Header(None),
+    stream_mode: schema.StreamModeEnum = schema.StreamModeEnum.FULL,
+) -> EventSourceResponse:
+    """
+    Follow a message job as a SSE stream, encoded with the `stream_mode` it was submitted with.
+    Reconnect with the Last-Event-ID header of the last event received to only get the events missed.
+    A job of another worker is followed through the checkpoints of its message, encoded with `stream_mode`.
+    """
+    generation = generation_registry.get(str(message_id))
+    if generation is None:
+        return EventSourceResponse(
+            follow_persisted_message(str(message_id), str(conversation_id), stream_mode)
+        )
+    if generation.conversation_id != str(conversation_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    resumed = generation_registry.resolve(last_event_id)
+    last_seq = resumed[1] if resumed is not None and resumed[0] is generation else None
+    return EventSourceResponse(generation.subscribe(last_seq))
+
+
+@router.delete(
+    "/{conversation_id}/jobs/{message_id}",
+    response_model=None,
+    status_code=status.HTTP_204_NO_CONTENT,
+)
+async def cancel_message_job(conversation_id: UUID, message_id: UUID):
+    """
+    Cancel a message job running on this worker. The message generated so far is saved with the ERROR status.
+    """
+    generation = generation_registry.get(str(message_id))
+    if (
+        generation is None
+        or generation.conversation_id != str(conversation_id)
+        or not generation_registry.cancel(generation)
+    ):
+        raise HTTPException(status_code=404, detail="No running job found on this worker")
+    return
 
 
 @router.get("/{conversation_id}/test_message")
@@ -373,10 +471,12 @@ async def test_message_conversation(
         user_message,
         temperature,
         db,
+        stream_mode=schema.StreamModeEnum.FULL,
+        last_event_id=None,
     )
     final_message = None
-    async for message in response.body_iterator:
-        final_message = message
+    async for event in response.body_iterator:
+        final_message = event["data"] if isinstance(event, dict) else event
     if final_message is not None:
         return schema.Message.parse_raw(final_message)  # type: ignore
     else:
@@ -1,9 +1,18 @@
-from typing import Dict
-from fastapi import APIRouter, Depends
+from typing import Any, Dict
+from fastapi import APIRouter, Depends, Response, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import text
 from api import crud
 from api import deps
+from api.streaming import generation_registry
+from chat.answer_cache import answer_cache
+from chat.event_pipeline import callback_event_stats
+from chat.checkpoints import workflow_checkpointer
+from chat.concurrency import concurrency_governor
+from chat.router import agent_router
+from chat.custom_sql_query_engine import sql_result_cache, text_to_sql_cache
+from chat.engine import query_engine_registry
+from libs.db.sql_executor import sql_executor
 
 
 router = APIRouter()
@@ -20,3 +29,31 @@ async def health(db: AsyncSession = Depends(deps.get_db)) -> Dict[str, str]:
 
     await db.execute(text("SELECT 1"))
     return {"status": "alive"}
+
+
+@router.get("/ready")
+async def ready(response: Response) -> Dict[str, Any]:
+    """
+    Readiness probe. Reports whether the query engines have been warmed up; answers 503 while cold.
+    """
+    if not query_engine_registry.is_warm:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return query_engine_registry.status()
+
+
+@router.get("/stats")
+async def stats() -> Dict[str, Any]:
+    """
+    Runtime counters of the worker serving the request.
+    """
+    return {
+        "sql_executor": sql_executor.stats(),
+        "text_to_sql_cache": text_to_sql_cache.stats(),
+        "sql_result_cache": sql_result_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "callback_events": callback_event_stats.stats(),
+        "generations": generation_registry.stats(),
+        "agent_router": agent_router.stats(),
+        "workflow_checkpoints": workflow_checkpointer.stats(),
+        "concurrency": concurrency_governor.stats(),
+    }
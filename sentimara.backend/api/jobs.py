@@ -0,0 +1,386 @@
+"""
+This module runs the generation of assistant messages as background jobs of the worker.
+
+A job is started by the conversation endpoints, either streamed right away (/message, /regenerate) or submitted and
+then followed by the client (/jobs). It runs in the GenerationRegistry, independently of the HTTP connection, so a slow
+or gone client neither holds a database connection nor stops the generation. The message is saved as PENDING when the
+job starts and checkpointed while it is generated, each write in a short-lived session of its own.
+"""
+
+import asyncio
+import datetime
+import logging
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Optional
+from uuid import uuid4
+
+import anyio
+
+import schema
+from api import crud
+from api.streaming import (
+    Generation,
+    MessageDeltaEncoder,
+    encode_final_message,
+    encode_message,
+    generation_registry,
+)
+from chat.headline import headline_service
+from chat.messaging import (
+    StreamedMessage,
+    StreamedMessageSubProcessBatch,
+    handle_chat_message,
+)
+from core.config import settings
+from libs.db.session import get_async_session
+from libs.models.chatdb import (
+    Message,
+    MessageRoleEnum,
+    MessageStatusEnum,
+    MessageSubProcess,
+    MessageSubProcessStatusEnum,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def save_pending_message(
+    message: Message,
+    user_message: str,
+    asked_at: datetime.datetime,
+    regenerate: bool,
+) -> None:
+    """Persists the PENDING assistant message, along with the user message unless the message is regenerated."""
+    async with get_async_session() as session:
+        if regenerate:
+            await crud.save_pending_message(session, message, replace=True)
+        else:
+            await crud.save_pending_message(
+                session,
+                message,
+                user_message=Message(
+                    id=uuid4(),  # type: ignore
+                    created_at=asked_at,  # type: ignore
+                    updated_at=asked_at,  # type: ignore
+                    conversation_id=message.conversation_id,  # type: ignore
+                    temperature=message.temperature,  # type: ignore
+                    content=user_message,  # type: ignore
+                    role=MessageRoleEnum.user,  # type: ignore
+                    status=MessageStatusEnum.SUCCESS,  # type: ignore
+                ),  # type: ignore
+            )
+
+
+class MessageCheckpointer:
+    """
+    Writes the progress of a message being generated to the database, so that it survives a crash of the worker and
+    can be followed by reading the conversation.
+
+    Changes are only marked as they stream in. A checkpoint is written at most once per interval, in the background,
+    with the content of the message if it changed and the sub processes changed since the previous checkpoint. Changes
+    made while it waits are part of it, and changes made while it writes are written by the next one, scheduled as soon
+    as it is done, so the writes never pile up behind a slow database and nothing marked waits for another change.
+    """
+
+    def __init__(
+        self,
+        message: Message,
+        interval: float = settings.MESSAGE_CHECKPOINT_INTERVAL,
+    ):
+        self._message = message
+        self._interval = interval
+        self._content_changed = False
+        # sub process id -> latest state of the sub process, not written yet
+        self._changed_sub_processes: Dict[Any, MessageSubProcess] = {}
+        self._last_write = 0.0
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._writing = False
+        self._flushed = False
+
+    def mark_content(self) -> None:
+        self._content_changed = True
+        self._schedule()
+
+    def mark_sub_process(self, sub_process: MessageSubProcess) -> None:
+        self._changed_sub_processes[sub_process.id] = sub_process
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if (
+            self._interval <= 0
+            or self._flushed
+            or (self._task is not None and not self._task.done())
+        ):
+            return
+        self._task = asyncio.create_task(self._checkpoint_later())
+
+    async def _checkpoint_later(self) -> None:
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(0.0, self._last_write + self._interval - loop.time()))
+        self._writing = True
+        try:
+            await self._write()
+        except Exception:
+            logger.warning("Failed to checkpoint message", exc_info=True)
+        finally:
+            self._writing = False
+            self._last_write = loop.time()
+            self._task = None
+            # changes marked during the write, or not written because it failed
+            if self._content_changed or self._changed_sub_processes:
+                self._schedule()
+
+    async def _write(self, update_message: bool = False) -> None:
+        sub_processes = list(self._changed_sub_processes.values())
+        update_message = update_message or self._content_changed
+        self._changed_sub_processes.clear()
+        self._content_changed = False
+        try:
+            async with get_async_session() as session:
+                await crud.checkpoint_message(
+                    session, self._message, sub_processes, update_message=update_message
+                )
+        except BaseException:
+            # written again with the next checkpoint
+            for sub_process in sub_processes:
+                self._changed_sub_processes.setdefault(sub_process.id, sub_process)
+            self._content_changed = self._content_changed or update_message
+            raise
+
+    async def flush(self) -> None:
+        """Writes the final state of the message, once the checkpoint in progress, if any, is done."""
+        self._flushed = True
+        if self._task is not None and not self._task.done():
+            if not self._writing:
+                self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self._write(update_message=True)
+
+
+async def message_job_events(
+    generation: Generation,
+    conversation: schema.ChatConversation,
+    user_message: str,
+    temperature: float,
+    message: Message,
+    regenerate: bool,
+    resume: bool = False,
+) -> AsyncIterator:
+    """
+    Generates the assistant message and yields the SSE events of its progress.
+
+    Parameters:
+    generation (Generation): The generation the events are published to.
+    conversation (schema.ChatConversation): The conversation, with the messages of its chat history.
+    user_message (str): The question of the user.
+    temperature (float): The temperature of the message.
+    message (Message): The PENDING assistant message, new or being regenerated.
+    regenerate (bool): Whether the message is regenerated, in which case the user message already exists.
+    resume (bool): Whether to resume the workflow of the message from its checkpoint, keeping its persisted state.
+    """
+    message_id = str(message.id)
+    stream_mode = generation.stream_mode
+    asked_at = datetime.datetime.utcnow()
+    checkpointer = MessageCheckpointer(message)
+    if resume:
+        # the message keeps what was persisted before its worker was gone, only its PENDING status is written
+        checkpointer.mark_content()
+    else:
+        await save_pending_message(message, user_message, asked_at, regenerate)
+    resumed_sub_processes = list(message.sub_processes) if resume else []
+    send_chan, recv_chan = anyio.create_memory_object_stream(1000)
+
+    task = asyncio.create_task(
+        handle_chat_message(
+            conversation,
+            schema.UserMessageCreate(content=user_message),
+            send_chan,
+            message_id if regenerate else None,
+            message_id=message_id,
+            resume=resume,
+        )
+    )
+    try:
+        generation.snapshot = lambda: encode_message(message)
+        encoder = MessageDeltaEncoder(message_id)
+        if stream_mode == schema.StreamModeEnum.DELTA:
+            yield encoder.status(MessageStatusEnum.PENDING)
+        final_status = MessageStatusEnum.ERROR
+        event_id_to_sub_process = OrderedDict()
+        try:
+            async for message_obj in recv_chan:
+                if isinstance(message_obj, StreamedMessage):
+                    message.content = message_obj.content  # type: ignore
+                    checkpointer.mark_content()
+                elif isinstance(message_obj, StreamedMessageSubProcessBatch):
+                    for streamed_sub_process in message_obj.sub_processes:
+                        status = (
+                            MessageSubProcessStatusEnum.FINISHED
+                            if streamed_sub_process.has_ended
+                            else MessageSubProcessStatusEnum.PENDING
+                        )
+                        previous = event_id_to_sub_process.get(
+                            streamed_sub_process.event_id
+                        )
+                        sub_process = MessageSubProcess(
+                            # the sub process keeps its row across checkpoints
+                            id=previous.id if previous is not None else uuid4(),  # type: ignore
+                            created_at=(
+                                previous.created_at
+                                if previous is not None
+                                else datetime.datetime.utcnow()
+                            ),  # type: ignore
+                            message_id=message_id,  # type: ignore
+                            source=streamed_sub_process.source,  # type: ignore
+                            metadata_map=streamed_sub_process.metadata_map,  # type: ignore
+                            status=status,  # type: ignore
+                        )  # type: ignore
+                        event_id_to_sub_process[
+                            streamed_sub_process.event_id
+                        ] = sub_process
+                        checkpointer.mark_sub_process(sub_process)
+
+                    message.sub_processes = resumed_sub_processes + list(  # type: ignore
+                        event_id_to_sub_process.values()
+                    )
+                else:
+                    logger.error(f"Unknown message object type: {type(message_obj)}")
+                    continue
+
+                if stream_mode == schema.StreamModeEnum.DELTA:
+                    for delta in encoder.encode(message_obj):
+                        yield delta
+                    continue
+
+                yield encode_message(message)
+
+            await task
+            if task.exception():
+                raise ValueError("handle_chat_message task failed") from task.exception()
+            final_status = MessageStatusEnum.SUCCESS
+        except Exception:
+            logger.error("Error in message publisher", exc_info=True)
+            final_status = MessageStatusEnum.ERROR
+    except asyncio.CancelledError:
+        # the generation was cancelled or abandoned: stop the chat task and keep what was generated so far
+        recv_chan.close()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        message.status = MessageStatusEnum.ERROR  # type: ignore
+        message.temperature = temperature  # type: ignore
+        await checkpointer.flush()
+        raise
+
+    message.status = final_status  # type: ignore
+    message.temperature = temperature  # type: ignore
+    await checkpointer.flush()
+
+    # the headline is generated in the background once the first answer is persisted
+    if (
+        not regenerate
+        and not conversation.messages
+        and final_status == MessageStatusEnum.SUCCESS
+    ):
+        headline_service.schedule(str(conversation.id), user_message)
+
+    if stream_mode == schema.StreamModeEnum.DELTA:
+        yield encoder.status(final_status)
+    # the persisted message is the one in memory, no need to fetch it again
+    yield encode_final_message(encode_message(message), stream_mode)
+
+
+def start_message_job(
+    conversation: schema.ChatConversation,
+    user_message: str,
+    temperature: float,
+    stream_mode: schema.StreamModeEnum,
+    regenerated_message: Optional[Message] = None,
+    cancel_on_abandon: bool = False,
+    resume: bool = False,
+) -> Generation:
+    """
+    Starts generating the answer to the user message in the background.
+
+    Parameters:
+    conversation (schema.ChatConversation): The conversation, with the messages of its chat history.
+    user_message (str): The question of the user.
+    temperature (float): The temperature of the message.
+    stream_mode (schema.StreamModeEnum): How the progress of the message is encoded as SSE events.
+    regenerated_message (Optional[Message]): The assistant message to regenerate, if any.
+    cancel_on_abandon (bool): Whether to cancel the generation when no client follows it anymore.
+    resume (bool): Whether to resume the workflow of the regenerated message from its checkpoint.
+
+    Returns:
+    Generation: The generation, whose id is the id of the assistant message.
+    """
+    if regenerated_message is not None:
+        message = regenerated_message
+        message.status = MessageStatusEnum.PENDING  # type: ignore
+        if not resume:
+            message.content = ""  # type: ignore
+            message.sub_processes = []  # type: ignore
+    else:
+        message = Message(
+            id=str(uuid4()),  # type: ignore
+            conversation_id=conversation.id,  # type: ignore
+            content="",  # type: ignore
+            temperature=temperature,  # type: ignore
+            role=MessageRoleEnum.assistant,  # type: ignore
+            status=MessageStatusEnum.PENDING,  # type: ignore
+            sub_processes=[],  # type: ignore
+        )  # type: ignore
+
+    return generation_registry.start(
+        str(message.id),
+        str(conversation.id),
+        stream_mode,
+        lambda generation: message_job_events(
+            generation,
+            conversation,
+            user_message,
+            temperature,
+            message,
+            regenerate=regenerated_message is not None,
+            resume=resume,
+        ),
+        cancel_on_abandon=cancel_on_abandon,
+    )
+
+
+async def follow_persisted_message(
+    message_id: str,
+    conversation_id: str,
+    stream_mode: schema.StreamModeEnum,
+    poll_interval: float = settings.STREAM_FOLLOW_POLL_INTERVAL,
+    idle_timeout: float = settings.STREAM_FOLLOW_IDLE_TIMEOUT,
+) -> AsyncIterator[Any]:
+    """
+    Follows a message generated by another worker through the checkpoints it writes to the database, until the
+    message is no longer PENDING, or has neither changed nor been created for `idle_timeout` seconds.
+
+    In the FULL mode every change of the message is sent, as a whole Message like the events of its worker. In the
+    DELTA mode only the completed message is sent, since the deltas of its worker cannot be rebuilt from the
+    checkpoints. The events carry no id, so the client keeps the Last-Event-ID of the generation and can still resume
+    it on its worker.
+    """
+    loop = asyncio.get_running_loop()
+    last_change = loop.time()
+    last_message_json: Optional[str] = None
+    while True:
+        async with get_async_session() as session:
+            message = await crud.get_message_with_sub_processes(session, message_id)
+            message_json = encode_message(message) if message is not None else None
+        if message is not None:
+            if str(message.conversation_id) != conversation_id:
+                return
+            if message.status != MessageStatusEnum.PENDING:
+                yield encode_final_message(message_json, stream_mode)  # type: ignore
+                return
+        if message_json != last_message_json:
+            last_message_json = message_json
+            last_change = loop.time()
+            if stream_mode == schema.StreamModeEnum.FULL:
+                yield message_json
+        elif loop.time() - last_change >= idle_timeout:
+            return
+        await asyncio.sleep(poll_interval)
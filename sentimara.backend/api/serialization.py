@@ -0,0 +1,123 @@
+"""
+This module builds the API schemas of conversations and messages from ORM rows without validating them again.
+
+The rows come from our own database, so their types already are the ones of the schemas: validating every message and
+sub process of a conversation with `model_validate` (after copying the ORM `__dict__`) only burns CPU. The schemas
+are built with `model_construct` from the row attributes instead, and serialized to JSON bytes by pydantic-core in one
+pass, which the endpoints return as is rather than letting FastAPI validate and serialize the response model again.
+
+Run `python -m benchmarks.serialization` to compare both paths.
+"""
+
+import base64
+from datetime import datetime
+from typing import Any, Dict, Iterable, Tuple
+from uuid import UUID
+
+from fastapi import Response
+from pydantic import BaseModel
+from pydantic_core import to_json
+
+import schema
+from libs.models.chatdb import Conversation, Document, Message, MessageSubProcess
+
+
+def _fields_of(model: type[BaseModel], *excluded: str) -> Tuple[str, ...]:
+    return tuple(name for name in model.model_fields if name not in excluded)
+
+
+SUB_PROCESS_FIELDS = _fields_of(schema.MessageSubProcess)
+MESSAGE_FIELDS = _fields_of(schema.Message, "sub_processes")
+DOCUMENT_FIELDS = _fields_of(schema.Document)
+CONVERSATION_FIELDS = _fields_of(schema.Conversation, "messages", "documents")
+CHAT_CONVERSATION_FIELDS = _fields_of(
+    schema.ChatConversation, "messages", "documents", "messages_to_fold", "more_to_fold"
+)
+
+
+def row_values(row: Any, fields: Tuple[str, ...]) -> Dict[str, Any]:
+    """Returns the given attributes of a row, read from its loaded state so that no lazy load is ever triggered."""
+    state = row.__dict__
+    return {name: state.get(name) for name in fields}
+
+
+def construct_sub_process(sub_process: MessageSubProcess) -> schema.MessageSubProcess:
+    return schema.MessageSubProcess.model_construct(
+        **row_values(sub_process, SUB_PROCESS_FIELDS)
+    )
+
+
+def construct_message(
+    message: Message, with_sub_processes: bool = True
+) -> schema.Message:
+    sub_processes = message.sub_processes if with_sub_processes else []
+    return schema.Message.model_construct(
+        **row_values(message, MESSAGE_FIELDS),
+        sub_processes=[construct_sub_process(sp) for sp in sub_processes],
+    )
+
+
+def construct_document(document: Document) -> schema.Document:
+    return schema.Document.model_construct(**row_values(document, DOCUMENT_FIELDS))
+
+
+def construct_conversation(
+    conversation: Conversation,
+    messages: Iterable[schema.Message],
+    documents: Iterable[schema.Document],
+) -> schema.Conversation:
+    return schema.Conversation.model_construct(
+        **row_values(conversation, CONVERSATION_FIELDS),
+        messages=list(messages),
+        documents=list(documents),
+    )
+
+
+def construct_chat_conversation(
+    conversation: Conversation,
+    messages: Iterable[schema.Message],
+    messages_to_fold: Iterable[schema.Message] = (),
+    more_to_fold: bool = False,
+) -> schema.ChatConversation:
+    return schema.ChatConversation.model_construct(
+        **row_values(conversation, CHAT_CONVERSATION_FIELDS),
+        messages=list(messages),
+        documents=[],
+        messages_to_fold=list(messages_to_fold),
+        more_to_fold=more_to_fold,
+    )
+
+
+def message_to_dict(message: Message) -> Dict[str, Any]:
+    """Returns the plain values of a message being generated, which may not be a persisted row yet."""
+    values = row_values(message, MESSAGE_FIELDS)
+    values["sub_processes"] = [
+        row_values(sp, SUB_PROCESS_FIELDS) for sp in message.sub_processes
+    ]
+    return values
+
+
+def dump_json(obj: Any) -> bytes:
+    """Serializes schemas, or plain values with UUIDs, datetimes and enums, to JSON."""
+    return to_json(obj)
+
+
+def json_response(obj: Any) -> Response:
+    """Returns already serializable data as a JSON response, bypassing the response model validation."""
+    return Response(content=dump_json(obj), media_type="application/json")
+
+
+def encode_message_cursor(message: Message) -> str:
+    """Encodes the (created_at, id) position of a message as an opaque, URL-safe page cursor."""
+    position = f"{message.created_at.isoformat()}/{message.id}"
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+
+def decode_message_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    """Decodes a page cursor into the (created_at, id) position of a message. Raises ValueError if it is invalid."""
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except Exception as e:
+        raise ValueError(f"Invalid cursor {cursor!r}") from e
+    created_at, _, message_id = position.rpartition("/")
+    return datetime.fromisoformat(created_at), UUID(message_id)
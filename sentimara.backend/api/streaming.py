@@ -0,0 +1,333 @@
+"""
+This module turns the objects streamed by the chat engine into the events sent over SSE by the conversation endpoints.
+
+In the default FULL mode every event carries the whole Message. In the DELTA mode every event only carries what changed
+since the previous one (appended content, a new or updated sub process, a status transition), numbered by a sequence
+number, and the whole Message is sent once, when it is completed.
+
+Generations run independently of the SSE connection that started them. Every event gets an id made of the generation
+id and its sequence number, and the last events of each generation are kept in a bounded replay buffer, so a client
+reconnecting with a Last-Event-ID header attaches to the running generation and only receives the events it missed.
+The generations only live in the memory of their worker: a client reconnecting to another worker follows the message
+through its checkpoints in the database instead (see api.jobs.follow_persisted_message).
+A streamed generation that nobody follows anymore for a grace period is cancelled, down to its LLM requests and SQL
+queries, so closing the tab does not keep spending tokens and database time.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+import schema
+from api.serialization import dump_json, message_to_dict
+from chat.messaging import StreamedMessage, StreamedMessageSubProcessBatch
+from core.config import settings
+from libs.models.chatdb import Message, MessageStatusEnum, MessageSubProcessStatusEnum
+
+logger = logging.getLogger(__name__)
+
+DELTA_EVENT = "delta"
+MESSAGE_EVENT = "message"
+
+
+def encode_message(message: Message) -> str:
+    """Serializes the assistant message being streamed, along with its sub processes."""
+    return dump_json(message_to_dict(message)).decode()
+
+
+class MessageDeltaEncoder:
+    """
+    Encodes the changes of a streamed assistant message as MessageDelta SSE events.
+    """
+
+    def __init__(self, message_id: Any):
+        self._message_id = message_id
+        self._seq = 0
+        self._content = ""
+
+    def _event(self, **kwargs: Any) -> Dict[str, str]:
+        delta = schema.MessageDelta(seq=self._seq, message_id=self._message_id, **kwargs)
+        self._seq += 1
+        return {"event": DELTA_EVENT, "data": delta.model_dump_json(exclude_none=True)}
+
+    def status(self, status: MessageStatusEnum) -> Dict[str, str]:
+        """Encodes a status transition of the message."""
+        return self._event(type=schema.MessageDeltaTypeEnum.STATUS, status=status)
+
+    def encode(self, message_obj: Any) -> List[Dict[str, str]]:
+        """Encodes the changes carried by a streamed object; empty if nothing changed."""
+        if isinstance(message_obj, StreamedMessage):
+            content = message_obj.content
+            if content == self._content:
+                return []
+            if content.startswith(self._content):
+                event = self._event(
+                    type=schema.MessageDeltaTypeEnum.CONTENT,
+                    content=content[len(self._content) :],
+                )
+            else:
+                event = self._event(
+                    type=schema.MessageDeltaTypeEnum.CONTENT, content=content, replace=True
+                )
+            self._content = content
+            return [event]
+
+        if isinstance(message_obj, StreamedMessageSubProcessBatch):
+            return [
+                self._event(
+                    type=schema.MessageDeltaTypeEnum.SUB_PROCESS,
+                    sub_process=schema.SubProcessDelta(
+                        event_id=sub_process.event_id,
+                        source=sub_process.source,
+                        status=(
+                            MessageSubProcessStatusEnum.FINISHED
+                            if sub_process.has_ended
+                            else MessageSubProcessStatusEnum.PENDING
+                        ),
+                        metadata_map=sub_process.metadata_map,
+                    ),
+                )
+                for sub_process in message_obj.sub_processes
+            ]
+
+        return []
+
+
+def encode_final_message(message_json: str, stream_mode: schema.StreamModeEnum) -> Any:
+    """Wraps the completed message in the SSE event of the stream mode."""
+    if stream_mode == schema.StreamModeEnum.DELTA:
+        return {"event": MESSAGE_EVENT, "data": message_json}
+    return message_json
+
+
+
+class Generation:
+    """
+    The events of one assistant message being generated, along with a bounded buffer of the last ones.
+    """
+
+    def __init__(
+        self,
+        generation_id: str,
+        conversation_id: str,
+        stream_mode: schema.StreamModeEnum,
+        buffer_size: int,
+    ):
+        self.id = generation_id
+        self.conversation_id = conversation_id
+        self.stream_mode = stream_mode
+        # returns the current state of the message, sent instead of the deltas evicted from the buffer
+        self.snapshot: Optional[Callable[[], str]] = None
+        self.task: Optional["asyncio.Task[None]"] = None
+        # when the generation got a slot to run, None while it waits for one
+        self.started_at: Optional[float] = None
+        # whether the generation is cancelled once it has no subscribers left, and the callback doing so
+        self.cancel_on_abandon = False
+        self.on_abandoned: Optional[Callable[["Generation"], None]] = None
+        self.subscribers = 0
+        self._events: Deque[Dict[str, str]] = deque(maxlen=buffer_size)
+        self._next_seq = 0
+        self._done = False
+        self._published = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def event_id(self, seq: int) -> str:
+        return f"{self.id}:{seq}"
+
+    def publish(self, event: Any) -> None:
+        """Numbers the event and appends it to the buffer, waking up the subscribers."""
+        if not isinstance(event, dict):
+            event = {"data": event}
+        self._events.append({**event, "id": self.event_id(self._next_seq)})
+        self._next_seq += 1
+        self._wake_up()
+
+    def finish(self) -> None:
+        self._done = True
+        self._wake_up()
+
+    def _wake_up(self) -> None:
+        published, self._published = self._published, asyncio.Event()
+        published.set()
+
+    async def subscribe(self, last_seq: Optional[int] = None) -> AsyncIterator[Dict[str, str]]:
+        """Yields the events published after `last_seq` (all of them if None), until the generation is done."""
+        next_seq = 0 if last_seq is None else last_seq + 1
+        self.subscribers += 1
+        try:
+            async for event in self._events_from(next_seq):
+                yield event
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self._done and self.on_abandoned:
+                self.on_abandoned(self)
+
+    async def _events_from(self, next_seq: int) -> AsyncIterator[Dict[str, str]]:
+        while True:
+            published = self._published
+            first_buffered = self._next_seq - len(self._events)
+            if next_seq < first_buffered:
+                if self.stream_mode == schema.StreamModeEnum.DELTA and self.snapshot is not None:
+                    # the missed deltas are gone, send the current state of the message instead
+                    yield {
+                        "event": MESSAGE_EVENT,
+                        "data": self.snapshot(),
+                        "id": self.event_id(self._next_seq - 1),
+                    }
+                    next_seq = self._next_seq
+                else:
+                    # every FULL event carries the whole message, the buffered ones are enough
+                    next_seq = first_buffered
+
+            for event in list(self._events)[next_seq - first_buffered :]:
+                yield event
+                next_seq += 1
+
+            if next_seq >= self._next_seq:
+                if self._done:
+                    return
+                await published.wait()
+
+
+def parse_event_id(event_id: Optional[str]) -> Optional[Tuple[str, int]]:
+    """Returns the generation id and the sequence number of an event id, None if it is not one."""
+    if not event_id or ":" not in event_id:
+        return None
+    generation_id, seq = event_id.rsplit(":", 1)
+    if not seq.isdigit():
+        return None
+    return generation_id, int(seq)
+
+
+class GenerationRegistry:
+    """
+    Runs the generations of the worker in background tasks and keeps them for a while once they are done.
+    """
+
+    def __init__(
+        self,
+        buffer_size: int,
+        retention: float,
+        max_running: int,
+        abandon_grace: float,
+    ):
+        self._buffer_size = buffer_size
+        self._retention = retention
+        self._max_running = max_running
+        self._abandon_grace = abandon_grace
+        self._running: Optional[asyncio.Semaphore] = None
+        # generations waiting for a slot, and holding one
+        self.waiting = 0
+        self.running = 0
+        self.cancelled = 0
+        self.abandoned = 0
+        # seconds the cancelled generations had run before being cancelled: work spent on answers nobody received
+        self.cancelled_run_time = 0.0
+        # generation (assistant message) id -> generation
+        self._generations: Dict[str, Generation] = {}
+
+    def start(
+        self,
+        generation_id: str,
+        conversation_id: str,
+        stream_mode: schema.StreamModeEnum,
+        events: Callable[[Generation], AsyncIterator[Any]],
+        cancel_on_abandon: bool = False,
+    ) -> Generation:
+        """
+        Starts publishing the events produced by `events(generation)` to a new generation.
+        With `cancel_on_abandon`, the generation is cancelled when it has had no subscriber for the grace period.
+        """
+        generation = Generation(
+            generation_id, conversation_id, stream_mode, self._buffer_size
+        )
+        generation.cancel_on_abandon = cancel_on_abandon and self._abandon_grace >= 0
+        generation.on_abandoned = self._on_abandoned
+        self._generations[generation_id] = generation
+        generation.task = asyncio.create_task(self._run(generation, events(generation)))
+        return generation
+
+    async def _run(self, generation: Generation, events: AsyncIterator[Any]) -> None:
+        if self._running is None:
+            self._running = asyncio.Semaphore(self._max_running)
+        try:
+            # the generations beyond the limit wait for a slot, their subscribers get the events once it starts
+            self.waiting += 1
+            try:
+                await self._running.acquire()
+            finally:
+                self.waiting -= 1
+            self.running += 1
+            generation.started_at = time.monotonic()
+            try:
+                async for event in events:
+                    generation.publish(event)
+            finally:
+                self.running -= 1
+                self._running.release()
+        except Exception:
+            logger.error("Generation %s failed", generation.id, exc_info=True)
+        finally:
+            generation.finish()
+            asyncio.get_running_loop().call_later(
+                self._retention, self._forget, generation
+            )
+
+    def _on_abandoned(self, generation: Generation) -> None:
+        if generation.cancel_on_abandon:
+            asyncio.get_running_loop().call_later(
+                self._abandon_grace, self._cancel_if_abandoned, generation
+            )
+
+    def _cancel_if_abandoned(self, generation: Generation) -> None:
+        if generation.subscribers == 0 and self.cancel(generation):
+            self.abandoned += 1
+            logger.info("Cancelled abandoned generation %s", generation.id)
+
+    def cancel(self, generation: Generation) -> bool:
+        """Cancels the generation if it is still running. Returns whether it was."""
+        if generation.done or generation.task is None or generation.task.done():
+            return False
+        generation.task.cancel()
+        self.cancelled += 1
+        if generation.started_at is not None:
+            self.cancelled_run_time += time.monotonic() - generation.started_at
+        return True
+
+    def _forget(self, generation: Generation) -> None:
+        if self._generations.get(generation.id) is generation:
+            del self._generations[generation.id]
+
+    def get(self, generation_id: str) -> Optional[Generation]:
+        return self._generations.get(generation_id)
+
+    def resolve(self, last_event_id: Optional[str]) -> Optional[Tuple[Generation, int]]:
+        """Returns the generation of a Last-Event-ID along with the sequence number it designates, if it is known."""
+        parsed = parse_event_id(last_event_id)
+        if parsed is None or parsed[0] not in self._generations:
+            return None
+        return self._generations[parsed[0]], parsed[1]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "generations": len(self._generations),
+            "running": self.running,
+            "waiting": self.waiting,
+            "max_running": self._max_running,
+            "cancelled": self.cancelled,
+            "abandoned": self.abandoned,
+            "cancelled_run_seconds": self.cancelled_run_time,
+        }
+
+
+generation_registry = GenerationRegistry(
+    buffer_size=settings.STREAM_REPLAY_BUFFER_SIZE,
+    retention=settings.STREAM_RETENTION_SECONDS,
+    max_running=settings.GENERATION_MAX_RUNNING,
+    abandon_grace=settings.GENERATION_ABANDON_GRACE_SECONDS,
+)
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 import sys
@@ -16,9 +17,10 @@ from sqlalchemy.engine import Engine
 from starlette.middleware.cors import CORSMiddleware
 
 from api.api import api_router
-from chat.engine import init_openai, init_anthropic
+from chat.engine import init_openai, init_anthropic, query_engine_registry
 from core.config import settings
 from libs.db.session import non_async_engine, close_db_connection
+from libs.db.sql_executor import sql_executor
 from libs.db.wait_for_db import check_database_connection
 from loader_io import loader_io_router
 
@@ -72,8 +74,12 @@ async def lifespan(app: FastAPI):
 
     # Some setup is required to initialize the llama-index sentence splitter
     split_by_sentence_tokenizer()
+    # Build the query engines in the background so the worker can bind its port right away
+    warmup_task = asyncio.create_task(query_engine_registry.warmup())
     yield
-    # Shutdown - cleanup connections
+    # Shutdown - stop warming up and cleanup connections
+    warmup_task.cancel()
+    sql_executor.shutdown()
     await close_db_connection()
 
 
@@ -0,0 +1,168 @@
+"""
+Benchmark of the serialization of conversations, comparing the validating path the endpoints used to take
+(`model_validate` on ORM `__dict__` copies, then `model_dump_json`) with the one of `api.serialization`
+(`model_construct` from the rows, then pydantic-core `to_json`).
+
+The conversation is made of transient ORM rows, so no database is needed:
+
+    python -m benchmarks.serialization --messages 500 --sub-processes 6 --repeat 20
+"""
+
+import argparse
+import datetime
+import time
+import uuid
+from typing import Callable, List
+
+import schema
+from api.serialization import (
+    construct_conversation,
+    construct_message,
+    dump_json,
+    message_to_dict,
+)
+from libs.models.chatdb import (
+    Conversation,
+    Message,
+    MessageRoleEnum,
+    MessageStatusEnum,
+    MessageSubProcess,
+    MessageSubProcessSourceEnum,
+    MessageSubProcessStatusEnum,
+)
+
+
+def build_conversation(num_messages: int, num_sub_processes: int) -> Conversation:
+    now = datetime.datetime.utcnow()
+    conversation = Conversation(id=uuid.uuid4(), created_at=now, updated_at=now)
+    messages: List[Message] = []
+    for idx in range(num_messages):
+        message_id = uuid.uuid4()
+        is_assistant = idx % 2 == 1
+        messages.append(
+            Message(
+                id=message_id,
+                created_at=now + datetime.timedelta(seconds=idx),
+                updated_at=now + datetime.timedelta(seconds=idx),
+                conversation_id=conversation.id,
+                content=("The total amount withdrawn by the client this month is 42. " * 20)
+                if is_assistant
+                else "How many clients made a withdrawal this month?",
+                role=MessageRoleEnum.assistant if is_assistant else MessageRoleEnum.user,
+                temperature=0.1,
+                status=MessageStatusEnum.SUCCESS,
+                sub_processes=[
+                    MessageSubProcess(
+                        id=uuid.uuid4(),
+                        created_at=now,
+                        updated_at=now,
+                        message_id=message_id,
+                        source=MessageSubProcessSourceEnum.SUB_QUESTION,
+                        status=MessageSubProcessStatusEnum.FINISHED,
+                        metadata_map={
+                            "sub_question": {
+                                "question": "How many withdrawals were made this month?",
+                                "answer": "There were 1234 withdrawals this month.",
+                            }
+                        },
+                    )
+                    for _ in range(num_sub_processes if is_assistant else 0)
+                ],
+            )
+        )
+    conversation.messages = messages
+    return conversation
+
+
+def validating_path(conversation: Conversation) -> bytes:
+    messages = [
+        schema.Message.model_validate(
+            {
+                **msg.__dict__,
+                "sub_processes": [
+                    schema.MessageSubProcess.model_validate(sp.__dict__)
+                    for sp in msg.sub_processes
+                ],
+            }
+        )
+        for msg in conversation.messages
+    ]
+    return schema.Conversation.model_validate(
+        {**conversation.__dict__, "messages": messages, "documents": []}
+    ).model_dump_json().encode()
+
+
+def constructing_path(conversation: Conversation) -> bytes:
+    return dump_json(
+        construct_conversation(
+            conversation,
+            messages=[construct_message(msg) for msg in conversation.messages],
+            documents=[],
+        )
+    )
+
+
+def streamed_message_validating(message: Message) -> bytes:
+    return schema.Message.model_validate(
+        {
+            **message.__dict__,
+            "sub_processes": [
+                schema.MessageSubProcess.model_validate(sp.__dict__)
+                for sp in message.sub_processes
+            ],
+        }
+    ).model_dump_json().encode()
+
+
+def streamed_message_dumping(message: Message) -> bytes:
+    return dump_json(message_to_dict(message))
+
+
+def measure(name: str, fn: Callable[[], bytes], repeat: int, unit: str) -> float:
+    fn()  # warm up
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        size = len(fn())
+    elapsed = (time.perf_counter() - started_at) / repeat
+    print(f"{name:<32} {elapsed * 1000:9.2f} ms/{unit}  {1 / elapsed:9.1f} {unit}/s  {size} bytes")
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--sub-processes", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    conversation = build_conversation(args.messages, args.sub_processes)
+    print(
+        f"Conversation of {args.messages} messages, {args.sub_processes} sub processes per answer"
+    )
+    before = measure(
+        "validate + model_dump_json", lambda: validating_path(conversation), args.repeat, "conv"
+    )
+    after = measure(
+        "construct + to_json", lambda: constructing_path(conversation), args.repeat, "conv"
+    )
+    print(f"speedup: {before / after:.1f}x\n")
+
+    message = conversation.messages[-1]
+    print("Streamed message (one SSE event)")
+    before = measure(
+        "validate + model_dump_json",
+        lambda: streamed_message_validating(message),
+        args.repeat * 100,
+        "event",
+    )
+    after = measure(
+        "to_json of row values",
+        lambda: streamed_message_dumping(message),
+        args.repeat * 100,
+        "event",
+    )
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Semantic answer cache placed in front of the chat workflow.
+
+Questions are embedded with the configured embedding model and compared by cosine similarity with the questions
+answered previously, in any conversation. When a cached question is similar enough and the data tables have not
+changed since it was answered, its answer is streamed back without running the workflow. Only questions asked
+without prior chat history are cached, since the answer to a follow-up depends on its conversation.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from llama_index.core.settings import Settings
+
+from chat.custom_sql_query_engine import table_version_tracker
+from chat.utils import normalize_question
+from core.config import settings
+from libs.db.table_versions import TableVersions
+
+logger = logging.getLogger(__name__)
+
+
+class AnswerCacheQuery:
+    """The embedding of a question along with the data version it is asked against."""
+
+    def __init__(self, question: str, embedding: np.ndarray, versions: TableVersions):
+        self.question = question
+        self.embedding = embedding
+        self.versions = versions
+
+
+class CachedAnswer:
+    def __init__(self, query: AnswerCacheQuery, answer: str, expires_at: float):
+        self.query = query
+        self.answer = answer
+        self.expires_at = expires_at
+
+
+class SemanticAnswerCache:
+    """
+    LRU cache of answers, looked up by the cosine similarity of the question embeddings.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, similarity_threshold: float):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._similarity_threshold = similarity_threshold
+        # normalized question -> cached answer
+        self._entries: "OrderedDict[str, CachedAnswer]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._maxsize > 0
+
+    async def aprepare(self, question: str) -> Optional[AnswerCacheQuery]:
+        """Embeds the question and reads the current data version. Returns None if either fails."""
+        try:
+            embedding = await Settings.embed_model.aget_query_embedding(question)
+            versions = await table_version_tracker.aget_versions()
+        except Exception:
+            logger.warning("Could not prepare answer cache lookup", exc_info=True)
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return AnswerCacheQuery(question, vector / norm if norm else vector, versions)
+
+    def _evict_stale(self, query: AnswerCacheQuery) -> List[CachedAnswer]:
+        now = time.monotonic()
+        for key in [
+            key
+            for key, entry in self._entries.items()
+            if entry.expires_at < now or entry.query.versions != query.versions
+        ]:
+            del self._entries[key]
+        return list(self._entries.values())
+
+    def get(self, query: AnswerCacheQuery) -> Optional[str]:
+        """Returns the answer of the most similar cached question above the threshold, if any."""
+        entries = self._evict_stale(query)
+        if not entries:
+            self.misses += 1
+            return None
+
+        embeddings = np.stack([entry.query.embedding for entry in entries])
+        similarities = embeddings @ query.embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self._similarity_threshold:
+            self.misses += 1
+            return None
+
+        entry = entries[best]
+        self._entries.move_to_end(normalize_question(entry.query.question))
+        self.hits += 1
+        logger.info(
+            "Answer cache hit (similarity %.3f) for question: %s",
+            similarities[best],
+            entry.query.question,
+        )
+        return entry.answer
+
+    def set(self, query: AnswerCacheQuery, answer: str) -> None:
+        """Caches the answer of the question."""
+        if not self.enabled:
+            return
+        key = normalize_question(query.question)
+        self._entries[key] = CachedAnswer(query, answer, time.monotonic() + self._ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the counters of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self._maxsize,
+            "ttl": self._ttl,
+            "similarity_threshold": self._similarity_threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+answer_cache = SemanticAnswerCache(
+    maxsize=settings.ANSWER_CACHE_SIZE,
+    ttl=settings.ANSWER_CACHE_TTL,
+    similarity_threshold=settings.ANSWER_CACHE_SIMILARITY_THRESHOLD,
+)
@@ -0,0 +1,96 @@
+"""
+Request-scoped routing of LlamaIndex callback events.
+
+The query engine tool graph is built once per worker and shared by every chat turn, so the callback
+handler of a chat turn cannot be baked into the objects themselves. Instead the shared objects are
+wired to a single `RequestCallbackHandler`, which forwards each event to the handler bound to the
+current request through a context variable. Asyncio tasks copy the context they were created in,
+so the sub-question tasks and workflow steps spawned by a chat turn keep reporting to its handler.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.callbacks.schema import CBEventType
+
+current_callback_handler: ContextVar[Optional[BaseCallbackHandler]] = ContextVar(
+    "current_callback_handler", default=None
+)
+
+
+@contextmanager
+def bind_callback_handler(callback_handler: BaseCallbackHandler) -> Iterator[None]:
+    """
+    Routes the callback events emitted in the current context (and in the tasks created from it)
+    to the given handler.
+    """
+    token = current_callback_handler.set(callback_handler)
+    try:
+        yield
+    finally:
+        current_callback_handler.reset(token)
+
+
+class RequestCallbackHandler(BaseCallbackHandler):
+    """
+    Forwards callback events to the handler bound to the current request, if any.
+
+    Ignored event types are resolved against the bound handler, since this handler is shared by all
+    requests and does not ignore anything itself.
+    """
+
+    def __init__(self) -> None:
+        super().__init__([], [])
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        callback_handler = current_callback_handler.get()
+        if (
+            callback_handler is not None
+            and event_type not in callback_handler.event_starts_to_ignore
+        ):
+            callback_handler.on_event_start(
+                event_type, payload, event_id=event_id, parent_id=parent_id, **kwargs
+            )
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        callback_handler = current_callback_handler.get()
+        if (
+            callback_handler is not None
+            and event_type not in callback_handler.event_ends_to_ignore
+        ):
+            callback_handler.on_event_end(event_type, payload, event_id=event_id, **kwargs)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        callback_handler = current_callback_handler.get()
+        if callback_handler is not None:
+            callback_handler.start_trace(trace_id)
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        callback_handler = current_callback_handler.get()
+        if callback_handler is not None:
+            callback_handler.end_trace(trace_id, trace_map)
+
+
+# Shared by every object of the prebuilt tool graph
+request_callback_manager = CallbackManager([RequestCallbackHandler()])
@@ -0,0 +1,265 @@
+"""
+Checkpoints of the concierge workflow Context, so that a workflow interrupted on one worker can be resumed on any other.
+
+After every step, the context of the workflow (its state, queued events and in-progress steps) is serialized and
+saved under the id of the assistant message it generates, either in Postgres or in a local directory shared by the
+workers. The runtime objects of the context, the LLM and the agent configs with their tools, are never serialized
+(they hold clients and credentials): they are replaced by placeholders, which are resolved again to the objects of
+the worker when the context is restored. The checkpoint is deleted once the workflow has finished.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+
+from llama_index.core.llms import LLM
+from llama_index.core.tools import BaseTool
+from llama_index.core.workflow import Context, Event, Workflow
+from llama_index.core.workflow.context_serializers import JsonSerializer
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+
+from chat.workflow import AgentConfig
+from core.config import settings
+from libs.db.session import get_async_session
+from libs.models.chatdb import WorkflowCheckpoint
+
+logger = logging.getLogger(__name__)
+
+# Placeholder of a runtime object in a serialized context
+RUNTIME_OBJECT_KEY = "__runtime_object__"
+
+
+class WorkflowContextSerializer(JsonSerializer):
+    """
+    Serializes a workflow context to JSON, replacing its runtime objects (LLMs, agent configs and tools) by
+    placeholders. When deserializing, the placeholders are resolved to the given LLM and agent configs.
+    """
+
+    def __init__(
+        self,
+        llm: Optional[LLM] = None,
+        agent_configs: Optional[Dict[str, AgentConfig]] = None,
+    ):
+        self._llm = llm
+        self._agent_configs = agent_configs or {}
+
+    def _serialize_value(self, value: Any) -> Any:
+        # checked before the BaseComponent and BaseModel handling of JsonSerializer, which would dump them
+        if isinstance(value, LLM):
+            return {RUNTIME_OBJECT_KEY: "llm"}
+        if isinstance(value, AgentConfig):
+            return {RUNTIME_OBJECT_KEY: "agent_config", "name": value.name}
+        if isinstance(value, BaseTool):
+            return {RUNTIME_OBJECT_KEY: "tool", "name": value.metadata.get_name()}
+        return super()._serialize_value(value)
+
+    def _deserialize_value(self, data: Any) -> Any:
+        if isinstance(data, dict) and RUNTIME_OBJECT_KEY in data:
+            return self._resolve(data)
+        return super()._deserialize_value(data)
+
+    def _resolve(self, placeholder: Dict[str, Any]) -> Any:
+        kind = placeholder[RUNTIME_OBJECT_KEY]
+        if kind == "llm":
+            return self._llm
+        if kind == "agent_config" and placeholder["name"] in self._agent_configs:
+            return self._agent_configs[placeholder["name"]]
+        if kind == "tool":
+            for agent_config in self._agent_configs.values():
+                for tool in agent_config.tools or []:
+                    if tool.metadata.get_name() == placeholder["name"]:
+                        return tool
+        raise ValueError(f"Cannot resolve runtime object {placeholder}")
+
+
+class WorkflowCheckpointStore(ABC):
+    """Saves and loads the serialized contexts of workflows, by the id of the message they generate."""
+
+    @abstractmethod
+    async def asave(self, message_id: str, state: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    async def aload(self, message_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def adelete(self, message_id: str) -> None:
+        ...
+
+
+class PostgresCheckpointStore(WorkflowCheckpointStore):
+    """Stores the checkpoints in the WorkflowCheckpoint table, one row per message."""
+
+    async def asave(self, message_id: str, state: Dict[str, Any]) -> None:
+        stmt = insert(WorkflowCheckpoint).values(message_id=message_id, state=state)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[WorkflowCheckpoint.message_id],
+            set_={"state": stmt.excluded.state, "updated_at": stmt.excluded.updated_at},
+        )
+        async with get_async_session() as db:
+            await db.execute(stmt)
+
+    async def aload(self, message_id: str) -> Optional[Dict[str, Any]]:
+        async with get_async_session() as db:
+            result = await db.execute(
+                select(WorkflowCheckpoint.state).where(
+                    WorkflowCheckpoint.message_id == message_id
+                )
+            )
+            return result.scalar_one_or_none()
+
+    async def adelete(self, message_id: str) -> None:
+        async with get_async_session() as db:
+            await db.execute(
+                delete(WorkflowCheckpoint).where(
+                    WorkflowCheckpoint.message_id == message_id
+                )
+            )
+
+
+class DiskCheckpointStore(WorkflowCheckpointStore):
+    """Stores the checkpoints as JSON files in a directory, which must be shared by the workers to resume elsewhere."""
+
+    def __init__(self, directory: str):
+        self._directory = directory
+
+    def _path(self, message_id: str) -> str:
+        return os.path.join(self._directory, f"{message_id}.json")
+
+    def _save(self, message_id: str, state: Dict[str, Any]) -> None:
+        os.makedirs(self._directory, exist_ok=True)
+        path = self._path(message_id)
+        # never leave a partially written checkpoint behind
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _load(self, message_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(message_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _delete(self, message_id: str) -> None:
+        try:
+            os.remove(self._path(message_id))
+        except FileNotFoundError:
+            pass
+
+    async def asave(self, message_id: str, state: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self._save, message_id, state)
+
+    async def aload(self, message_id: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._load, message_id)
+
+    async def adelete(self, message_id: str) -> None:
+        await asyncio.to_thread(self._delete, message_id)
+
+
+class WorkflowCheckpointer:
+    """
+    Checkpoints the contexts of the workflows at their step boundaries and restores them. Does nothing when the
+    checkpoints are disabled.
+    """
+
+    def __init__(self, store: Optional[WorkflowCheckpointStore]):
+        self._store = store
+        self._serializer = WorkflowContextSerializer()
+        self.saved = 0
+        self.restored = 0
+        self.failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._store is not None
+
+    def checkpoint_callback(self, message_id: str):
+        """Returns the callback of `Workflow.run` saving the context of the workflow after each of its steps."""
+
+        async def save(
+            run_id: str,
+            last_completed_step: Optional[str],
+            input_ev: Optional[Event],
+            output_ev: Optional[Event],
+            ctx: Context,
+        ) -> None:
+            try:
+                state = ctx.to_dict(serializer=self._serializer)
+                await self._store.asave(message_id, state)  # type: ignore
+                self.saved += 1
+            except Exception:
+                # the workflow goes on, it only cannot be resumed from this step
+                self.failed += 1
+                logger.warning(
+                    "Failed to checkpoint workflow of message %s after step %s",
+                    message_id,
+                    last_completed_step,
+                    exc_info=True,
+                )
+
+        return save
+
+    async def arestore(
+        self,
+        workflow: Workflow,
+        message_id: str,
+        agent_configs: Dict[str, AgentConfig],
+        llm: LLM,
+    ) -> Optional[Context]:
+        """Returns the checkpointed context of the workflow generating the message, if any."""
+        if self._store is None:
+            return None
+        state = await self._store.aload(message_id)
+        if state is None:
+            return None
+        ctx = Context.from_dict(
+            workflow,
+            state,
+            serializer=WorkflowContextSerializer(llm=llm, agent_configs=agent_configs),
+        )
+        self.restored += 1
+        logger.info("Resuming workflow of message %s from its checkpoint", message_id)
+        return ctx
+
+    async def ahas_checkpoint(self, message_id: str) -> bool:
+        if self._store is None:
+            return False
+        return await self._store.aload(message_id) is not None
+
+    async def adiscard(self, message_id: str) -> None:
+        """Deletes the checkpoint of a finished workflow."""
+        if self._store is None:
+            return
+        try:
+            await self._store.adelete(message_id)
+        except Exception:
+            logger.warning(
+                "Failed to delete workflow checkpoint of message %s",
+                message_id,
+                exc_info=True,
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "store": type(self._store).__name__ if self._store else None,
+            "saved": self.saved,
+            "restored": self.restored,
+            "failed": self.failed,
+        }
+
+
+def get_checkpoint_store() -> Optional[WorkflowCheckpointStore]:
+    if settings.WORKFLOW_CHECKPOINT_STORE == "postgres":
+        return PostgresCheckpointStore()
+    if settings.WORKFLOW_CHECKPOINT_STORE == "disk":
+        return DiskCheckpointStore(settings.WORKFLOW_CHECKPOINT_DIR)
+    return None
+
+
+workflow_checkpointer = WorkflowCheckpointer(get_checkpoint_store())
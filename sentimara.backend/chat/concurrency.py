@@ -0,0 +1,225 @@
+"""
+This module bounds how much work the chat requests of a worker start at the same time.
+
+Without limits, every tool call of every request runs right away, and every sub question of a tool call with it, so a
+few simultaneous users exhaust the database pool and trip the rate limits of the LLM providers, and then all time out
+together. The governor hands out slots instead, in a fixed order so that nested slots cannot deadlock:
+
+- tool calls take a slot of their tool, then one of the worker-wide cap on tool calls;
+- sub questions take a slot of the worker-wide limit on sub questions;
+- requests to the API of an LLM provider take a slot of the provider, until their response is closed.
+
+The provider slots are taken by the HTTP clients of the models (`http_client`), so every call to the provider is
+bounded: the agents, the text-to-SQL generation, the sub question generation, the response synthesis and the
+embeddings alike.
+
+Work beyond the limits waits for a slot, so the throughput degrades gradually under load. The waiting is measured
+and reported by `stats`.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+import httpx
+
+from core.config import settings
+
+
+def parse_limits(limits: str) -> Dict[str, int]:
+    """Parses limits given as "name=limit,other=limit"."""
+    parsed = {}
+    for item in limits.split(","):
+        name, _, limit = item.partition("=")
+        if name.strip() and limit.strip():
+            parsed[name.strip()] = int(limit)
+    return parsed
+
+
+class Limiter:
+    """A semaphore that measures its queue. A limit of 0 or less does not limit anything, but is still measured."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+        self.in_use = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.acquired = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def acquire(self) -> None:
+        if self._semaphore is not None:
+            started_at = time.monotonic()
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+            wait_seconds = time.monotonic() - started_at
+            self.total_wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+        self.acquired += 1
+        self.in_use += 1
+
+    def release(self) -> None:
+        self.in_use -= 1
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "acquired": self.acquired,
+            "avg_wait_seconds": (
+                self.total_wait_seconds / self.acquired if self.acquired else 0.0
+            ),
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+class _SlotReleasingStream(httpx.AsyncByteStream):
+    """The body of a response, releasing the slot of its request once closed."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, limiter: Limiter):
+        self._stream = stream
+        self._limiter = limiter
+        self._released = False
+
+    def _release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._limiter.release()
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+        self._release()
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release()
+
+
+class LimitedTransport(httpx.AsyncBaseTransport):
+    """HTTP transport holding a slot of the limiter for each request, until its response is closed."""
+
+    def __init__(self, limiter: Limiter, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self._limiter = limiter
+        self._transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self._limiter.acquire()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self._limiter.release()
+            raise
+        if isinstance(response.stream, httpx.ByteStream):
+            # The body is already in memory, nothing is left to wait for.
+            self._limiter.release()
+        else:
+            response.stream = _SlotReleasingStream(response.stream, self._limiter)  # type: ignore
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class ConcurrencyGovernor:
+    """
+    The limiters of the worker. The limiters of tools and providers are created on first use, with their limit in
+    the overrides or the default one.
+    """
+
+    def __init__(
+        self,
+        max_tool_calls: int,
+        tool_limit: int,
+        provider_limit: int,
+        sub_question_limit: int,
+        tool_limits: Optional[Dict[str, int]] = None,
+        provider_limits: Optional[Dict[str, int]] = None,
+    ):
+        self._tool_calls = Limiter(max_tool_calls)
+        self._sub_questions = Limiter(sub_question_limit)
+        self._tool_limit = tool_limit
+        self._provider_limit = provider_limit
+        self._tool_limits = tool_limits or {}
+        self._provider_limits = provider_limits or {}
+        self._tools: Dict[str, Limiter] = {}
+        self._providers: Dict[str, Limiter] = {}
+        self._http_clients: Dict[str, httpx.AsyncClient] = {}
+
+    def _tool(self, tool_name: str) -> Limiter:
+        if tool_name not in self._tools:
+            self._tools[tool_name] = Limiter(
+                self._tool_limits.get(tool_name, self._tool_limit)
+            )
+        return self._tools[tool_name]
+
+    def _provider(self, provider: str) -> Limiter:
+        if provider not in self._providers:
+            self._providers[provider] = Limiter(
+                self._provider_limits.get(provider, self._provider_limit)
+            )
+        return self._providers[provider]
+
+    @asynccontextmanager
+    async def tool_call(self, tool_name: str) -> AsyncIterator[None]:
+        """Holds a slot of the tool and of the worker-wide cap on tool calls."""
+        async with self._tool(tool_name).slot():
+            async with self._tool_calls.slot():
+                yield
+
+    def sub_question(self):
+        """Holds a slot of the worker-wide limit on sub questions."""
+        return self._sub_questions.slot()
+
+    def http_client(self, provider: str) -> httpx.AsyncClient:
+        """
+        Returns the async HTTP client to give to the models calling the API of the provider: each of its requests
+        holds a slot of the provider until its response is closed.
+        """
+        if provider not in self._http_clients:
+            self._http_clients[provider] = httpx.AsyncClient(
+                transport=LimitedTransport(self._provider(provider)),
+                timeout=None,
+            )
+        return self._http_clients[provider]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tool_calls": self._tool_calls.stats(),
+            "sub_questions": self._sub_questions.stats(),
+            "tools": {name: limiter.stats() for name, limiter in self._tools.items()},
+            "providers": {
+                name: limiter.stats() for name, limiter in self._providers.items()
+            },
+        }
+
+
+concurrency_governor = ConcurrencyGovernor(
+    max_tool_calls=settings.CONCURRENCY_MAX_TOOL_CALLS,
+    tool_limit=settings.CONCURRENCY_TOOL_LIMIT,
+    provider_limit=settings.CONCURRENCY_PROVIDER_LIMIT,
+    sub_question_limit=settings.CONCURRENCY_SUB_QUESTION_LIMIT,
+    tool_limits=parse_limits(settings.CONCURRENCY_TOOL_LIMITS),
+    provider_limits=parse_limits(settings.CONCURRENCY_PROVIDER_LIMITS),
+)
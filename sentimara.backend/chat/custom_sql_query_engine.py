@@ -0,0 +1,281 @@
+import asyncio
+import hashlib
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from llama_index.core.callbacks.base import CallbackManager
+from llama_index.core.indices.struct_store.sql_query import SQLTableRetrieverQueryEngine
+from llama_index.core.indices.struct_store.sql_retriever import (
+  NLSQLRetriever,
+  SQLRetriever,
+)
+from llama_index.core.llms.llm import LLM
+from llama_index.core.objects import ObjectRetriever, SQLTableSchema
+from llama_index.core.prompts import BasePromptTemplate
+from llama_index.core.schema import NodeWithScore, QueryBundle, QueryType, TextNode
+from llama_index.core.utilities.sql_wrapper import SQLDatabase
+
+from chat.utils import normalize_question, tables_list
+from core.config import settings
+from libs.db.sql_executor import sql_executor, sql_executor_engine
+from libs.db.table_versions import TableVersionTracker
+from libs.helpers.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# (normalized question, table group, schema/prompt version) -> generated SQL
+text_to_sql_cache: TTLCache[str] = TTLCache(
+    maxsize=settings.TEXT_TO_SQL_CACHE_SIZE, ttl=settings.TEXT_TO_SQL_CACHE_TTL
+)
+
+# (canonical SQL, table versions) -> (retrieved nodes, metadata)
+sql_result_cache: TTLCache[Tuple[List[NodeWithScore], Dict]] = TTLCache(
+    maxsize=settings.SQL_RESULT_CACHE_SIZE, ttl=settings.SQL_RESULT_CACHE_TTL
+)
+
+table_version_tracker = TableVersionTracker(
+    sql_executor_engine,
+    tables_list,
+    refresh_interval=settings.SQL_RESULT_CACHE_VERSION_INTERVAL,
+)
+
+
+# Statements that may change the data tables; a false positive only bypasses the SQL result cache
+_WRITE_SQL_RE = re.compile(
+    r"\b(insert|update|delete|merge|truncate|alter|drop|create|copy|call)\b", re.IGNORECASE
+)
+
+
+def is_write_sql(sql_query_str: str) -> bool:
+    """Whether a SQL query may write to the database."""
+    return _WRITE_SQL_RE.search(sql_query_str) is not None
+
+
+def canonicalize_sql(sql_query_str: str) -> str:
+    """
+    Strips the surrounding whitespace and trailing semicolon of a SQL query.
+
+    Inner whitespace is kept as is, since it may be part of a string literal.
+    """
+    return sql_query_str.strip().rstrip(";").rstrip()
+
+
+class CustomSQLRetriever(SQLRetriever):
+    """SQL retriever that runs its queries on the dedicated SQL executor.
+
+    The stock retriever runs the SQL synchronously, i.e. on the event loop thread when
+    called from an async query engine. Results of up to SQL_RESULT_CACHE_MAX_ROWS rows are
+    cached by canonical SQL text and the version watermark of the data tables, so a change
+    to `clients` or `transactions` invalidates them. Queries that may write are never cached,
+    and make the worker re-read the versions once they ran.
+    """
+
+    async def aretrieve_with_metadata(
+        self, str_or_query_bundle: QueryType
+    ) -> Tuple[List[NodeWithScore], Dict]:
+        if isinstance(str_or_query_bundle, str):
+            query_bundle = QueryBundle(str_or_query_bundle)
+        else:
+            query_bundle = str_or_query_bundle
+
+        if is_write_sql(query_bundle.query_str):
+            try:
+                return await sql_executor.run(self.retrieve_with_metadata, query_bundle)
+            finally:
+                table_version_tracker.expire()
+
+        try:
+            versions = await table_version_tracker.aget_versions()
+        except Exception:
+            logger.warning("Could not read table versions, bypassing SQL result cache", exc_info=True)
+            return await sql_executor.run(self.retrieve_with_metadata, query_bundle)
+
+        cache_key = (canonicalize_sql(query_bundle.query_str), versions)
+        cached = sql_result_cache.get(cache_key)
+        if cached is not None:
+            retrieved_nodes, metadata = cached
+            return list(retrieved_nodes), dict(metadata)
+
+        retrieved_nodes, metadata = await sql_executor.run(
+            self.retrieve_with_metadata, query_bundle
+        )
+        if len(metadata.get("result", [])) <= settings.SQL_RESULT_CACHE_MAX_ROWS:
+            sql_result_cache.set(cache_key, (list(retrieved_nodes), dict(metadata)))
+        return retrieved_nodes, metadata
+
+
+class CustomNLSQLRetriever(NLSQLRetriever):
+    """Text-to-SQL retriever whose async path never executes SQL on the event loop.
+
+    The SQL generated for a question is cached by the normalized question, the table group
+    and a hash of the table schemas and text-to-SQL prompt, so a repeated question skips the
+    table retrieval and the LLM round-trip. Only SQL that executed successfully is cached.
+
+    The table schemas are reflected once, at construction, and the tables of a question are
+    retrieved with the async embedding path, so building the table context does not block
+    the event loop either.
+
+    Args:
+        Same as NLSQLRetriever.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        table_retriever: Optional[ObjectRetriever[SQLTableSchema]] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, table_retriever=table_retriever, **kwargs)
+        self._table_retriever = table_retriever
+        self._sql_retriever = CustomSQLRetriever(
+            self._sql_database,
+            return_raw=self._sql_retriever._return_raw,
+            callback_manager=self.callback_manager,
+        )
+        table_names = sorted(self._sql_database.get_usable_table_names())
+        self._table_group = ",".join(table_names)
+        # table name -> reflected schema of the table
+        self._table_infos: Dict[str, str] = {
+            table_name: self._sql_database.get_single_table_info(table_name)
+            for table_name in table_names
+        }
+        self._schema_version = self._get_schema_version()
+
+    def _get_schema_version(self) -> str:
+        """Hashes the text-to-SQL prompt and the reflected schema of the table group."""
+        schema_str = "\n".join(self._table_infos.values())
+        payload = f"{self._text_to_sql_prompt.get_template()}\n{schema_str}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _get_cache_key(self, query_bundle: QueryBundle) -> Tuple[str, str, str]:
+        return (
+            normalize_question(query_bundle.query_str),
+            self._table_group,
+            self._schema_version,
+        )
+
+    async def _aget_table_context(self, query_bundle: QueryBundle) -> str:
+        """Async version of `_get_table_context`, describing the tables with their schemas reflected at construction."""
+        if self._rows_retrievers is not None or self._cols_retrievers is not None:
+            # the row and column retrievers are only retrieved from synchronously
+            return await asyncio.to_thread(self._get_table_context, query_bundle)
+
+        if self._table_retriever is not None:
+            table_schema_objs = await self._table_retriever.aretrieve(query_bundle.query_str)
+        else:
+            table_schema_objs = self._get_tables(query_bundle.query_str)
+
+        context_strs = []
+        for table_schema_obj in table_schema_objs:
+            table_info = self._table_infos.get(table_schema_obj.table_name)
+            if table_info is None:
+                table_info = await sql_executor.run(
+                    self._sql_database.get_single_table_info, table_schema_obj.table_name
+                )
+            if table_schema_obj.context_str:
+                table_info += f" The table description is: {table_schema_obj.context_str}"
+            context_strs.append(table_info)
+        return "\n\n".join(context_strs)
+
+    async def _agenerate_sql(self, query_bundle: QueryBundle) -> str:
+        """Translates the question into a SQL query with the LLM."""
+        table_desc_str = await self._aget_table_context(query_bundle)
+        logger.debug("> Table desc str: %s", table_desc_str)
+
+        response_str = await self._llm.apredict(
+            self._text_to_sql_prompt,
+            query_str=query_bundle.query_str,
+            schema=table_desc_str,
+            dialect=self._sql_database.dialect,
+        )
+        return self._sql_parser.parse_response_to_sql(response_str, query_bundle)
+
+    async def aretrieve_with_metadata(
+        self, str_or_query_bundle: QueryType
+    ) -> Tuple[List[NodeWithScore], Dict]:
+        if isinstance(str_or_query_bundle, str):
+            query_bundle = QueryBundle(str_or_query_bundle)
+        else:
+            query_bundle = str_or_query_bundle
+
+        cache_key = self._get_cache_key(query_bundle)
+        sql_query_str = text_to_sql_cache.get(cache_key)
+        from_cache = sql_query_str is not None
+        if from_cache:
+            logger.info("Text-to-SQL cache hit for %s", cache_key[0])
+        else:
+            sql_query_str = await self._agenerate_sql(query_bundle)
+        if self._verbose:
+            print(f"> Predicted SQL query: {sql_query_str}")
+
+        if self._sql_only:
+            sql_only_node = TextNode(text=f"{sql_query_str}")
+            retrieved_nodes = [NodeWithScore(node=sql_only_node)]
+            metadata: Dict[str, Any] = {"result": sql_query_str}
+        else:
+            try:
+                (
+                    retrieved_nodes,
+                    metadata,
+                ) = await self._sql_retriever.aretrieve_with_metadata(sql_query_str)
+                if not from_cache:
+                    text_to_sql_cache.set(cache_key, sql_query_str)
+            except Exception as e:
+                # a cancellation (asyncio.CancelledError) is not an error of the SQL: it propagates as is
+                if from_cache:
+                    text_to_sql_cache.pop(cache_key)
+                # if handle_sql_errors is True, then return error message
+                if self._handle_sql_errors:
+                    err_node = TextNode(text=f"Error: {e!s}")
+                    retrieved_nodes = [NodeWithScore(node=err_node)]
+                    metadata = {}
+                else:
+                    raise
+
+        return retrieved_nodes, {"sql_query": sql_query_str, **metadata}
+
+
+class CustomSQLTableRetrieverQueryEngine(SQLTableRetrieverQueryEngine):
+    """SQL table retriever query engine backed by CustomNLSQLRetriever.
+
+    Args:
+        Same as SQLTableRetrieverQueryEngine.
+    """
+
+    def __init__(
+        self,
+        sql_database: SQLDatabase,
+        table_retriever: ObjectRetriever[SQLTableSchema],
+        llm: Optional[LLM] = None,
+        text_to_sql_prompt: Optional[BasePromptTemplate] = None,
+        context_query_kwargs: Optional[dict] = None,
+        context_str_prefix: Optional[str] = None,
+        sql_only: bool = False,
+        callback_manager: Optional[CallbackManager] = None,
+        verbose: bool = False,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(
+            sql_database=sql_database,
+            table_retriever=table_retriever,
+            llm=llm,
+            text_to_sql_prompt=text_to_sql_prompt,
+            context_query_kwargs=context_query_kwargs,
+            context_str_prefix=context_str_prefix,
+            sql_only=sql_only,
+            callback_manager=callback_manager,
+            verbose=verbose,
+            **kwargs,
+        )
+        self._sql_retriever = CustomNLSQLRetriever(
+            sql_database,
+            llm=llm,
+            text_to_sql_prompt=text_to_sql_prompt,
+            context_query_kwargs=context_query_kwargs,
+            table_retriever=table_retriever,
+            context_str_prefix=context_str_prefix,
+            sql_only=sql_only,
+            callback_manager=callback_manager,
+            verbose=verbose,
+        )
@@ -4,10 +4,11 @@ from typing import Optional, Sequence
 from llama_index.core.callbacks.base import CallbackManager
 from llama_index.core.llms.llm import LLM
 from llama_index.core.query_engine.sub_question_query_engine import (
+  SubQuestionAnswerPair,
   SubQuestionQueryEngine,
 )
 from llama_index.core.question_gen.llm_generators import LLMQuestionGenerator
-from llama_index.core.question_gen.types import BaseQuestionGenerator
+from llama_index.core.question_gen.types import BaseQuestionGenerator, SubQuestion
 from llama_index.core.response_synthesizers import (
   BaseSynthesizer,
   get_response_synthesizer,
@@ -15,6 +16,8 @@ from llama_index.core.response_synthesizers import (
 from llama_index.core.settings import Settings
 from llama_index.core.tools.query_engine import QueryEngineTool
 
+from chat.concurrency import concurrency_governor
+
 logger = logging.getLogger(__name__)
 
 
@@ -36,7 +39,8 @@ class CustomSubQuestionQueryEngine(SubQuestionQueryEngine):
         verbose (bool): whether to print intermediate questions and answers.
             Defaults to True
         use_async (bool): whether to execute the sub questions with asyncio.
-            Defaults to True
+            Defaults to True. The sub questions executed at the same time by the
+            worker are bounded by the concurrency governor.
     """
 
     def __init__(
@@ -109,3 +113,9 @@ class CustomSubQuestionQueryEngine(SubQuestionQueryEngine):
             verbose=verbose,
             use_async=use_async,
         )
+
+    async def _aquery_subq(
+        self, sub_q: SubQuestion, color: Optional[str] = None
+    ) -> Optional[SubQuestionAnswerPair]:
+        async with concurrency_governor.sub_question():
+            return await super()._aquery_subq(sub_q, color=color)
@@ -6,13 +6,14 @@ This module plays a central role in integrating various components like database
 query processing, and chat interface to facilitate effective communication and data retrieval.
 """
 
+import asyncio
 import logging
 import os
+import threading
 from datetime import datetime
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 import nest_asyncio
-import openai
 from dotenv import load_dotenv
 from llama_index.agent.openai import OpenAIAgent
 from llama_index.core import ServiceContext
@@ -24,6 +25,7 @@ from llama_index.core.indices.vector_store import VectorStoreIndex
 from llama_index.core.llms import ChatMessage, MessageRole
 from llama_index.core.node_parser import SimpleNodeParser
 from llama_index.core.objects import ObjectIndex, SQLTableNodeMapping, SQLTableSchema
+from llama_index.core.schema import BaseNode, MetadataMode
 from llama_index.core.settings import Settings
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
 from llama_index.core.utilities.sql_wrapper import SQLDatabase
@@ -31,17 +33,26 @@ from llama_index.llms.openai.base import OpenAI
 from llama_index.question_gen.openai import OpenAIQuestionGenerator
 from llama_index.core.workflow.handler import WorkflowHandler
 from llama_index.llms.openai import OpenAI
+from chat.checkpoints import workflow_checkpointer
+from chat.concurrency import concurrency_governor
+from chat.callbacks import (
+    bind_callback_handler,
+    request_callback_manager,
+)
 from chat.constants import SUB_QUESTION_SYSTEM_PROMPT, SYSTEM_PROMPT
+from chat.custom_sql_query_engine import CustomSQLTableRetrieverQueryEngine
 from chat.custom_sub_question_query_engine import CustomSubQuestionQueryEngine
+from chat.history import build_chat_history, filter_chat_messages, to_chat_message
 from chat.qa_response_synth import get_custom_response_synth
 from chat.core.settings import CustomSettings
+from chat.table_index_cache import table_index_cache
 from chat.utils import table_groups, tables_list
 from core.config import settings
-from libs.db.session import non_async_engine
+from libs.db.sql_executor import sql_executor_engine
 from libs.models.chatdb import MessageRoleEnum, MessageStatusEnum
-from schema import Conversation as ConversationSchema
+from schema import ChatConversation as ConversationSchema
 from schema import Message as MessageSchema
-from schema import QueryEngineInfo
+from schema import QueryEngineInfo, TableInfo
 from libs.models.db import table_context_dict
 from .workflow import (
     AgentConfig,
@@ -54,34 +65,6 @@ logger = logging.getLogger(__name__)
 logger.info("Applying nested asyncio patch")
 nest_asyncio.apply()
 
-def get_conversation_headline(prompt: str):
-    """
-    Generates a concise and informative headline from a given survey question.
-
-    This function utilizes the OpenAI Completion API to create a headline that captures the essence of the input question in a brief and clear manner. It formats the input question into a prompt template and requests a headline generation from the API.
-
-    Parameters:
-    prompt (str): The survey question from which a headline is to be generated.
-
-    Returns:
-    str: A headline derived from the survey question, providing a succinct summary or overview of the question's topic.
-    """
-    prompt_template = f""""
-    Create a concise headline from the given question. The headline should be simple and clearly reflect the essence of the question.
-    
-    For example, if the question is 'How many respondents have participated in this survey?', a suitable headline could be 'Survey Participation Overview'.
-    
-    Question: {prompt}
-    """
-    response = openai.completions.create(
-        model=settings.MODEL,
-        prompt=prompt_template,
-        temperature=0.7,
-    )
-
-    return response.choices[0].text.strip()
-
-
 class QueryEngineData:
     def __init__(self, name: str, query_engine: QueryEngineInfo):
         self._name: str = name
@@ -113,6 +96,9 @@ def init_azure_openai():
     from llama_index.llms.azure_openai import AzureOpenAI
     from llama_index.core import Settings
 
+    # Route the events of every model to the callback handler of the current request
+    Settings.callback_manager = request_callback_manager
+
     # LLM Configuration
     max_tokens = os.getenv("LLM_MAX_TOKENS", 16384)
     llm_config = {
@@ -123,6 +109,7 @@ def init_azure_openai():
         "api_version": settings.AZURE_OPENAI_API_VERSION,
         "temperature": float(os.getenv("LLM_TEMPERATURE", DEFAULT_TEMPERATURE)),
         "max_tokens": int(max_tokens) if max_tokens is not None else 16384,
+        "async_http_client": concurrency_governor.http_client("azure_openai"),
     }
     Settings.llm = AzureOpenAI(**llm_config)
 
@@ -135,6 +122,7 @@ def init_azure_openai():
         "azure_endpoint": settings.AZURE_OPENAI_ENDPOINT,
         "api_version": settings.AZURE_OPENAI_API_VERSION,
         "dimensions": int(dimensions) if dimensions is not None else None,
+        "async_http_client": concurrency_governor.http_client("azure_openai"),
     }
     Settings.embed_model = AzureOpenAIEmbedding(**embed_config)
 
@@ -148,12 +136,16 @@ def init_openai():
     from llama_index.embeddings.openai import OpenAIEmbedding
     from llama_index.llms.openai import OpenAI
 
+    # Route the events of every model to the callback handler of the current request
+    Settings.callback_manager = request_callback_manager
+
     max_tokens = os.getenv("LLM_MAX_TOKENS", 16384)
     config = {
         "model": settings.MODEL,
         "temperature": float(os.getenv("LLM_TEMPERATURE", DEFAULT_TEMPERATURE)),
         "api_key": settings.OPENAI_API_KEY,
         "max_tokens": int(max_tokens) if max_tokens is not None else 16384,
+        "async_http_client": concurrency_governor.http_client("openai"),
     }
     Settings.llm = OpenAI(**config)
 
@@ -161,6 +153,7 @@ def init_openai():
     config = {
         "model": settings.EMBEDDING_MODEL,
         "dimensions": int(dimensions) if dimensions is not None else None,
+        "async_http_client": concurrency_governor.http_client("openai"),
     }
     Settings.embed_model = OpenAIEmbedding(**config)
 
@@ -168,10 +161,14 @@ def init_openai():
     Settings.chunk_overlap = int(os.getenv("CHUNK_OVERLAP", "20"))
 
 def init_anthropic():
+    import anthropic
     from llama_index.core.constants import DEFAULT_TEMPERATURE
     from llama_index.llms.anthropic import Anthropic
     from llama_index.embeddings.openai import OpenAIEmbedding
 
+    # Route the events of every model to the callback handler of the current request
+    Settings.callback_manager = request_callback_manager
+
     max_tokens = os.getenv("LLM_MAX_TOKENS", 16384)
     config = {
         "model": settings.SQL_MODEL,
@@ -179,12 +176,20 @@ def init_anthropic():
         "api_key": settings.ANTHROPIC_API_KEY,
         "max_tokens": int(max_tokens) if max_tokens is not None else 16384,
     }
-    CustomSettings.code_llm = Anthropic(**config)
+    code_llm = Anthropic(**config)
+    # the Anthropic LLM takes no HTTP client: its async client is replaced by one bounded by the governor
+    code_llm._aclient = anthropic.AsyncAnthropic(
+        api_key=settings.ANTHROPIC_API_KEY,
+        max_retries=code_llm.max_retries,
+        http_client=concurrency_governor.http_client("anthropic"),
+    )
+    CustomSettings.code_llm = code_llm
 
     dimensions = settings.EMBEDDING_DIM
     config = {
         "model": settings.EMBEDDING_MODEL,
         "dimensions": int(dimensions) if dimensions is not None else None,
+        "async_http_client": concurrency_governor.http_client("openai"),
     }
     CustomSettings.embed_model = OpenAIEmbedding(**config)
     CustomSettings.chunk_size = int(os.getenv("CHUNK_SIZE", "1024"))
@@ -200,6 +205,8 @@ def table_index_builder(
     This function creates an index of table schemas, which is useful for organizing and accessing
     database information efficiently. It iterates over each table name provided in the table context
     dictionary, constructs a schema object for each table, and then compiles these into an ObjectIndex.
+    Node embeddings are loaded from the on-disk table index cache when available, so only the tables
+    whose context string (or reflected schema) changed are sent to the embedding model.
 
     Parameters:
     sql_database (SQLDatabase): The SQL database instance containing the tables.
@@ -218,10 +225,44 @@ def table_index_builder(
         )
         table_schema_objs.append(table_schema)
 
-    obj_index = ObjectIndex.from_objects(
-        objects=table_schema_objs,
-        object_mapping=table_node_mapping,
-        index_cls=VectorStoreIndex,
+    nodes = table_node_mapping.to_nodes(table_schema_objs)
+
+    # Reuse persisted embeddings and only embed the tables whose node text changed
+    embed_model = Settings.embed_model
+    embed_model_name = getattr(embed_model, "model_name", settings.EMBEDDING_MODEL)
+    embed_dim = getattr(embed_model, "dimensions", None) or settings.EMBEDDING_DIM
+    missing: list[tuple[str, SQLTableSchema, BaseNode]] = []
+    for table_schema, node in zip(table_schema_objs, nodes):
+        cache_key = table_index_cache.build_key(
+            table_name=table_schema.table_name,
+            context_str=table_schema.context_str or "",
+            embed_text=node.get_content(metadata_mode=MetadataMode.EMBED),
+            embed_model_name=embed_model_name,
+            embed_dim=embed_dim,
+        )
+        embedding = table_index_cache.get(cache_key)
+        if embedding is None:
+            missing.append((cache_key, table_schema, node))
+        else:
+            node.embedding = embedding
+
+    if missing:
+        logger.info(
+            "Embedding %d table schema(s): %s",
+            len(missing),
+            ", ".join(table_schema.table_name for _, table_schema, _ in missing),
+        )
+        embeddings = embed_model.get_text_embedding_batch(
+            [node.get_content(metadata_mode=MetadataMode.EMBED) for _, _, node in missing]
+        )
+        for (cache_key, table_schema, node), embedding in zip(missing, embeddings):
+            node.embedding = embedding
+            table_index_cache.put(cache_key, table_schema.table_name, embedding)
+
+    # Nodes that already carry an embedding are not sent to the embedding model again
+    obj_index = ObjectIndex(
+        VectorStoreIndex(nodes=nodes, embed_model=embed_model),
+        table_node_mapping,
     )
 
     return obj_index
@@ -237,7 +278,8 @@ def build_query_engine(
     This function initializes a query engine that is capable of converting natural language queries into SQL queries.
     It uses a text-to-SQL prompt template to guide this conversion process and leverages the provided service context
     for query execution. The query engine is configured with specific context parameters for each table in the database,
-    as defined in the table_context_dict.
+    as defined in the table_context_dict. The generated SQL is executed on the dedicated SQL executor so it never
+    blocks the event loop.
 
     Parameters:
     sql_database (SQLDatabase): The SQL database to be queried.
@@ -257,7 +299,7 @@ def build_query_engine(
         "similarity_top_k": 3
     }
 
-    query_engine = SQLTableRetrieverQueryEngine(
+    query_engine = CustomSQLTableRetrieverQueryEngine(
         sql_database=sql_database,
         table_retriever=obj_index.as_retriever(**kwargs), 
         llm=CustomSettings.code_llm,
@@ -300,44 +342,121 @@ def get_tool_service_context() -> ServiceContext:
     return service_context
 
 
-def build() -> tuple[List[QueryEngineInfo], SQLTableRetrieverQueryEngine]:
+def build_table_query_engine(group: TableInfo) -> QueryEngineData:
+    """
+    Builds the text-to-SQL query engine of a single table group.
+
+    Parameters:
+    group (TableInfo): The table group whose query engine should be built.
+
+    Returns:
+    QueryEngineData: The named query engine along with its tool descriptions.
+    """
+    sql_database = SQLDatabase(engine=sql_executor_engine, include_tables=[group.name])
+
+    sq_qe = build_query_engine(
+        sql_database, {group.name: table_context_dict[group.name]}
+    )
+    query_engine: QueryEngineInfo = QueryEngineInfo(
+        engine=sq_qe,  # type" ignore
+        query_engine_description=group.query_engine_description,
+        top_query_engine_description=group.top_query_engine_description,
+    )
+    return QueryEngineData(
+        f"{group.name}_query_engine",
+        query_engine,
+    )
+
+
+def build() -> List[QueryEngineData]:
     """
     Initializes and sets up query engines for database interaction.
 
     This function is responsible for creating and configuring various components necessary for the chat system's query processing.
-    It establishes connections to both SQLite and PostgreSQL databases, seeds the databases, and initializes components such as
-    OpenAI language models, embedding models, and node parsers. It then dynamically creates a list of QueryEngineInfo objects,
-    each representing a configured query engine for specific tables in the database.
+    It reflects the tables of each table group from the PostgreSQL database, builds their table-schema index
+    and wraps each of them in a text-to-SQL query engine.
 
     Returns:
-    List[QueryEngineInfo]: A list of QueryEngineInfo instances, each containing a configured query engine for database interaction.
+    List[QueryEngineData]: A list of QueryEngineData instances, each containing a configured query engine for database interaction.
     """
-    # Create query engines dynamically
-    query_engines: List[QueryEngineData] = []
+    return [build_table_query_engine(group) for group in table_groups]
 
-    for group in table_groups:
-        sql_database = SQLDatabase(engine=non_async_engine, include_tables=[group.name])
 
-        sq_qe = build_query_engine(
-            sql_database, {group.name: table_context_dict[group.name]}
-        )
-        query_engine: QueryEngineInfo = QueryEngineInfo(
-            engine=sq_qe,  # type" ignore
-            query_engine_description=group.query_engine_description,
-            top_query_engine_description=group.top_query_engine_description,
-        )
-        query_engines.append(
-            QueryEngineData(
-                f"{group.name}_query_engine",
-                query_engine,
-            )
-        )
+class QueryEngineRegistry:
+    """
+    Lazily built registry of the per-table query engines.
 
-    return query_engines
+    The registry starts empty so importing this module performs no DB reflection or embedding calls.
+    `warmup` is launched in the background from the application lifespan and builds the engines one
+    table at a time off the event loop. Any engine that is requested before warmup reached it is
+    built on demand; a per-table lock guarantees each engine is only built once per process.
+    """
 
+    def __init__(self, groups: List[TableInfo]):
+        self._groups = groups
+        self._engines: Dict[str, QueryEngineData] = {}
+        self._locks: Dict[str, threading.Lock] = {
+            group.name: threading.Lock() for group in groups
+        }
+        self._warmup_error: Optional[BaseException] = None
 
-# Get the dynamically created query engines
-query_engines = build()
+    @property
+    def is_warm(self) -> bool:
+        """Whether the query engine of every table group has been built."""
+        return len(self._engines) == len(self._groups)
+
+    def status(self) -> Dict[str, Any]:
+        """Returns the warm/cold state of the registry, as reported by the readiness probe."""
+        return {
+            "status": "warm" if self.is_warm else "cold",
+            "built": [group.name for group in self._groups if group.name in self._engines],
+            "pending": [
+                group.name for group in self._groups if group.name not in self._engines
+            ],
+            "error": repr(self._warmup_error) if self._warmup_error else None,
+        }
+
+    def get(self, group: TableInfo) -> QueryEngineData:
+        """Returns the query engine of the table group, building it first if needed."""
+        engine = self._engines.get(group.name)
+        if engine is not None:
+            return engine
+
+        with self._locks[group.name]:
+            engine = self._engines.get(group.name)
+            if engine is None:
+                logger.info("Building query engine for table %s", group.name)
+                engine = build_table_query_engine(group)
+                self._engines[group.name] = engine
+        return engine
+
+    def all(self) -> List[QueryEngineData]:
+        """Returns the query engines of all table groups, in table group order."""
+        return [self.get(group) for group in self._groups]
+
+    async def aall(self) -> List[QueryEngineData]:
+        """Same as `all`, but builds missing engines in a worker thread."""
+        if not self.is_warm:
+            await asyncio.to_thread(self.all)
+        return self.all()
+
+    async def warmup(self) -> None:
+        """Builds every query engine in the background without blocking the event loop."""
+        for group in self._groups:
+            try:
+                await asyncio.to_thread(self.get, group)
+            except Exception as e:
+                logger.error(
+                    "Failed to warm up query engine for table %s", group.name, exc_info=True
+                )
+                self._warmup_error = e
+        if self.is_warm:
+            self._warmup_error = None
+            logger.info("Query engine registry is warm")
+
+
+# Query engines are built in the background by the application lifespan, or on first use
+query_engine_registry = QueryEngineRegistry(table_groups)
 
 
 def get_chat_history(
@@ -348,50 +467,32 @@ def get_chat_history(
     Given a list of chat messages, return a list of ChatMessage instances.
 
     Failed chat messages are filtered out and then the remaining ones are
-    sorted by created_at.
+    sorted by created_at. The result is not bounded; use `chat.history.build_chat_history`
+    to build the history handed to the agents.
     """
-    # pre-process chat messages
-    chat_messages = []
-
-    for m in chat_messages:
-        if last_ai_message_id != m.id:
-            if m.content.strip() and m.status == MessageStatusEnum.SUCCESS:
-                chat_messages.append(m)
-
-    # TODO: could be a source of high CPU utilization
-    chat_messages = sorted(chat_messages, key=lambda m: m.created_at)  # type: ignore
-
-    chat_history = []
-    for message in chat_messages:
-        role = (
-            MessageRole.ASSISTANT
-            if message.role == MessageRoleEnum.assistant
-            else MessageRole.USER
-        )
-        chat_history.append(ChatMessage(content=message.content, role=role))  # type: ignore
-
-    return chat_history
+    return [
+        to_chat_message(message)
+        for message in filter_chat_messages(chat_messages, last_ai_message_id)
+    ]
 
-def get_query_engine_tools(
-    callback_handler: BaseCallbackHandler,
-):
+def build_query_engine_tools() -> List[QueryEngineTool]:
     """
-    Asynchronously creates and configures an OpenAIAgent for handling chat interactions.
-
-    This function sets up an OpenAIAgent with various tools and configurations required for processing and responding to chat messages. It initializes the service context, sets up query engine tools, creates sub-question query engines, and prepares the top-level sub-tools for the chat system. The function also configures an OpenAI language model and processes the chat history to be used by the agent.
+    Creates the tool graph used by the agents to answer chat messages.
 
-    Parameters:
-    callback_handler (BaseCallbackHandler): The callback handler to be used in the service context.
+    This function sets up the query engine tools of every table, wraps each of them in a sub-question query engine
+    sharing a single question generator and response synthesizer, and prepares the top-level sub-tools for the chat system.
+    Every object is wired to the request-scoped callback manager, so the graph can be shared by all chat turns of the
+    worker while each turn still receives its own callback events.
 
     Returns:
     List[QueryEngineTool]: A list of QueryEngineTool instances configured for the chat system.
     """
+    query_engines = query_engine_registry.all()
     question_gen = OpenAIQuestionGenerator.from_defaults(
         llm=Settings.llm, verbose=True, prompt_template_str=SUB_QUESTION_SYSTEM_PROMPT
     )
 
-    callback_manager = CallbackManager([callback_handler])
-    Settings.callback_manager = callback_manager
+    callback_manager = request_callback_manager
 
     response_synth = get_custom_response_synth(
         callback_manager=callback_manager,
@@ -439,9 +540,30 @@ def get_query_engine_tools(
     return top_level_sub_tools
 
 
-def get_agent_configs(
-    callback_handler: BaseCallbackHandler,
-) -> list[AgentConfig]:
+_query_engine_tools: Optional[List[QueryEngineTool]] = None
+_query_engine_tools_lock = threading.Lock()
+
+
+def get_query_engine_tools() -> List[QueryEngineTool]:
+    """
+    Returns the tool graph of the worker, building it on first use.
+
+    The callback handler of a chat turn is not attached here; bind it with
+    `chat.callbacks.bind_callback_handler` around the code that runs the tools.
+
+    Returns:
+    List[QueryEngineTool]: A list of QueryEngineTool instances configured for the chat system.
+    """
+    global _query_engine_tools
+
+    if _query_engine_tools is None:
+        with _query_engine_tools_lock:
+            if _query_engine_tools is None:
+                _query_engine_tools = build_query_engine_tools()
+    return _query_engine_tools
+
+
+def get_agent_configs() -> list[AgentConfig]:
     curr_date = datetime.utcnow().strftime("%Y-%m-%d")
     tables_list = ["clients", "transactions"]
 
@@ -462,7 +584,7 @@ def get_agent_configs(
                 table_names=", ".join(tables_list),
                 curr_date=curr_date
             ),
-            tools=get_query_engine_tools(callback_handler),
+            tools=get_query_engine_tools(),
         ),
     ]
 
@@ -472,25 +594,49 @@ async def workflow_runner(
     user_message: str,
     conversation: ConversationSchema,
     last_ai_message_id: Optional[str] = None,
+    message_id: Optional[str] = None,
+    resume: bool = False,
 ):
-    """Main function to run the workflow."""
-    agent_configs = get_agent_configs(
-        callback_handler=callback_handler,
-    )
+    """
+    Main function to run the workflow.
+
+    With a `message_id`, the context of the workflow is checkpointed after each step under the id of the message it
+    generates, and with `resume`, the workflow resumes from its last checkpoint instead of starting over.
+    """
+    # make sure every query engine exists without building them on the event loop
+    await query_engine_registry.aall()
+    agent_configs = get_agent_configs()
     workflow = ConciergeAgent(timeout=None)
 
-    chat_messages: List[MessageSchema] = conversation.messages
-    chat_history = get_chat_history(chat_messages, last_ai_message_id)
+    ctx = None
+    checkpoint_callback = None
+    if message_id is not None and workflow_checkpointer.enabled:
+        checkpoint_callback = workflow_checkpointer.checkpoint_callback(message_id)
+        if resume:
+            ctx = await workflow_checkpointer.arestore(
+                workflow,
+                message_id,
+                {ac.name: ac for ac in agent_configs},
+                Settings.llm,
+            )
+
+    chat_history = build_chat_history(conversation, last_ai_message_id)
     logger.debug("Chat history: %s", chat_history)
     # draw a diagram of the workflow
     # draw_all_possible_flows(workflow, filename="workflow.html")
 
-    handler: WorkflowHandler = workflow.run(
-        user_msg=user_message,
-        agent_configs=agent_configs,
-        llm=Settings.llm,
-        chat_history=chat_history,
-    )
+    # the workflow tasks copy the current context, so they keep reporting to this callback handler
+    with bind_callback_handler(callback_handler):
+        handler: WorkflowHandler = workflow.run(
+            ctx=ctx,
+            checkpoint_callback=checkpoint_callback,
+            user_msg=user_message,
+            agent_configs=agent_configs,
+            llm=Settings.llm,
+            chat_history=chat_history,
+            active_speaker=conversation.active_speaker,
+            initial_state=conversation.user_state or {},
+        )
 
     return handler
 
@@ -507,7 +653,8 @@ async def get_chat_engine(
     This function sets up an OpenAIAgent with various tools and configurations required for processing and responding to chat messages. It initializes the service context, sets up query engine tools, creates sub-question query engines, and prepares the top-level sub-tools for the chat system. The function also configures an OpenAI language model and processes the chat history to be used by the agent.
 
     Parameters:
-    callback_handler (BaseCallbackHandler): The callback handler to be used in the service context.
+    callback_handler (BaseCallbackHandler): The callback handler of the chat turn. The agent reports to the handler bound
+    to the current context, so run it within `chat.callbacks.bind_callback_handler(callback_handler)`.
     conversation (ConversationSchema): The schema representing the conversation for which the chat engine is being set up.
     temperature (float): The temperature setting for the OpenAI model, controlling the creativity of the responses.
 
@@ -521,64 +668,16 @@ async def get_chat_engine(
         "temperature": float(os.getenv("LLM_TEMPERATURE", DEFAULT_TEMPERATURE)),
         "api_key": settings.OPENAI_API_KEY,
         "max_tokens": int(os.getenv("MAX_TOKENS", 4096)),
+        "async_http_client": concurrency_governor.http_client("openai"),
     }
 
     llm = OpenAI(**config)
     curr_date = datetime.utcnow().strftime("%Y-%m-%d")
 
-    question_gen = OpenAIQuestionGenerator.from_defaults(
-        llm=Settings.llm, verbose=True, prompt_template_str=SUB_QUESTION_SYSTEM_PROMPT
-    )
-
-    callback_manager = CallbackManager([callback_handler])
-    Settings.callback_manager = callback_manager
-
-    response_synth = get_custom_response_synth(
-        callback_manager=callback_manager,
-    )
-
-    vector_sql_query_engine_tools = [
-        QueryEngineTool(
-            query_engine=query_engine.query_engine.engine,
-            metadata=ToolMetadata(
-                name=query_engine.name,
-                # Correctly reference the attribute here
-                description=query_engine.query_engine.query_engine_description,
-            ),
-            resolve_input_errors=True,
-        )
-        for query_engine in query_engines
-    ]  # Use enumerate to get idx
-
-    qualitative_question_engines = [
-        CustomSubQuestionQueryEngine.from_defaults(
-            query_engine_tools=[vector_sql_query_engine_tool],
-            llm=Settings.llm,
-            response_synthesizer=response_synth,
-            verbose=settings.VERBOSE,
-            question_gen=question_gen,
-            use_async=True,
-            callback_manager=callback_manager,
-        )
-        for vector_sql_query_engine_tool in vector_sql_query_engine_tools
-    ]
-
-    top_level_sub_tools = [
-        QueryEngineTool(
-            query_engine=qualitative_question_engine,
-            metadata=ToolMetadata(
-                name=f"qualitative_{query_engines[idx].name}",
-                description=query_engines[
-                    idx
-                ].query_engine.top_query_engine_description.strip(),
-            ),
-            resolve_input_errors=True,
-        )
-        for idx, qualitative_question_engine in enumerate(qualitative_question_engines)
-    ]
+    await query_engine_registry.aall()
+    top_level_sub_tools = get_query_engine_tools()
 
-    chat_messages: List[MessageSchema] = conversation.messages
-    chat_history = get_chat_history(chat_messages, last_ai_message_id)
+    chat_history = build_chat_history(conversation, last_ai_message_id)
     logger.debug("Chat history: %s", chat_history)
 
     chat_engine = OpenAIAgent.from_tools(
@@ -589,7 +688,7 @@ async def get_chat_engine(
         system_prompt=SYSTEM_PROMPT.format(
             table_names=tables_list, curr_date=curr_date
         ),
-        callback_manager=Settings.callback_manager,  # type: ignore
+        callback_manager=request_callback_manager,  # type: ignore
         max_function_calls=3,
     )
 
@@ -0,0 +1,197 @@
+"""
+This module forwards the LlamaIndex callback events of a chat request to its SSE stream in bounded, ordered batches.
+
+Callbacks fire synchronously, possibly from the SQL executor threads, and in bursts (every LLM, embedding and
+retrieval call produces a start and an end event). Instead of a task per event, events are buffered per request,
+keyed by event id so that the start and end of the same event merge into a single entry, and flushed once per tick
+by a single drainer task as one batch. The buffer is bounded for low-value event types only: when it is full, they are
+dropped, and evicted to make room for the other events. The other events (sub questions, LLM calls, ...) are persisted
+with the message and are never dropped: when nothing can be evicted, the buffer goes over its bound and is flushed
+right away instead of at the end of the tick. The drainer awaits the send channel, so a slow client slows the flushes
+down rather than the workflow.
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import anyio
+from anyio.streams.memory import MemoryObjectSendStream
+from llama_index.core.callbacks.schema import CBEventType
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Event types only shown as progress hints, the only ones dropped when the buffer is full
+LOW_VALUE_EVENT_TYPES = frozenset(
+    event_type.name
+    for event_type in (
+        CBEventType.CHUNKING,
+        CBEventType.NODE_PARSING,
+        CBEventType.EMBEDDING,
+        CBEventType.TEMPLATING,
+        CBEventType.TREE,
+    )
+)
+
+
+class CallbackEventStats:
+    """Counters of the callback event pipelines of the worker."""
+
+    def __init__(self) -> None:
+        self.received = 0
+        self.merged = 0
+        self.dropped = 0
+        self.overflowed = 0
+        self.batches = 0
+        self.sent = 0
+        self.max_queue_depth = 0
+        self.pipelines: "set[CallbackEventPipeline]" = set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active_pipelines": len(self.pipelines),
+            "queue_depth": sum(pipeline.queue_depth for pipeline in self.pipelines),
+            "max_queue_depth": self.max_queue_depth,
+            "received": self.received,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "overflowed": self.overflowed,
+            "batches": self.batches,
+            "sent": self.sent,
+        }
+
+
+callback_event_stats = CallbackEventStats()
+
+
+class CallbackEventPipeline:
+    """
+    Buffers the sub process events of one chat request and sends them in batches to its send channel.
+
+    The events are expected to have `event_id`, `source`, `has_ended` and `metadata_map` attributes, like
+    StreamedMessageSubProcess. `make_batch` wraps a list of them into the object sent to the channel.
+    """
+
+    def __init__(
+        self,
+        send_chan: MemoryObjectSendStream,
+        make_batch: Callable[[List[Any]], Any],
+        max_pending: int = settings.CALLBACK_EVENT_QUEUE_SIZE,
+        flush_interval: float = settings.CALLBACK_EVENT_FLUSH_INTERVAL,
+    ):
+        self._send_chan = send_chan
+        self._make_batch = make_batch
+        self._max_pending = max_pending
+        self._flush_interval = flush_interval
+        # event id -> latest state of the event, in order of first appearance
+        self._pending: "OrderedDict[str, Any]" = OrderedDict()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        # set when the buffer is over its bound, to flush without waiting for the end of the tick
+        self._overflow: Optional[asyncio.Event] = None
+        self._drainer: Optional["asyncio.Task[None]"] = None
+        self._closed = False
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    def start(self) -> None:
+        """Starts the drainer task. Must be called from the event loop of the request."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._overflow = asyncio.Event()
+        self._drainer = asyncio.create_task(self._drain())
+        callback_event_stats.pipelines.add(self)
+
+    def put(self, event: Any) -> None:
+        """Enqueues an event. Safe to call from any thread; never blocks."""
+        if self._loop is None or self._closed:
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            self._put(event)
+        else:
+            self._loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event: Any) -> None:
+        if self._closed:
+            return
+        callback_event_stats.received += 1
+
+        previous = self._pending.get(event.event_id)
+        if previous is not None:
+            # the start and end of the event are flushed as a single update
+            if event.metadata_map is None:
+                event.metadata_map = previous.metadata_map
+            self._pending[event.event_id] = event
+            callback_event_stats.merged += 1
+            return
+
+        if len(self._pending) >= self._max_pending:
+            if event.source.name in LOW_VALUE_EVENT_TYPES:
+                callback_event_stats.dropped += 1
+                return
+            if not self._evict_low_value():
+                callback_event_stats.overflowed += 1
+                self._overflow.set()  # type: ignore
+
+        self._pending[event.event_id] = event
+        callback_event_stats.max_queue_depth = max(
+            callback_event_stats.max_queue_depth, len(self._pending)
+        )
+        self._wakeup.set()  # type: ignore
+
+    def _evict_low_value(self) -> bool:
+        """Evicts the oldest pending low-value event. Returns False if there is none."""
+        for event_id, pending in self._pending.items():
+            if pending.source.name in LOW_VALUE_EVENT_TYPES:
+                del self._pending[event_id]
+                callback_event_stats.dropped += 1
+                return True
+        return False
+
+    async def _flush(self) -> None:
+        if not self._pending:
+            return
+        batch = list(self._pending.values())
+        self._pending.clear()
+        try:
+            await self._send_chan.send(self._make_batch(batch))
+        except (anyio.ClosedResourceError, anyio.BrokenResourceError):
+            logger.debug("Received events after send channel closed. Ignoring.")
+            return
+        callback_event_stats.batches += 1
+        callback_event_stats.sent += len(batch)
+
+    async def _drain(self) -> None:
+        while not self._closed:
+            await self._wakeup.wait()  # type: ignore
+            if not self._closed and not self._overflow.is_set():  # type: ignore
+                # let the events of the tick accumulate before sending them, unless the buffer is full
+                try:
+                    await asyncio.wait_for(
+                        self._overflow.wait(), self._flush_interval  # type: ignore
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()  # type: ignore
+            self._overflow.clear()  # type: ignore
+            await self._flush()
+
+    async def aclose(self) -> None:
+        """Stops the drainer once it has flushed the remaining events."""
+        if self._closed:
+            return
+        self._closed = True
+        callback_event_stats.pipelines.discard(self)
+        if self._drainer is not None:
+            self._wakeup.set()  # type: ignore
+            await self._drainer
+        await self._flush()
@@ -0,0 +1,125 @@
+"""
+The headline module generates the headlines of conversations off the request path.
+
+Headlines are generated asynchronously from the first question of a conversation, memoized by the normalized question
+text, and persisted by a background task. Concurrent requests for the same conversation share a single task, and
+concurrent conversations starting with the same question share a single LLM call.
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from llama_index.core.settings import Settings
+from sqlalchemy import update
+
+from chat.utils import normalize_question
+from core.config import settings
+from libs.db.session import get_async_session
+from libs.models.chatdb import Conversation
+
+logger = logging.getLogger(__name__)
+
+
+async def get_conversation_headline(prompt: str) -> str:
+    """
+    Generates a concise and informative headline from a given question.
+
+    This function uses the configured LLM to create a headline that captures the essence of the input question in a brief and clear manner. It formats the input question into a prompt template and requests a headline generation from the LLM.
+
+    Parameters:
+    prompt (str): The question from which a headline is to be generated.
+
+    Returns:
+    str: A headline derived from the question, providing a succinct summary or overview of the question's topic.
+    """
+    prompt_template = f"""
+    Create a concise headline from the given question. The headline should be simple and clearly reflect the essence of the question.
+    Only answer with the headline.
+
+    For example, if the question is 'How many clients made a withdrawal this month?', a suitable headline could be 'Monthly Withdrawal Activity'.
+
+    Question: {prompt}
+    """
+    response = await Settings.llm.acomplete(prompt_template)
+
+    return response.text.strip().strip('"')
+
+
+class HeadlineService:
+    """
+    Generates, memoizes and persists conversation headlines in the background.
+    """
+
+    def __init__(self, max_cache_size: int):
+        self._max_cache_size = max_cache_size
+        # normalized first question -> headline
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        # normalized first question -> in-flight headline generation
+        self._generations: Dict[str, "asyncio.Task[str]"] = {}
+        # conversation id -> in-flight generate-and-persist task
+        self._tasks: Dict[str, "asyncio.Task[None]"] = {}
+
+    def get_cached(self, question: str) -> Optional[str]:
+        """Returns the memoized headline of the question, if any."""
+        key = normalize_question(question)
+        headline = self._cache.get(key)
+        if headline is not None:
+            self._cache.move_to_end(key)
+        return headline
+
+    def is_pending(self, conversation_id: str) -> bool:
+        """Whether a headline is currently being generated for the conversation."""
+        return conversation_id in self._tasks
+
+    async def generate(self, question: str) -> str:
+        """Returns the headline of the question, sharing the LLM call with concurrent callers."""
+        key = normalize_question(question)
+        headline = self.get_cached(question)
+        if headline is not None:
+            return headline
+
+        generation = self._generations.get(key)
+        if generation is None:
+            generation = asyncio.create_task(get_conversation_headline(question))
+            self._generations[key] = generation
+            generation.add_done_callback(lambda _: self._generations.pop(key, None))
+
+        headline = await asyncio.shield(generation)
+        self._cache[key] = headline
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._max_cache_size:
+            self._cache.popitem(last=False)
+        return headline
+
+    def schedule(self, conversation_id: str, question: str) -> Optional[str]:
+        """
+        Makes sure the headline of the conversation gets generated and persisted, without waiting for it.
+
+        Returns the memoized headline when there is one, otherwise None while the headline is pending.
+        """
+        if conversation_id not in self._tasks:
+            task = asyncio.create_task(self._generate_and_persist(conversation_id, question))
+            self._tasks[conversation_id] = task
+            task.add_done_callback(lambda _: self._tasks.pop(conversation_id, None))
+        return self.get_cached(question)
+
+    async def _generate_and_persist(self, conversation_id: str, question: str) -> None:
+        try:
+            headline = await self.generate(question)
+            async with get_async_session() as db:
+                await db.execute(
+                    update(Conversation)
+                    .where(Conversation.id == conversation_id)
+                    .values(headline=headline)
+                )
+        except Exception:
+            logger.error(
+                "Failed to generate headline for conversation %s",
+                conversation_id,
+                exc_info=True,
+            )
+
+
+headline_service = HeadlineService(max_cache_size=settings.HEADLINE_CACHE_SIZE)
@@ -0,0 +1,222 @@
+"""
+The history module builds the chat history handed to the agents within a configurable token budget.
+
+The most recent messages are kept verbatim. The messages that no longer fit the budget are folded into a rolling
+summary of the conversation, which is persisted on the conversation and updated incrementally in the background, so
+the prompt size stays bounded however long the conversation grows. A message leaves the prompt only once the summary
+covering it is persisted: until then the prompt may exceed the budget, within the loaded window of messages.
+"""
+
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+from llama_index.core.settings import Settings
+from llama_index.core.utils import get_tokenizer
+from sqlalchemy import or_, update
+
+from core.config import settings
+from libs.db.session import get_async_session
+from libs.models.chatdb import Conversation, MessageRoleEnum, MessageStatusEnum
+from schema import ChatConversation as ConversationSchema
+from schema import Message as MessageSchema
+
+logger = logging.getLogger(__name__)
+
+# Approximate number of tokens added by the chat format around each message
+MESSAGE_TOKEN_OVERHEAD = 4
+
+SUMMARY_PROMPT_TMPL = """
+You maintain a running summary of an investigation conversation between a user and a financial data analyst assistant.
+Update the existing summary with the new messages below. Keep the facts, figures, filters, client identifiers and
+open questions that later questions may refer to, and drop pleasantries. Answer with the updated summary only,
+in less than 300 words.
+
+Existing summary:
+{summary}
+
+New messages:
+{messages}
+""".strip()
+
+
+def count_tokens(text: str) -> int:
+    """Counts the tokens of the text with the default LlamaIndex tokenizer."""
+    return len(get_tokenizer()(text))
+
+
+def filter_chat_messages(
+    chat_messages: List[MessageSchema],
+    last_ai_message_id: Optional[str] = None,
+) -> List[MessageSchema]:
+    """
+    Filters out failed and empty messages, as well as the message being regenerated, and sorts the rest by created_at.
+    """
+    chat_messages = [
+        m
+        for m in chat_messages
+        if last_ai_message_id != m.id
+        and m.content.strip()
+        and m.status == MessageStatusEnum.SUCCESS
+    ]
+    return sorted(chat_messages, key=lambda m: m.created_at)  # type: ignore
+
+
+def to_chat_message(message: MessageSchema) -> ChatMessage:
+    role = (
+        MessageRole.ASSISTANT
+        if message.role == MessageRoleEnum.assistant
+        else MessageRole.USER
+    )
+    return ChatMessage(content=message.content, role=role)
+
+
+def split_history(
+    chat_messages: List[MessageSchema],
+    token_budget: int,
+    summary: Optional[str] = None,
+) -> tuple[List[MessageSchema], List[MessageSchema]]:
+    """
+    Splits the chronologically sorted messages into the older ones that do not fit the token budget and the most
+    recent ones that do. The latest message is always kept.
+
+    Returns:
+    tuple[List[MessageSchema], List[MessageSchema]]: The messages to fold into the summary and the messages to keep verbatim.
+    """
+    used = count_tokens(summary) + MESSAGE_TOKEN_OVERHEAD if summary else 0
+    first_kept = len(chat_messages)
+    for idx in range(len(chat_messages) - 1, -1, -1):
+        cost = count_tokens(chat_messages[idx].content) + MESSAGE_TOKEN_OVERHEAD
+        if first_kept < len(chat_messages) and used + cost > token_budget:
+            break
+        used += cost
+        first_kept = idx
+    return chat_messages[:first_kept], chat_messages[first_kept:]
+
+
+async def summarize_messages(
+    summary: Optional[str], messages: List[MessageSchema]
+) -> str:
+    """Folds the messages into the existing summary with the LLM."""
+    messages_str = "\n".join(
+        f"{message.role.value}: {message.content.strip()}" for message in messages
+    )
+    prompt = SUMMARY_PROMPT_TMPL.format(
+        summary=summary or "(none)", messages=messages_str
+    )
+    response = await Settings.llm.acomplete(prompt)
+    return response.text.strip()
+
+
+class HistorySummarizer:
+    """
+    Updates the persisted history summary of conversations in the background, one update at a time per conversation.
+    """
+
+    def __init__(self) -> None:
+        # conversation id -> in-flight summarize-and-persist task
+        self._tasks: Dict[str, "asyncio.Task[None]"] = {}
+
+    def schedule(
+        self,
+        conversation_id: str,
+        summary: Optional[str],
+        messages: List[MessageSchema],
+    ) -> None:
+        """Folds the messages into the summary of the conversation, without waiting for it."""
+        if not messages or conversation_id in self._tasks:
+            return
+        task = asyncio.create_task(
+            self._summarize_and_persist(conversation_id, summary, messages)
+        )
+        self._tasks[conversation_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(conversation_id, None))
+
+    async def _summarize_and_persist(
+        self,
+        conversation_id: str,
+        summary: Optional[str],
+        messages: List[MessageSchema],
+    ) -> None:
+        try:
+            new_summary = await summarize_messages(summary, messages)
+            summary_until = messages[-1].created_at
+            async with get_async_session() as db:
+                # never move the watermark backwards if another worker got further
+                await db.execute(
+                    update(Conversation)
+                    .where(Conversation.id == conversation_id)
+                    .where(
+                        or_(
+                            Conversation.history_summary_until.is_(None),
+                            Conversation.history_summary_until < summary_until,
+                        )
+                    )
+                    .values(
+                        history_summary=new_summary,
+                        history_summary_until=summary_until,
+                    )
+                )
+        except Exception:
+            logger.error(
+                "Failed to update history summary of conversation %s",
+                conversation_id,
+                exc_info=True,
+            )
+
+
+history_summarizer = HistorySummarizer()
+
+
+def build_chat_history(
+    conversation: ConversationSchema,
+    last_ai_message_id: Optional[str] = None,
+    token_budget: int = settings.CHAT_HISTORY_TOKEN_BUDGET,
+) -> List[ChatMessage]:
+    """
+    Builds the chat history of the conversation within the token budget.
+
+    The persisted summary (if any) comes first, followed by the messages it does not cover yet. The messages that
+    do not fit the budget, including the ones older than the loaded window, are scheduled to be folded into the
+    summary for the next turns, oldest first: the summary watermark never moves past a message that was not folded.
+    They stay in the prompt until then, so nothing is lost while the summary is being written.
+
+    Parameters:
+    conversation (ConversationSchema): The conversation, with the messages newer than its summary.
+    last_ai_message_id (Optional[str]): The id of the assistant message being regenerated, if any.
+    token_budget (int): The number of tokens of the summary and the verbatim messages beyond which the older messages
+    are folded.
+
+    Returns:
+    List[ChatMessage]: The chat history to hand to the agents.
+    """
+    chat_messages = filter_chat_messages(conversation.messages, last_ai_message_id)
+    summary = conversation.history_summary
+    to_fold, _ = split_history(chat_messages, token_budget, summary)
+    older = filter_chat_messages(conversation.messages_to_fold, last_ai_message_id)
+    if conversation.more_to_fold:
+        # the messages between the older ones and the window are folded first, on the next turns
+        to_fold = older
+    else:
+        to_fold = older + to_fold
+
+    if to_fold:
+        logger.debug(
+            "Folding %d message(s) of conversation %s into its summary",
+            len(to_fold),
+            conversation.id,
+        )
+        history_summarizer.schedule(str(conversation.id), summary, to_fold)
+
+    chat_history = []
+    if summary:
+        chat_history.append(
+            ChatMessage(
+                role=MessageRole.SYSTEM,
+                content=f"Summary of the earlier part of this conversation:\n{summary}",
+            )
+        )
+    # the messages being folded are not covered by the persisted summary yet
+    chat_history.extend(to_chat_message(message) for message in chat_messages)
+    return chat_history
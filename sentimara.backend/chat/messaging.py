@@ -15,22 +15,31 @@ from llama_index.core.query_engine.sub_question_query_engine import (
 from pydantic import BaseModel
 
 import schema
-from chat.engine import workflow_runner
+from chat.answer_cache import answer_cache
+from chat.checkpoints import workflow_checkpointer
+from chat.engine import get_chat_history, workflow_runner
+from chat.event_pipeline import CallbackEventPipeline
 from libs.models.chatdb import MessageSubProcessSourceEnum
 from schema import (
-    Conversation,
+    ChatConversation,
     SubProcessMetadataKeysEnum,
     SubProcessMetadataMap,
     UserMessageCreate,
 )
 from .workflow import (    
+    AnswerDeltaEvent,
     ProgressEvent,
     ToolRequestEvent,
     ToolApprovedEvent,
 )
 from llama_index.core.workflow import (
+    Context,
     StopEvent,
 )
+from sqlalchemy import update
+
+from libs.db.session import get_async_session
+from libs.models.chatdb import Conversation as ConversationModel
 
 logger = logging.getLogger(__name__)
 
@@ -67,6 +76,14 @@ class StreamedMessageSubProcess(BaseModel):
     metadata_map: Optional[SubProcessMetadataMap]
 
 
+class StreamedMessageSubProcessBatch(BaseModel):
+    """
+    The subprocess events flushed together by the callback event pipeline, in order of first appearance.
+    """
+
+    sub_processes: List[StreamedMessageSubProcess]
+
+
 class ChatCallbackHandler(BaseCallbackHandler):
     """
     Handles callbacks for chat-related events.
@@ -74,6 +91,9 @@ class ChatCallbackHandler(BaseCallbackHandler):
     This class extends BaseCallbackHandler to provide custom handling of various chat events,
     such as the start and end of specific processes or actions within the chat system.
 
+    Events are forwarded through a bounded CallbackEventPipeline, which merges and batches them. The handler must be
+    created within the event loop of the request and closed with `aclose` before the send channel is closed.
+
     Attributes:
     send_chan (MemoryObjectSendStream): A stream for sending messages or subprocess information.
     """
@@ -86,6 +106,17 @@ class ChatCallbackHandler(BaseCallbackHandler):
         ignored_events = [CBEventType.CHUNKING, CBEventType.NODE_PARSING]
         super().__init__(ignored_events, ignored_events)
         self._send_chan = send_chan
+        self._pipeline = CallbackEventPipeline(
+            send_chan,
+            make_batch=lambda sub_processes: StreamedMessageSubProcessBatch(
+                sub_processes=sub_processes
+            ),
+        )
+        self._pipeline.start()
+
+    async def aclose(self) -> None:
+        """Flushes the pending events and stops the pipeline."""
+        await self._pipeline.aclose()
 
     def on_event_start(
         self,
@@ -95,11 +126,12 @@ class ChatCallbackHandler(BaseCallbackHandler):
         **kwargs: Any,
     ) -> str:  # type: ignore
         """Create the MessageSubProcess row for the event that started."""
-        asyncio.create_task(
-            self.async_on_event(
-                event_type, payload, event_id, is_start_event=True, **kwargs
+        self._pipeline.put(
+            self.to_streamed_sub_process(
+                event_type, payload, event_id, is_start_event=True
             )
         )
+        return event_id
 
     def on_event_end(
         self,
@@ -109,9 +141,9 @@ class ChatCallbackHandler(BaseCallbackHandler):
         **kwargs: Any,
     ) -> None:
         """Create the MessageSubProcess row for the event that completed."""
-        asyncio.create_task(
-            self.async_on_event(
-                event_type, payload, event_id, is_start_event=False, **kwargs
+        self._pipeline.put(
+            self.to_streamed_sub_process(
+                event_type, payload, event_id, is_start_event=False
             )
         )
 
@@ -157,44 +189,35 @@ class ChatCallbackHandler(BaseCallbackHandler):
             )
         return metadata_map
 
-    async def async_on_event(
+    def to_streamed_sub_process(
         self,
         event_type: CBEventType,
         payload: Optional[Dict[str, Any]] = None,
         event_id: str = "",
         is_start_event: bool = False,
-        **kwargs: Any,
-    ) -> None:
+    ) -> StreamedMessageSubProcess:
         """
-        Asynchronously handles a specific chat event.
-
-        This method is responsible for processing chat events asynchronously.
-        It sends the processed event data, including metadata, to a designated stream channel
-        for further handling or logging.
+        Converts a chat event into the subprocess information sent to the stream channel.
 
         Parameters:
         event_type (CBEventType): The type of the chat event.
         payload (Optional[Dict[str, Any]]): The payload associated with the event.
         event_id (str): The unique identifier of the event.
         is_start_event (bool): Flag indicating whether the event is a start event.
-        **kwargs: Additional keyword arguments.
+
+        Returns:
+        StreamedMessageSubProcess: The subprocess information of the event.
         """
         metadata_map = self.get_metadata_from_event(
             event_type, payload=payload, is_start_event=is_start_event
         )
         metadata_map = metadata_map or None
         source = MessageSubProcessSourceEnum[event_type.name]
-        # TODO: Access to a protected member _closed of a client class
-        if self._send_chan._closed:
-            logger.debug("Received event after send channel closed. Ignoring.")
-            return
-        await self._send_chan.send(
-            StreamedMessageSubProcess(
-                source=source,
-                metadata_map=metadata_map,
-                event_id=event_id,
-                has_ended=not is_start_event,
-            )
+        return StreamedMessageSubProcess(
+            source=source,
+            metadata_map=metadata_map,
+            event_id=event_id,
+            has_ended=not is_start_event,
         )
 
     def start_trace(self, trace_id: Optional[str] = None) -> None:
@@ -208,11 +231,40 @@ class ChatCallbackHandler(BaseCallbackHandler):
         """No-op."""
 
 
+async def save_workflow_state(conversation: ChatConversation, ctx: Context) -> None:
+    """
+    Persists the active speaker and the user state of the workflow with the conversation, so that the next turn
+    resumes with the same agent instead of going through the orchestrator again.
+    """
+    active_speaker = await ctx.get("active_speaker", default=None) or None
+    user_state = await ctx.get("user_state", default=None) or None
+    if (
+        active_speaker == conversation.active_speaker
+        and user_state == conversation.user_state
+    ):
+        return
+    try:
+        async with get_async_session() as db:
+            await db.execute(
+                update(ConversationModel)
+                .where(ConversationModel.id == conversation.id)
+                .values(active_speaker=active_speaker, user_state=user_state)
+            )
+    except Exception:
+        logger.error(
+            "Failed to save workflow state of conversation %s",
+            conversation.id,
+            exc_info=True,
+        )
+
+
 async def handle_chat_message(
-    conversation: Conversation,
+    conversation: ChatConversation,
     user_message: UserMessageCreate,
     send_chan: MemoryObjectSendStream,
     last_ai_message_id: Optional[str] = None,
+    message_id: Optional[str] = None,
+    resume: bool = False,
 ) -> None:
     """
     Handles the processing of a chat message within a conversation.
@@ -221,62 +273,113 @@ async def handle_chat_message(
     streams the chat response, and sends the processed message or a default response to the send channel.
 
     Parameters:
-    conversation (Conversation): The conversation context in which the chat message is being processed.
+    conversation (ChatConversation): The conversation context in which the chat message is being processed.
     user_message (UserMessageCreate): The user message to be processed.
     send_chan (MemoryObjectSendStream): The stream channel to which the processed message or responses are sent.
     temperature (float): The temperature setting for the OpenAI model, controlling the creativity of the responses.
+    message_id (Optional[str]): The id of the assistant message, under which the workflow is checkpointed.
+    resume (bool): Whether to resume the workflow from its checkpoint instead of starting it over.
     """
     async with send_chan:
         await send_chan.send(
-            StreamedMessageSubProcess(
-                event_id=str(uuid4()),
-                has_ended=True,
-                metadata_map=None,
-                source=MessageSubProcessSourceEnum.CONSTRUCTED_QUERY_ENGINE,  # type: ignore
-            )  # type: ignore
+            StreamedMessageSubProcessBatch(
+                sub_processes=[
+                    StreamedMessageSubProcess(
+                        event_id=str(uuid4()),
+                        has_ended=True,
+                        metadata_map=None,
+                        source=MessageSubProcessSourceEnum.CONSTRUCTED_QUERY_ENGINE,  # type: ignore
+                    )  # type: ignore
+                ]
+            )
         )
         logger.debug("Engine received")
         templated_message = f"""
             {user_message.content}
         """.strip()
-        handler = await workflow_runner(
-            ChatCallbackHandler(send_chan), templated_message, conversation, last_ai_message_id
-        )
 
-        response_str = ""
-        async for event in handler.stream_events():
-            # response_str += event.content
-            if isinstance(event, StopEvent):
-                if event.result:
-                    response_str += event.result["response"]
-
-                    print("<--- Final Response --->")
-                    print(event.result["response"])
-                    print("<--- Final Response --->")
-            # elif isinstance(event, AgentInput):
-            #     print("📥 Input:", event.input)
-            elif isinstance(event, ToolApprovedEvent):
-                if event.response:
-                    print("📤 Output:", event.response)
-                if event.tool_kwargs:
-                    print(
-                        "🛠️  Planning to use tools:",
-                        [call.get("tool_name")   for call in event.tool_kwargs],
-                    )
-
-            elif isinstance(event, ToolRequestEvent):
-                print(f"🔧 Tool Request ({event.tool_name}):")
-                print(f"  Arguments: {event.tool_kwargs}")
-            elif isinstance(event, ProgressEvent):
-                print(f"Progress: {event.msg}")
-
-            # if send_chan._closed:
-            #     logger.debug(
-            #         "Received streamed token after send channel closed. Ignoring."
-            #     )
-            #     return
-            # response_str += event.response.content
-            await send_chan.send(StreamedMessage(content=response_str))
+        # Questions asked without history can be answered from the semantic answer cache,
+        # unless the user explicitly asked to regenerate the answer.
+        cache_query = None
+        if (
+            answer_cache.enabled
+            and last_ai_message_id is None
+            and not conversation.history_summary
+            and not get_chat_history(conversation.messages)
+        ):
+            cache_query = await answer_cache.aprepare(templated_message)
+            cached_answer = answer_cache.get(cache_query) if cache_query else None
+            if cached_answer is not None:
+                await send_chan.send(StreamedMessage(content=cached_answer))
+                return
+
+        callback_handler = ChatCallbackHandler(send_chan)
+        handler = None
+        try:
+            handler = await workflow_runner(
+                callback_handler,
+                templated_message,
+                conversation,
+                last_ai_message_id,
+                message_id=message_id,
+                resume=resume,
+            )
+
+            response_str = ""
+            sent_str = None
+            async for event in handler.stream_events():
+                # response_str += event.content
+                if isinstance(event, AnswerDeltaEvent):
+                    response_str = "" if event.reset else response_str + event.delta
+                elif isinstance(event, StopEvent):
+                    if event.result:
+                        # the final answer supersedes the streamed tokens
+                        response_str = event.result["response"] or ""
+
+                        print("<--- Final Response --->")
+                        print(event.result["response"])
+                        print("<--- Final Response --->")
+                # elif isinstance(event, AgentInput):
+                #     print("📥 Input:", event.input)
+                elif isinstance(event, ToolApprovedEvent):
+                    if event.response:
+                        print("📤 Output:", event.response)
+                    if event.tool_kwargs:
+                        print(
+                            "🛠️  Planning to use tools:",
+                            [call.get("tool_name")   for call in event.tool_kwargs],
+                        )
+
+                elif isinstance(event, ToolRequestEvent):
+                    print(f"🔧 Tool Request ({event.tool_name}):")
+                    print(f"  Arguments: {event.tool_kwargs}")
+                elif isinstance(event, ProgressEvent):
+                    print(f"Progress: {event.msg}")
+
+                # if send_chan._closed:
+                #     logger.debug(
+                #         "Received streamed token after send channel closed. Ignoring."
+                #     )
+                #     return
+                # response_str += event.response.content
+                if response_str != sent_str:
+                    await send_chan.send(StreamedMessage(content=response_str))
+                    sent_str = response_str
+
+            await save_workflow_state(conversation, handler.ctx)
+            if message_id is not None:
+                await workflow_checkpointer.adiscard(message_id)
+        except asyncio.CancelledError:
+            # stop the workflow steps, with their tool calls, LLM requests and SQL queries
+            if handler is not None:
+                await handler.cancel_run()
+            raise
+        finally:
+            # the pending sub process events must reach the stream before it is closed
+            await callback_handler.aclose()
+
+        if cache_query is not None and response_str.strip():
+            answer_cache.set(cache_query, response_str)
 
         if response_str.strip() == "":
             await send_chan.send(
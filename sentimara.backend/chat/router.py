@@ -0,0 +1,152 @@
+"""
+Routing of user messages to the agents of the concierge workflow, in front of its orchestrator.
+
+The orchestrator picks the agent with a whole LLM round-trip. The router picks it without one whenever it can: a
+single agent is picked right away; otherwise the message is compared with the descriptions of the agents, by the
+cosine similarity of their embeddings, and the best agent is picked when it wins by a clear margin. Keyword overlap
+only stands in for the embeddings when the embedding model is unavailable. Whenever the router is not confident, the
+orchestrator LLM is asked.
+"""
+
+import logging
+import re
+from typing import Any, Dict, List, Mapping, Optional
+
+import numpy as np
+from llama_index.core.settings import Settings
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Keyword routing needs this many matching words, and the best agent this share of them more than the runner-up.
+MIN_KEYWORD_HITS = 2
+MIN_KEYWORD_MARGIN = 0.5
+
+_WORD_RE = re.compile(r"[a-z]{4,}")
+
+
+def _keywords(text: str) -> "set[str]":
+    return set(_WORD_RE.findall(text.lower()))
+
+
+class RouteDecision:
+    """The agent picked for a message, with how and how confidently it was picked."""
+
+    def __init__(self, agent_name: str, method: str, confidence: float):
+        self.agent_name = agent_name
+        self.method = method
+        self.confidence = confidence
+
+
+class AgentRouter:
+    """
+    Picks the agent of a message from the agent descriptions. The embeddings of the descriptions are computed once
+    and cached by description.
+    """
+
+    def __init__(self, min_similarity: float, min_margin: float):
+        self._min_similarity = min_similarity
+        self._min_margin = min_margin
+        # agent description -> normalized embedding
+        self._description_embeddings: Dict[str, np.ndarray] = {}
+        self.routed: Dict[str, int] = {"single": 0, "embedding": 0, "keyword": 0}
+        self.fallbacks = 0
+
+    async def aroute(
+        self, user_msg: str, agent_configs: Mapping[str, Any]
+    ) -> Optional[RouteDecision]:
+        """
+        Returns the agent to transfer the message to, or None if the orchestrator must decide.
+
+        Parameters:
+        user_msg (str): The message of the user.
+        agent_configs (Mapping[str, AgentConfig]): The agent configs of the workflow, by agent name.
+        """
+        decision = None
+        if len(agent_configs) == 1:
+            decision = RouteDecision(next(iter(agent_configs)), "single", 1.0)
+        elif agent_configs:
+            similarities = await self._asimilarities(user_msg, agent_configs)
+            if similarities is not None:
+                decision = self._route_by_similarity(similarities, list(agent_configs))
+            else:
+                decision = self._route_by_keywords(user_msg, agent_configs)
+
+        if decision is None:
+            self.fallbacks += 1
+            return None
+        self.routed[decision.method] += 1
+        logger.info(
+            "Routed message to %s by %s (confidence %.3f)",
+            decision.agent_name,
+            decision.method,
+            decision.confidence,
+        )
+        return decision
+
+    async def _aembed_descriptions(self, descriptions: List[str]) -> np.ndarray:
+        missing = [d for d in descriptions if d not in self._description_embeddings]
+        if missing:
+            embeddings = await Settings.embed_model.aget_text_embedding_batch(missing)
+            for description, embedding in zip(missing, embeddings):
+                vector = np.asarray(embedding, dtype=np.float32)
+                norm = np.linalg.norm(vector)
+                self._description_embeddings[description] = vector / norm if norm else vector
+        return np.stack([self._description_embeddings[d] for d in descriptions])
+
+    async def _asimilarities(
+        self, user_msg: str, agent_configs: Mapping[str, Any]
+    ) -> Optional[np.ndarray]:
+        """Returns the similarity of the message to each agent description, or None if they cannot be embedded."""
+        try:
+            descriptions = await self._aembed_descriptions(
+                [config.description for config in agent_configs.values()]
+            )
+            embedding = await Settings.embed_model.aget_query_embedding(user_msg)
+        except Exception:
+            logger.warning("Could not embed message for routing", exc_info=True)
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return descriptions @ (vector / norm if norm else vector)
+
+    def _route_by_similarity(
+        self, similarities: np.ndarray, names: List[str]
+    ) -> Optional[RouteDecision]:
+        ranking = np.argsort(similarities)[::-1]
+        best, runner_up = similarities[ranking[0]], similarities[ranking[1]]
+        if best < self._min_similarity or best - runner_up < self._min_margin:
+            return None
+        return RouteDecision(names[int(ranking[0])], "embedding", float(best - runner_up))
+
+    def _route_by_keywords(
+        self, user_msg: str, agent_configs: Mapping[str, Any]
+    ) -> Optional[RouteDecision]:
+        words = _keywords(user_msg)
+        hits = sorted(
+            (
+                (len(words & _keywords(f"{name} {config.description}")), name)
+                for name, config in agent_configs.items()
+            ),
+            reverse=True,
+        )
+        (best, name), (runner_up, _) = hits[0], hits[1]
+        if best < MIN_KEYWORD_HITS or (best - runner_up) / best < MIN_KEYWORD_MARGIN:
+            return None
+        return RouteDecision(name, "keyword", (best - runner_up) / best)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the counters of the router."""
+        return {
+            "min_similarity": self._min_similarity,
+            "min_margin": self._min_margin,
+            "routed": dict(self.routed),
+            "orchestrator_fallbacks": self.fallbacks,
+        }
+
+
+agent_router = AgentRouter(
+    min_similarity=settings.AGENT_ROUTER_MIN_SIMILARITY,
+    min_margin=settings.AGENT_ROUTER_MIN_MARGIN,
+)
@@ -0,0 +1,75 @@
+"""
+On-disk cache for the embeddings of the table-schema nodes indexed by `table_index_builder`.
+
+Every worker used to re-embed each SQLTableSchema context string through the embedding API on
+startup. The embeddings are now persisted as small JSON files keyed by a hash of the table name,
+its context string, the exact text sent to the embedding model and the embedding model/dimension,
+so a restart only re-embeds the tables whose entry in `table_context_dict` (or reflected schema)
+actually changed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from typing import List, Optional
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TableIndexCache:
+    """
+    A directory of `<key>.json` files, each holding the embedding of one table-schema node.
+
+    Writes go through a temporary file and `os.replace` so concurrent gunicorn workers never read
+    a partially written entry.
+    """
+
+    def __init__(self, cache_dir: str):
+        self._cache_dir = cache_dir
+
+    @staticmethod
+    def build_key(
+        table_name: str,
+        context_str: str,
+        embed_text: str,
+        embed_model_name: str,
+        embed_dim: Optional[str],
+    ) -> str:
+        """Returns a stable hash identifying the embedding of a table-schema node."""
+        payload = json.dumps(
+            [table_name, context_str, embed_text, embed_model_name, str(embed_dim)],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[List[float]]:
+        """Returns the cached embedding for the key, or None on a miss or unreadable entry."""
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)["embedding"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            logger.warning("Ignoring corrupt table index cache entry %s", key, exc_info=True)
+            return None
+
+    def put(self, key: str, table_name: str, embedding: List[float]) -> None:
+        """Persists the embedding for the key. Failures are logged and otherwise ignored."""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"table_name": table_name, "embedding": embedding}, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.warning("Could not write table index cache entry %s", key, exc_info=True)
+
+
+table_index_cache = TableIndexCache(settings.TABLE_INDEX_CACHE_DIR)
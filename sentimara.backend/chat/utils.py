@@ -18,6 +18,7 @@ and support decision-making in compliance, auditing, and investigation workflows
 """
 
 
+import re
 from typing import List
 from schema import TableInfo
 from inspect import signature
@@ -42,6 +43,11 @@ tables_list = [
 ]
 
 
+def normalize_question(question: str) -> str:
+    """Lowercases the question, collapses its whitespace and strips trailing punctuation."""
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").lower()
+
+
 def create_schema_from_function(
     name: str,
     func: Union[Callable[..., Any], Callable[..., Awaitable[Any]]],
@@ -1,7 +1,7 @@
 from typing import Any
 from pydantic import BaseModel, ConfigDict, Field
 from chat.core.settings import CustomSettings
-from llama_index.core.llms import ChatMessage, LLM
+from llama_index.core.llms import ChatMessage, ChatResponse, LLM
 from llama_index.core.program.function_program import get_function_tool
 from llama_index.core.tools import (
     BaseTool,
@@ -17,6 +17,10 @@ from llama_index.core.workflow import (
 )
 from llama_index.core.workflow.events import InputRequiredEvent, HumanResponseEvent
 
+from core.config import settings
+
+from .concurrency import concurrency_governor
+from .router import agent_router
 from .utils import FunctionToolWithContext
 
 
@@ -59,8 +63,9 @@ class OrchestratorEvent(Event):
 
 
 class ToolCallEvent(Event):
+    # the tools are looked up from the agent that made the call, by name, so that the event can be checkpointed
     tool_call: ToolSelection
-    tools: list[BaseTool]
+    agent_name: str
 
 
 class ToolCallResultEvent(Event):
@@ -71,12 +76,14 @@ class ToolRequestEvent(InputRequiredEvent):
     tool_name: str
     tool_id: str
     tool_kwargs: dict
+    agent_name: str
 
 
 class ToolApprovedEvent(HumanResponseEvent):
     tool_name: str
     tool_id: str
     tool_kwargs: dict
+    agent_name: str
     approved: bool
     response: str | None = None
 
@@ -85,6 +92,14 @@ class ProgressEvent(Event):
     msg: str
 
 
+class AnswerDeltaEvent(Event):
+    """Tokens of the answer being generated, streamed before the StopEvent that carries the whole answer."""
+
+    delta: str
+    # the text streamed so far is not the answer (the LLM went on with a tool call) and must be discarded
+    reset: bool = False
+
+
 # ---- Workflow ----
 
 DEFAULT_ORCHESTRATOR_PROMPT = (
@@ -113,15 +128,48 @@ class ConciergeAgent(Workflow):
             default_tool_reject_str or DEFAULT_TOOL_REJECT_STR
         )
 
+    async def achat_with_tools_streaming(
+        self,
+        ctx: Context,
+        llm: LLM,
+        tools: list[BaseTool],
+        llm_input: list[ChatMessage],
+    ) -> ChatResponse:
+        """
+        Streams the LLM response, writing the content tokens to the event stream as they arrive.
+        Returns the final response, with its tool calls if any.
+        """
+        response: ChatResponse | None = None
+        streamed = False
+        async for response in await llm.astream_chat_with_tools(
+            tools, chat_history=llm_input
+        ):
+            if response.delta:
+                ctx.write_event_to_stream(AnswerDeltaEvent(delta=response.delta))
+                streamed = True
+
+        if response is None:
+            raise ValueError("LLM returned an empty stream")
+
+        if streamed and llm.get_tool_calls_from_response(
+            response, error_on_no_tool_call=False
+        ):
+            ctx.write_event_to_stream(AnswerDeltaEvent(delta="", reset=True))
+        return response
+
     @step
     async def setup(
         self, ctx: Context, ev: StartEvent
     ) -> ActiveSpeakerEvent | OrchestratorEvent:
         """Sets up the workflow, validates inputs, and stores them in the context."""
-        active_speaker = await ctx.get("active_speaker", default="")
+        # the active speaker of the previous turn, persisted with the conversation
+        active_speaker = ev.get("active_speaker") or await ctx.get(
+            "active_speaker", default=""
+        )
         user_msg = ev.get("user_msg")
         agent_configs = ev.get("agent_configs", default=[])
-        llm: LLM = ev.get("llm", default=CustomSettings.llm)
+        # the default LLM is only resolved when none is given
+        llm: LLM = ev.get("llm") or CustomSettings.llm
         # llm = CustomSettings.llm
         chat_history = ev.get("chat_history", default=[])
         initial_state = ev.get("initial_state", default={})
@@ -148,11 +196,24 @@ class ConciergeAgent(Workflow):
 
         await ctx.set("user_state", initial_state)
 
+        if active_speaker not in agent_configs_dict:
+            # the agent may not exist anymore
+            active_speaker = ""
+        await ctx.set("active_speaker", active_speaker)
+
         # if there is an active speaker, we need to transfer forward the user to them
         if active_speaker:
             return ActiveSpeakerEvent()
 
-        # otherwise, we need to decide who the next active speaker is
+        # otherwise, we need to decide who the next active speaker is, without the orchestrator if possible
+        decision = await agent_router.aroute(user_msg, agent_configs_dict)
+        if decision is not None:
+            await ctx.set("active_speaker", decision.agent_name)
+            ctx.write_event_to_stream(
+                ProgressEvent(msg=f"Transferring to agent {decision.agent_name}")
+            )
+            return ActiveSpeakerEvent()
+
         return OrchestratorEvent(user_msg=user_msg)
 
     @step
@@ -179,7 +240,7 @@ class ConciergeAgent(Workflow):
         # inject the request transfer tool into the list of tools
         tools = [get_function_tool(RequestTransfer)] + agent_config.tools
 
-        response = await llm.achat_with_tools(tools, chat_history=llm_input)
+        response = await self.achat_with_tools_streaming(ctx, llm, tools, llm_input)
 
         tool_calls: list[ToolSelection] = llm.get_tool_calls_from_response(
             response, error_on_no_tool_call=False
@@ -194,15 +255,29 @@ class ConciergeAgent(Workflow):
                 }
             )
 
+        if all(tool_call.tool_name == "RequestTransfer" for tool_call in tool_calls):
+            await ctx.set("active_speaker", None)
+            ctx.write_event_to_stream(
+                ProgressEvent(msg="Agent is requesting a transfer. Please hold.")
+            )
+            return OrchestratorEvent()
+
+        # a transfer requested along with other tool calls happens once their results are in
         await ctx.set("num_tool_calls", len(tool_calls))
+        await ctx.set("transfer_requested", False)
 
         for tool_call in tool_calls:
             if tool_call.tool_name == "RequestTransfer":
-                await ctx.set("active_speaker", None)
-                ctx.write_event_to_stream(
-                    ProgressEvent(msg="Agent is requesting a transfer. Please hold.")
+                await ctx.set("transfer_requested", True)
+                ctx.send_event(
+                    ToolCallResultEvent(
+                        chat_message=ChatMessage(
+                            role="tool",
+                            content="The transfer will happen once the other tool calls are done.",
+                            additional_kwargs={"tool_call_id": tool_call.tool_id},
+                        )
+                    )
                 )
-                return OrchestratorEvent()
             elif tool_call.tool_name in agent_config.tools_requiring_human_confirmation:
                 ctx.write_event_to_stream(
                     ToolRequestEvent(
@@ -210,11 +285,12 @@ class ConciergeAgent(Workflow):
                         tool_name=tool_call.tool_name,
                         tool_kwargs=tool_call.tool_kwargs,
                         tool_id=tool_call.tool_id,
+                        agent_name=active_speaker,
                     )
                 )
             else:
                 ctx.send_event(
-                    ToolCallEvent(tool_call=tool_call, tools=agent_config.tools)
+                    ToolCallEvent(tool_call=tool_call, agent_name=active_speaker)
                 )
 
         chat_history.append(response.message)
@@ -226,15 +302,13 @@ class ConciergeAgent(Workflow):
     ) -> ToolCallEvent | ToolCallResultEvent:
         """Handles the approval or rejection of a tool call."""
         if ev.approved:
-            active_speaker = await ctx.get("active_speaker")
-            agent_config = (await ctx.get("agent_configs"))[active_speaker]
             return ToolCallEvent(
-                tools=agent_config.tools,
                 tool_call=ToolSelection(
                     tool_id=ev.tool_id,
                     tool_name=ev.tool_name,
                     tool_kwargs=ev.tool_kwargs,
                 ),
+                agent_name=ev.agent_name,
             )
         else:
             return ToolCallResultEvent(
@@ -245,33 +319,36 @@ class ConciergeAgent(Workflow):
                 )
             )
 
-    @step(num_workers=4)
+    @step(num_workers=settings.TOOL_CALL_MAX_WORKERS)
     async def handle_tool_call(
         self, ctx: Context, ev: ToolCallEvent
     ) -> ActiveSpeakerEvent:
         """Handles the execution of a tool call."""
         tool_call = ev.tool_call
-        tools_by_name = {tool.metadata.get_name(): tool for tool in ev.tools}
-
-        tool_msg = None
+        # the active speaker may have changed since the call was made
+        agent_config: AgentConfig = (await ctx.get("agent_configs"))[ev.agent_name]
+        tools_by_name = {tool.metadata.get_name(): tool for tool in agent_config.tools}
 
         tool = tools_by_name.get(tool_call.tool_name)
         additional_kwargs = {
             "tool_call_id": tool_call.tool_id,
-            "name": tool.metadata.get_name(),
+            "name": tool_call.tool_name,
         }
         if not tool:
-            tool_msg = ChatMessage(
-                role="tool",
-                content=f"Tool {tool_call.tool_name} does not exist",
-                additional_kwargs=additional_kwargs,
+            return ToolCallResultEvent(
+                chat_message=ChatMessage(
+                    role="tool",
+                    content=f"Tool {tool_call.tool_name} does not exist",
+                    additional_kwargs=additional_kwargs,
+                )
             )
 
         try:
-            if isinstance(tool, FunctionToolWithContext):
-                tool_output = await tool.acall(ctx, **tool_call.tool_kwargs)
-            else:
-                tool_output = await tool.acall(**tool_call.tool_kwargs)
+            async with concurrency_governor.tool_call(tool_call.tool_name):
+                if isinstance(tool, FunctionToolWithContext):
+                    tool_output = await tool.acall(ctx, **tool_call.tool_kwargs)
+                else:
+                    tool_output = await tool.acall(**tool_call.tool_kwargs)
 
             tool_msg = ChatMessage(
                 role="tool",
@@ -296,7 +373,7 @@ class ConciergeAgent(Workflow):
     @step
     async def aggregate_tool_results(
         self, ctx: Context, ev: ToolCallResultEvent
-    ) -> ActiveSpeakerEvent:
+    ) -> ActiveSpeakerEvent | OrchestratorEvent:
         """Collects the results of all tool calls and updates the chat history."""
         num_tool_calls = await ctx.get("num_tool_calls")
         results = ctx.collect_events(ev, [ToolCallResultEvent] * num_tool_calls)
@@ -308,6 +385,14 @@ class ConciergeAgent(Workflow):
             chat_history.append(result.chat_message)
         await ctx.set("chat_history", chat_history)
 
+        if await ctx.get("transfer_requested", default=False):
+            await ctx.set("transfer_requested", False)
+            await ctx.set("active_speaker", None)
+            ctx.write_event_to_stream(
+                ProgressEvent(msg="Agent is requesting a transfer. Please hold.")
+            )
+            return OrchestratorEvent()
+
         return ActiveSpeakerEvent()
 
     @step
@@ -333,7 +418,7 @@ class ConciergeAgent(Workflow):
         # convert the TransferToAgent pydantic model to a tool
         tools = [get_function_tool(TransferToAgent)]
 
-        response = await llm.achat_with_tools(tools, chat_history=llm_input)
+        response = await self.achat_with_tools_streaming(ctx, llm, tools, llm_input)
         tool_calls = llm.get_tool_calls_from_response(
             response, error_on_no_tool_call=False
         )
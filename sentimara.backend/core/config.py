@@ -83,6 +83,84 @@ class Settings(PreviewPrefixedSettings):
     # Dimension of the embedding model to use.
     EMBEDDING_DIM: str = "1536"
     LLM_MAX_TOKENS: str = "16384"
+    # Directory where the embeddings of the table-schema index are persisted between restarts.
+    TABLE_INDEX_CACHE_DIR: str = os.getenv("TABLE_INDEX_CACHE_DIR", ".cache/table_index")
+    # Number of threads (and pooled DB connections) running the SQL generated by the query engines.
+    SQL_EXECUTOR_MAX_WORKERS: int = int(os.getenv("SQL_EXECUTOR_MAX_WORKERS", "4"))
+    # Number of headlines memoized by normalized first question.
+    HEADLINE_CACHE_SIZE: int = int(os.getenv("HEADLINE_CACHE_SIZE", "1024"))
+    # Question-to-SQL translation cache of the text-to-SQL engines (TTL in seconds, 0 disables expiry).
+    TEXT_TO_SQL_CACHE_SIZE: int = int(os.getenv("TEXT_TO_SQL_CACHE_SIZE", "512"))
+    TEXT_TO_SQL_CACHE_TTL: int = int(os.getenv("TEXT_TO_SQL_CACHE_TTL", "86400"))
+    # Result cache of the generated SQL, invalidated when the version of a data table moves.
+    SQL_RESULT_CACHE_SIZE: int = int(os.getenv("SQL_RESULT_CACHE_SIZE", "256"))
+    SQL_RESULT_CACHE_TTL: int = int(os.getenv("SQL_RESULT_CACHE_TTL", "3600"))
+    SQL_RESULT_CACHE_MAX_ROWS: int = int(os.getenv("SQL_RESULT_CACHE_MAX_ROWS", "1000"))
+    # How often (in seconds) the versions of the data tables are re-read.
+    SQL_RESULT_CACHE_VERSION_INTERVAL: int = int(
+        os.getenv("SQL_RESULT_CACHE_VERSION_INTERVAL", "30")
+    )
+    # Semantic answer cache in front of the chat workflow (TTL in seconds, size 0 disables it).
+    ANSWER_CACHE_SIZE: int = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+    ANSWER_CACHE_TTL: int = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+    ANSWER_CACHE_SIMILARITY_THRESHOLD: float = float(
+        os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.95")
+    )
+    # Number of most recent successful messages loaded to build the chat history.
+    CHAT_HISTORY_WINDOW: int = int(os.getenv("CHAT_HISTORY_WINDOW", "20"))
+    # Maximum number of messages older than the window folded into the history summary per chat turn.
+    CHAT_HISTORY_FOLD_LIMIT: int = int(os.getenv("CHAT_HISTORY_FOLD_LIMIT", "50"))
+    # Number of tokens of the history summary and verbatim messages handed to the agents beyond which the older
+    # messages are folded into the summary.
+    CHAT_HISTORY_TOKEN_BUDGET: int = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "4000"))
+    # Maximum number of callback events buffered per chat request, and seconds between two flushes to the stream.
+    CALLBACK_EVENT_QUEUE_SIZE: int = int(os.getenv("CALLBACK_EVENT_QUEUE_SIZE", "256"))
+    CALLBACK_EVENT_FLUSH_INTERVAL: float = float(
+        os.getenv("CALLBACK_EVENT_FLUSH_INTERVAL", "0.05")
+    )
+    # Number of SSE events kept per generation for clients resuming with Last-Event-ID, and seconds a finished
+    # generation stays available to them.
+    STREAM_REPLAY_BUFFER_SIZE: int = int(os.getenv("STREAM_REPLAY_BUFFER_SIZE", "512"))
+    STREAM_RETENTION_SECONDS: int = int(os.getenv("STREAM_RETENTION_SECONDS", "120"))
+    # Clients resuming a generation of another worker follow its message in the database: seconds between two reads,
+    # and seconds without any change to the message after which the stream ends.
+    STREAM_FOLLOW_POLL_INTERVAL: float = float(os.getenv("STREAM_FOLLOW_POLL_INTERVAL", "1.0"))
+    STREAM_FOLLOW_IDLE_TIMEOUT: int = int(os.getenv("STREAM_FOLLOW_IDLE_TIMEOUT", "300"))
+    # Number of messages generated at the same time by a worker; further jobs wait for a slot.
+    GENERATION_MAX_RUNNING: int = int(os.getenv("GENERATION_MAX_RUNNING", "16"))
+    # Seconds a streamed generation keeps running without any client before it is cancelled (negative disables).
+    GENERATION_ABANDON_GRACE_SECONDS: int = int(
+        os.getenv("GENERATION_ABANDON_GRACE_SECONDS", "15")
+    )
+    # Seconds between two checkpoints of a message being generated to the database (0 only writes its start and end).
+    MESSAGE_CHECKPOINT_INTERVAL: float = float(
+        os.getenv("MESSAGE_CHECKPOINT_INTERVAL", "2.0")
+    )
+    # Agent routing without the orchestrator LLM: minimum cosine similarity of the best agent description to the
+    # message, and minimum lead over the runner-up; below either, the orchestrator LLM picks the agent.
+    AGENT_ROUTER_MIN_SIMILARITY: float = float(
+        os.getenv("AGENT_ROUTER_MIN_SIMILARITY", "0.3")
+    )
+    AGENT_ROUTER_MIN_MARGIN: float = float(os.getenv("AGENT_ROUTER_MIN_MARGIN", "0.05"))
+    # Where the workflow contexts are checkpointed after each step to be resumed by any worker: "postgres", "disk"
+    # (in WORKFLOW_CHECKPOINT_DIR, shared by the workers) or "" to disable the checkpoints.
+    WORKFLOW_CHECKPOINT_STORE: str = os.getenv("WORKFLOW_CHECKPOINT_STORE", "postgres")
+    WORKFLOW_CHECKPOINT_DIR: str = os.getenv(
+        "WORKFLOW_CHECKPOINT_DIR", "/tmp/workflow_checkpoints"
+    )
+    # Number of tool calls of a chat turn run in parallel by its workflow.
+    TOOL_CALL_MAX_WORKERS: int = int(os.getenv("TOOL_CALL_MAX_WORKERS", "4"))
+    # Concurrency limits of a worker (0 disables a limit): tool calls of all chat turns, calls of each tool and
+    # requests to each LLM provider ("openai", "azure_openai", "anthropic"), overridden per name with
+    # "name=limit,...", and sub questions run at the same time.
+    CONCURRENCY_MAX_TOOL_CALLS: int = int(os.getenv("CONCURRENCY_MAX_TOOL_CALLS", "16"))
+    CONCURRENCY_TOOL_LIMIT: int = int(os.getenv("CONCURRENCY_TOOL_LIMIT", "8"))
+    CONCURRENCY_TOOL_LIMITS: str = os.getenv("CONCURRENCY_TOOL_LIMITS", "")
+    CONCURRENCY_PROVIDER_LIMIT: int = int(os.getenv("CONCURRENCY_PROVIDER_LIMIT", "16"))
+    CONCURRENCY_PROVIDER_LIMITS: str = os.getenv("CONCURRENCY_PROVIDER_LIMITS", "")
+    CONCURRENCY_SUB_QUESTION_LIMIT: int = int(
+        os.getenv("CONCURRENCY_SUB_QUESTION_LIMIT", "8")
+    )
     BACKEND_CORS_ORIGINS: List[AnyHttpUrl] = [
         "https://survey.info4pi.org",
         "http://localhost:3000",
@@ -0,0 +1,204 @@
+"""
+This module provides a bounded, dedicated thread pool for running the SQL generated by the text-to-SQL query engines.
+
+The generated SQL is executed with a synchronous SQLAlchemy engine, so running it on the event loop thread stalls every
+other request of the worker. The SQLExecutor runs it on its own threads, with its own connection pool sized to the
+number of threads, and keeps track of the queue depth and execution time of each query.
+
+When the coroutine waiting for a query is cancelled (e.g. the client of the chat request went away), the query is
+skipped if it has not started yet, and otherwise cancelled on the Postgres side with pg_cancel_backend, so abandoned
+requests do not keep the database busy.
+"""
+
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+
+from core.config import settings
+from core.db_config import LLM_DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class RunningQuery:
+    """The Postgres backend running a query submitted to the executor, if it has started."""
+
+    def __init__(self) -> None:
+        self.backend_pid: Optional[int] = None
+        self.cancelled = False
+
+
+# the query submitted by the current context, set within the executor threads
+current_query: contextvars.ContextVar[Optional[RunningQuery]] = contextvars.ContextVar(
+    "current_query", default=None
+)
+
+
+class SQLExecutor:
+    """
+    Runs blocking SQL work on a bounded thread pool and reports queue depth and execution time.
+    """
+
+    def __init__(self, max_workers: int, cancel_engine: Optional[Engine] = None):
+        self._max_workers = max_workers
+        self._cancel_engine = cancel_engine
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="sql-executor"
+        )
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._executed = 0
+        self._failed = 0
+        self._cancelled = 0
+        self._cancelled_running = 0
+        self._total_execution_time = 0.0
+        self._max_execution_time = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of submitted queries that are waiting for a free thread."""
+        return self._queued
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the counters of the executor."""
+        with self._lock:
+            executed = self._executed + self._failed
+            return {
+                "max_workers": self._max_workers,
+                "queue_depth": self._queued,
+                "running": self._running,
+                "executed": self._executed,
+                "failed": self._failed,
+                # queries skipped before they started, and queries cancelled on the database while running
+                "cancelled": self._cancelled,
+                "cancelled_running": self._cancelled_running,
+                "avg_execution_time": (
+                    self._total_execution_time / executed if executed else 0.0
+                ),
+                "max_execution_time": self._max_execution_time,
+            }
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """
+        Runs `fn(*args)` on the executor and waits for its result without blocking the event loop.
+
+        The current context is propagated to the thread, like `asyncio.to_thread` does. If the caller is cancelled,
+        the query is skipped or cancelled on the database.
+        """
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        query = RunningQuery()
+        ctx.run(current_query.set, query)
+        submitted_at = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+            queue_depth = self._queued
+
+        def _run() -> T:
+            started_at = time.perf_counter()
+            with self._lock:
+                self._queued -= 1
+                if query.cancelled:
+                    self._cancelled += 1
+                    raise asyncio.CancelledError()
+                self._running += 1
+            failed = False
+            try:
+                return ctx.run(fn, *args)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                execution_time = time.perf_counter() - started_at
+                with self._lock:
+                    self._running -= 1
+                    if failed:
+                        self._failed += 1
+                    else:
+                        self._executed += 1
+                    self._total_execution_time += execution_time
+                    self._max_execution_time = max(
+                        self._max_execution_time, execution_time
+                    )
+                logger.info(
+                    "SQL query %s in %.3fs (waited %.3fs, queue depth %d)",
+                    "failed" if failed else "executed",
+                    execution_time,
+                    started_at - submitted_at,
+                    queue_depth,
+                )
+
+        try:
+            return await loop.run_in_executor(self._executor, _run)
+        except asyncio.CancelledError:
+            with self._lock:
+                query.cancelled = True
+                backend_pid = query.backend_pid
+            if backend_pid is not None:
+                loop.run_in_executor(None, self._cancel_backend, backend_pid)
+            raise
+
+    def _cancel_backend(self, backend_pid: int) -> None:
+        if self._cancel_engine is None:
+            return
+        try:
+            with self._cancel_engine.connect() as connection:
+                connection.execute(
+                    text("SELECT pg_cancel_backend(:pid)"), {"pid": backend_pid}
+                )
+            with self._lock:
+                self._cancelled_running += 1
+            logger.info("Cancelled SQL query of backend %d", backend_pid)
+        except Exception:
+            logger.warning(
+                "Could not cancel SQL query of backend %d", backend_pid, exc_info=True
+            )
+
+    def shutdown(self) -> None:
+        """Stops accepting queries and releases the threads."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Dedicated connection pool for the generated SQL, one connection per executor thread
+sql_executor_engine = create_engine(
+    LLM_DATABASE_URL,
+    pool_pre_ping=True,
+    pool_size=settings.SQL_EXECUTOR_MAX_WORKERS,
+    max_overflow=0,
+    pool_recycle=3600,
+)
+
+
+
+@event.listens_for(sql_executor_engine, "before_cursor_execute")
+def _track_backend_pid(connection, cursor, statement, parameters, context, executemany):
+    query = current_query.get()
+    if query is not None:
+        query.backend_pid = connection.connection.dbapi_connection.get_backend_pid()
+
+
+@event.listens_for(sql_executor_engine, "after_cursor_execute")
+def _untrack_backend_pid(connection, cursor, statement, parameters, context, executemany):
+    query = current_query.get()
+    if query is not None:
+        # the pooled connection may run another query next, it must not be cancelled
+        query.backend_pid = None
+
+
+# Unpooled connections to issue pg_cancel_backend, since the executor pool may be exhausted by the query to cancel
+sql_cancel_engine = create_engine(LLM_DATABASE_URL, poolclass=NullPool)
+
+sql_executor = SQLExecutor(
+    max_workers=settings.SQL_EXECUTOR_MAX_WORKERS, cancel_engine=sql_cancel_engine
+)
@@ -0,0 +1,70 @@
+"""
+This module tracks a version per data table, used to invalidate the caches built on top of their content.
+
+The version of a table is its row in the `tableversion` table, incremented by a statement-level trigger on every
+statement writing to the table, whichever worker or process runs it, deletes and truncates included. The versions are
+re-read by primary key at most every `refresh_interval` seconds, so every worker sees a write within that interval;
+the worker that wrote re-reads them right away with `expire`.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+
+from libs.db.sql_executor import sql_executor
+from libs.models.chatdb import TableVersion
+
+logger = logging.getLogger(__name__)
+
+TableVersions = Tuple[Tuple[str, int], ...]
+
+
+class TableVersionTracker:
+    """
+    Keeps the versions of a fixed set of tables.
+    """
+
+    def __init__(self, engine: Engine, table_names: List[str], refresh_interval: float):
+        self._engine = engine
+        self._table_names = sorted(table_names)
+        self._refresh_interval = refresh_interval
+        self._versions: Dict[str, int] = {}
+        self._refreshed_at = float("-inf")
+        self._refresh_lock: Optional[asyncio.Lock] = None
+
+    def _is_fresh(self) -> bool:
+        return time.monotonic() - self._refreshed_at < self._refresh_interval
+
+    def refresh(self) -> None:
+        """Re-reads the version of every table. Blocking; run it on the SQL executor."""
+        stmt = select(TableVersion.table_name, TableVersion.version).where(
+            TableVersion.table_name.in_(self._table_names)
+        )
+        with self._engine.connect() as connection:
+            versions = dict(connection.execute(stmt).all())
+        for table_name in self._table_names:
+            if table_name not in versions:
+                # without a version row, the writes to the table cannot be noticed
+                raise LookupError(f"Table {table_name} has no version row")
+        self._versions = versions
+        self._refreshed_at = time.monotonic()
+
+    async def aget_versions(self) -> TableVersions:
+        """Returns the current version of every table, re-reading them when they are stale."""
+        if not self._is_fresh():
+            if self._refresh_lock is None:
+                self._refresh_lock = asyncio.Lock()
+            async with self._refresh_lock:
+                if not self._is_fresh():
+                    await sql_executor.run(self.refresh)
+        return tuple(
+            (table_name, self._versions[table_name]) for table_name in self._table_names
+        )
+
+    def expire(self) -> None:
+        """Re-reads the versions on the next call to `aget_versions`, e.g. right after the worker wrote to the tables."""
+        self._refreshed_at = float("-inf")
@@ -2,7 +2,7 @@ from enum import Enum
 from sqlalchemy import Column, DateTime, Numeric
 from datetime import datetime
 from llama_index.core.callbacks.schema import CBEventType
-from sqlalchemy import Boolean, Column, Float, ForeignKey, String
+from sqlalchemy import BigInteger, Boolean, Column, Float, ForeignKey, String
 from sqlalchemy.dialects.postgresql import ENUM, JSONB, UUID
 from sqlalchemy.orm import relationship
 
@@ -62,6 +62,12 @@ class Conversation(Base):
     """
 
     headline = Column(String, nullable=True, unique=False)
+    # rolling summary of the messages older than history_summary_until, used to bound the chat history
+    history_summary = Column(String, nullable=True)
+    history_summary_until = Column(DateTime, nullable=True)
+    # agent the workflow last transferred the user to, and user state of the workflow, restored on the next turn
+    active_speaker = Column(String, nullable=True)
+    user_state = Column(JSONB, nullable=True)
     messages = relationship("Message", back_populates="conversation")
     conversation_documents = relationship(
         "ConversationDocument", back_populates="conversation"
@@ -125,6 +131,25 @@ class HumanFeedback(Base):
     Thread_id = Column(UUID(as_uuid=True))
 
 
+class WorkflowCheckpoint(Base):
+    """
+    The serialized context of the workflow generating a message, saved after each of its steps to resume it
+    """
+
+    message_id = Column(
+        UUID(as_uuid=True), ForeignKey("message.id"), index=True, unique=True
+    )
+    state = Column(JSONB, nullable=False)
+
+
+class TableVersion(Base):
+    """
+    The version of a data table, incremented by a trigger on every statement writing to it
+    """
+
+    table_name = Column(String, index=True, unique=True, nullable=False)
+    version = Column(BigInteger, nullable=False, server_default="0")
+
 
 class Client(Base):
     __tablename__ = "clients"
@@ -108,6 +108,82 @@ class Message(Base):
     sub_processes: List[MessageSubProcess]
 
 
+class StreamModeEnum(str, Enum):
+    """
+    How the assistant message is streamed over SSE
+    """
+
+    # every event is the full Message
+    FULL = "full"
+    # every event is a MessageDelta, the full Message is only sent once completed
+    DELTA = "delta"
+
+
+class MessageDeltaTypeEnum(str, Enum):
+    CONTENT = "content"
+    SUB_PROCESS = "sub_process"
+    STATUS = "status"
+
+
+class SubProcessDelta(BaseModel):
+    # id of the callback event that the sub process stems from, stable across its updates
+    event_id: str
+    source: MessageSubProcessSourceEnum
+    status: MessageSubProcessStatusEnum
+    metadata_map: Optional[SubProcessMetadataMap] = None
+
+
+class MessageDelta(BaseModel):
+    """
+    A change to the assistant message being streamed, applied in `seq` order
+    """
+
+    seq: int
+    message_id: UUID
+    type: MessageDeltaTypeEnum
+    # CONTENT: text appended to the content, or the whole content when `replace` is set
+    content: Optional[str] = None
+    replace: bool = False
+    # SUB_PROCESS: the new or updated sub process
+    sub_process: Optional[SubProcessDelta] = None
+    # STATUS: the new status of the message
+    status: Optional[MessageStatusEnum] = None
+
+
+class MessageJobCreate(BaseModel):
+    user_message: str
+    temperature: float
+    # the assistant message to regenerate, if any
+    last_ai_message_id: Optional[UUID] = None
+    stream_mode: StreamModeEnum = StreamModeEnum.FULL
+
+
+class MessageJobResume(BaseModel):
+    stream_mode: StreamModeEnum = StreamModeEnum.FULL
+
+
+class MessageJob(BaseModel):
+    """
+    A background generation of an assistant message
+    """
+
+    message_id: UUID
+    conversation_id: UUID
+    status: MessageStatusEnum
+    # the current state of the message, once its generation has started
+    message: Optional[Message] = None
+
+
+class MessagePage(BaseModel):
+    """
+    A page of the messages of a conversation, in chronological order
+    """
+
+    messages: List[Message]
+    # position of the oldest message of the page, to fetch the previous page; None on the first message
+    next_cursor: Optional[str] = None
+
+
 class UserMessageCreate(BaseModel):
     content: str
 
@@ -129,10 +205,43 @@ class Document(Base):
 
 
 class Conversation(Base):
+    headline: Optional[str] = None
     messages: List[Message]
     documents: List[Document]
 
 
+class ChatConversation(Conversation):
+    """
+    A conversation as loaded by the chat path, with the internal state of its history summary and of its workflow,
+    which the API never returns
+    """
+
+    history_summary: Optional[str] = None
+    history_summary_until: Optional[datetime] = None
+    active_speaker: Optional[str] = None
+    user_state: Optional[Dict[str, Any]] = None
+    # the oldest messages newer than the summary but older than `messages`, to fold into the summary
+    messages_to_fold: List[Message] = []
+    # whether there are more such messages than `messages_to_fold`
+    more_to_fold: bool = False
+
+
+class HeadlineStatusEnum(str, Enum):
+    READY = "READY"
+    PENDING = "PENDING"
+    UNAVAILABLE = "UNAVAILABLE"
+
+
+class ConversationHeadline(BaseModel):
+    """
+    The headline of a conversation, which is generated in the background
+    """
+
+    conversation_id: UUID
+    headline: Optional[str] = None
+    status: HeadlineStatusEnum
+
+
 class ConversationCreate(BaseModel):
     # UUID
     document_ids: List[str]
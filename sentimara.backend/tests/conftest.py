@@ -0,0 +1,12 @@
+import os
+
+# The settings require the credentials of the LLM providers, which the unit tests never call
+for name in (
+    "OPENAI_API_KEY",
+    "AZURE_OPENAI_API_KEY",
+    "AZURE_OPENAI_ENDPOINT",
+    "AZURE_OPENAI_API_VERSION",
+    "AZURE_LLM_DEPLOYMENT_NAME",
+    "AZURE_EMBEDDING_DEPLOYMENT_NAME",
+):
+    os.environ.setdefault(name, "test")
@@ -0,0 +1,51 @@
+import pytest
+from llama_index.core.llms import ChatMessage, MockLLM
+from llama_index.core.tools import FunctionTool
+
+from chat.checkpoints import RUNTIME_OBJECT_KEY, WorkflowContextSerializer
+from chat.workflow import AgentConfig
+
+
+def lookup(client_id: str) -> str:
+    """Looks a client up."""
+    return client_id
+
+
+def agent_config() -> AgentConfig:
+    return AgentConfig(
+        name="Fraud Agent",
+        description="Detects fraud",
+        tools=[FunctionTool.from_defaults(fn=lookup)],
+    )
+
+
+def test_serializer_round_trips_a_context_with_runtime_objects():
+    config = agent_config()
+    llm = MockLLM()
+    state = {
+        "llm": MockLLM(),
+        "agent_config": config,
+        "tools": config.tools,
+        "chat_history": [ChatMessage(role="user", content="Any fraud?")],
+        "active_speaker": "Fraud Agent",
+    }
+
+    serialized = WorkflowContextSerializer().serialize(state)
+    assert serialized.count(RUNTIME_OBJECT_KEY) == 3
+
+    restored = WorkflowContextSerializer(llm=llm, agent_configs={config.name: config}).deserialize(serialized)
+    assert restored["llm"] is llm
+    assert restored["agent_config"] is config
+    assert restored["tools"][0] is config.tools[0]
+    assert restored["chat_history"] == state["chat_history"]
+    assert restored["active_speaker"] == "Fraud Agent"
+
+
+def test_serializer_rejects_unknown_runtime_objects():
+    serialized = WorkflowContextSerializer().serialize({"agent_config": agent_config()})
+    with pytest.raises(ValueError):
+        WorkflowContextSerializer(agent_configs={}).deserialize(serialized)
+
+    serialized = WorkflowContextSerializer().serialize({"tool": agent_config().tools[0]})
+    with pytest.raises(ValueError):
+        WorkflowContextSerializer(agent_configs={}).deserialize(serialized)
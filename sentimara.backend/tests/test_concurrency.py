@@ -0,0 +1,63 @@
+import asyncio
+
+import httpx
+
+from chat.concurrency import LimitedTransport, Limiter, parse_limits
+
+
+class SlowBody(httpx.AsyncByteStream):
+    """A streamed body, sent in two chunks."""
+
+    async def __aiter__(self):
+        yield b"a"
+        await asyncio.sleep(0.01)
+        yield b"b"
+
+    async def aclose(self):
+        pass
+
+
+def limited_client(limiter: Limiter) -> httpx.AsyncClient:
+    async def handler(request):
+        return httpx.Response(200, stream=SlowBody())
+
+    return httpx.AsyncClient(transport=LimitedTransport(limiter, httpx.MockTransport(handler)))
+
+
+def test_parse_limits():
+    assert parse_limits("openai=4, anthropic = 2") == {"openai": 4, "anthropic": 2}
+    assert parse_limits("") == {}
+    assert parse_limits("openai=,=3,anthropic=1") == {"anthropic": 1}
+
+
+def test_limited_transport_holds_a_slot_until_the_body_is_read():
+    async def run():
+        limiter = Limiter(1)
+        async with limited_client(limiter) as client:
+            responses = await asyncio.gather(*[client.get("http://provider/") for _ in range(3)])
+            assert [response.content for response in responses] == [b"ab"] * 3
+            assert limiter.acquired == 3
+            assert limiter.max_waiting == 2
+            assert limiter.in_use == 0
+
+            async with client.stream("GET", "http://provider/"):
+                assert limiter.in_use == 1
+            assert limiter.in_use == 0
+
+    asyncio.run(run())
+
+
+def test_limited_transport_releases_the_slot_on_errors():
+    async def run():
+        async def handler(request):
+            raise httpx.ConnectError("unreachable")
+
+        limiter = Limiter(1)
+        async with httpx.AsyncClient(transport=LimitedTransport(limiter, httpx.MockTransport(handler))) as client:
+            try:
+                await client.get("http://provider/")
+            except httpx.ConnectError:
+                pass
+        assert limiter.in_use == 0
+
+    asyncio.run(run())
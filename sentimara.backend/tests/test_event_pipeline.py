@@ -0,0 +1,54 @@
+import asyncio
+from types import SimpleNamespace
+
+import anyio
+
+from chat.event_pipeline import CallbackEventPipeline
+from libs.models.chatdb import MessageSubProcessSourceEnum
+
+
+def event(event_id, source=MessageSubProcessSourceEnum.QUERY, has_ended=False, metadata_map=None):
+    return SimpleNamespace(event_id=event_id, source=source, has_ended=has_ended, metadata_map=metadata_map)
+
+
+def run_pipeline(events, max_pending=256, flush_interval=0.01):
+    """Puts the events into a pipeline at once and returns the batches it sent."""
+
+    async def run():
+        send_chan, recv_chan = anyio.create_memory_object_stream(100)
+        pipeline = CallbackEventPipeline(send_chan, list, max_pending=max_pending, flush_interval=flush_interval)
+        pipeline.start()
+        for ev in events:
+            pipeline.put(ev)
+        await asyncio.sleep(0)
+        await pipeline.aclose()
+        send_chan.close()
+        return [batch async for batch in recv_chan]
+
+    return asyncio.run(run())
+
+
+def test_pipeline_merges_the_start_and_end_of_an_event():
+    batches = run_pipeline(
+        [event("a", metadata_map={"k": "v"}), event("b"), event("a", has_ended=True)]
+    )
+    assert len(batches) == 1
+    assert [(e.event_id, e.has_ended) for e in batches[0]] == [("a", True), ("b", False)]
+    # the end keeps the metadata of the start
+    assert batches[0][0].metadata_map == {"k": "v"}
+
+
+def test_pipeline_drops_low_value_events_when_full():
+    embedding = MessageSubProcessSourceEnum.EMBEDDING
+    batches = run_pipeline(
+        [event("e1", embedding), event("q1"), event("e2", embedding), event("q2")], max_pending=2
+    )
+    sent = [e.event_id for batch in batches for e in batch]
+    # e2 is dropped as the buffer is full, e1 is evicted to make room for q2
+    assert sent == ["q1", "q2"]
+
+
+def test_pipeline_never_drops_other_events():
+    batches = run_pipeline([event(str(i)) for i in range(5)], max_pending=2, flush_interval=10)
+    sent = [e.event_id for batch in batches for e in batch]
+    assert sent == [str(i) for i in range(5)]
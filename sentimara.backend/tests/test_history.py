@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from llama_index.core.base.llms.types import MessageRole
+
+import schema
+from chat import history
+from chat.history import MESSAGE_TOKEN_OVERHEAD, build_chat_history, count_tokens, split_history
+from libs.models.chatdb import MessageRoleEnum, MessageStatusEnum
+
+START = datetime(2024, 1, 1)
+
+
+def message(content, minute, role=MessageRoleEnum.user, status=MessageStatusEnum.SUCCESS):
+    return schema.Message(
+        id=uuid4(),
+        created_at=START + timedelta(minutes=minute),
+        conversation_id=uuid4(),
+        content=content,
+        role=role,
+        temperature=0.0,
+        status=status,
+        sub_processes=[],
+    )
+
+
+def cost(text):
+    return count_tokens(text) + MESSAGE_TOKEN_OVERHEAD
+
+
+def test_split_history_keeps_the_most_recent_messages_that_fit():
+    messages = [message(f"message number {i}", i) for i in range(5)]
+    budget = sum(cost(m.content) for m in messages[-2:])
+    to_fold, kept = split_history(messages, budget)
+    assert to_fold == messages[:3]
+    assert kept == messages[3:]
+
+
+def test_split_history_counts_the_summary():
+    messages = [message(f"message number {i}", i) for i in range(5)]
+    budget = sum(cost(m.content) for m in messages[-2:])
+    to_fold, kept = split_history(messages, budget, summary="a summary")
+    assert kept == messages[4:]
+
+
+def test_split_history_always_keeps_the_latest_message():
+    messages = [message("a rather long message " * 20, i) for i in range(3)]
+    to_fold, kept = split_history(messages, token_budget=1)
+    assert to_fold == messages[:2]
+    assert kept == messages[2:]
+
+
+def test_build_chat_history_keeps_the_folded_messages_until_summarized(monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(
+        history.history_summarizer,
+        "schedule",
+        lambda conversation_id, summary, messages: scheduled.append(messages),
+    )
+    messages = [
+        message(f"message number {i}", i, role=MessageRoleEnum.user if i % 2 == 0 else MessageRoleEnum.assistant)
+        for i in range(4)
+    ] + [message("failed", 5, status=MessageStatusEnum.ERROR)]
+    conversation = schema.ChatConversation(
+        id=uuid4(), messages=messages, documents=[], history_summary="the summary"
+    )
+
+    chat_history = build_chat_history(conversation, token_budget=cost("the summary") + cost(messages[3].content))
+
+    assert scheduled == [messages[:3]]
+    assert chat_history[0].role == MessageRole.SYSTEM
+    assert "the summary" in chat_history[0].content
+    assert [m.content for m in chat_history[1:]] == [m.content for m in messages[:4]]
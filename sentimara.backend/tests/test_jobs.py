@@ -0,0 +1,67 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import schema
+from api import jobs
+from api.streaming import MESSAGE_EVENT, parse_event_id
+from libs.models.chatdb import MessageStatusEnum
+
+
+def persisted(states, monkeypatch):
+    """Makes the database return the given states of the message, one per read, the last one from then on."""
+    states = list(states)
+
+    @asynccontextmanager
+    async def session():
+        yield None
+
+    async def get_message(db, message_id):
+        return states.pop(0) if len(states) > 1 else states[0]
+
+    monkeypatch.setattr(jobs, "get_async_session", session)
+    monkeypatch.setattr(jobs.crud, "get_message_with_sub_processes", get_message)
+    monkeypatch.setattr(jobs, "encode_message", lambda message: message.content)
+
+
+def message(content, status=MessageStatusEnum.PENDING, conversation_id="c"):
+    return SimpleNamespace(content=content, status=status, conversation_id=conversation_id)
+
+
+def follow(stream_mode, idle_timeout=1.0):
+    async def run():
+        events = jobs.follow_persisted_message(
+            "m", "c", stream_mode, poll_interval=0, idle_timeout=idle_timeout
+        )
+        return [event async for event in events]
+
+    return asyncio.run(run())
+
+
+def test_parse_event_id():
+    assert parse_event_id("a:b:12") == ("a:b", 12)
+    assert parse_event_id("m:x") is None
+    assert parse_event_id(None) is None
+
+
+def test_follow_sends_each_change_of_the_message_in_full_mode(monkeypatch):
+    persisted(
+        [None, message("a"), message("a"), message("ab"), message("abc", MessageStatusEnum.SUCCESS)],
+        monkeypatch,
+    )
+    assert follow(schema.StreamModeEnum.FULL) == ["a", "ab", "abc"]
+
+
+def test_follow_only_sends_the_completed_message_in_delta_mode(monkeypatch):
+    persisted([message("a"), message("ab", MessageStatusEnum.ERROR)], monkeypatch)
+    assert follow(schema.StreamModeEnum.DELTA) == [{"event": MESSAGE_EVENT, "data": "ab"}]
+
+
+def test_follow_stops_when_the_message_stays_unchanged(monkeypatch):
+    persisted([message("a")], monkeypatch)
+    assert follow(schema.StreamModeEnum.FULL, idle_timeout=0.05) == ["a"]
+
+
+def test_follow_ignores_the_messages_of_other_conversations(monkeypatch):
+    persisted([message("a", MessageStatusEnum.SUCCESS, conversation_id="other")], monkeypatch)
+    assert follow(schema.StreamModeEnum.FULL) == []
@@ -0,0 +1,64 @@
+import asyncio
+from types import SimpleNamespace
+
+from chat import router
+from chat.router import AgentRouter
+
+AGENTS = {
+    "Fraud Agent": SimpleNamespace(description="fraud detection suspicious transactions anomalies"),
+    "Client Agent": SimpleNamespace(description="client demographics profiles segments"),
+}
+
+
+class AxisEmbedding:
+    """Embeds a text on the axis of the first agent whose description shares a word with it."""
+
+    def __init__(self, fail=False):
+        self._fail = fail
+
+    def _embed(self, text):
+        if self._fail:
+            raise ConnectionError("embedding model unavailable")
+        words = set(text.lower().split())
+        return [float(bool(words & set(config.description.split()))) for config in AGENTS.values()]
+
+    async def aget_text_embedding_batch(self, texts):
+        return [self._embed(text) for text in texts]
+
+    async def aget_query_embedding(self, text):
+        return self._embed(text)
+
+
+def route(message, agents=AGENTS, embed_model=None, monkeypatch=None):
+    if monkeypatch is not None:
+        monkeypatch.setattr(router, "Settings", SimpleNamespace(embed_model=embed_model))
+    agent_router = AgentRouter(min_similarity=0.5, min_margin=0.2)
+    return agent_router, asyncio.run(agent_router.aroute(message, agents))
+
+
+def test_router_picks_a_single_agent_right_away():
+    agents = {"Fraud Agent": AGENTS["Fraud Agent"]}
+    agent_router, decision = route("anything", agents)
+    assert (decision.agent_name, decision.method) == ("Fraud Agent", "single")
+    assert agent_router.routed["single"] == 1
+
+
+def test_router_picks_the_most_similar_agent(monkeypatch):
+    agent_router, decision = route("list suspicious transactions", embed_model=AxisEmbedding(), monkeypatch=monkeypatch)
+    assert (decision.agent_name, decision.method) == ("Fraud Agent", "embedding")
+
+
+def test_router_falls_back_to_the_orchestrator_when_unsure(monkeypatch):
+    agent_router, decision = route("hello there", embed_model=AxisEmbedding(), monkeypatch=monkeypatch)
+    assert decision is None
+    assert agent_router.fallbacks == 1
+
+
+def test_router_uses_keywords_without_embeddings(monkeypatch):
+    agent_router, decision = route(
+        "show client demographics by segments", embed_model=AxisEmbedding(fail=True), monkeypatch=monkeypatch
+    )
+    assert (decision.agent_name, decision.method) == ("Client Agent", "keyword")
+
+    agent_router, decision = route("show the clients", embed_model=AxisEmbedding(fail=True), monkeypatch=monkeypatch)
+    assert decision is None
@@ -0,0 +1,28 @@
+import base64
+from datetime import datetime
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+
+from api.serialization import decode_message_cursor, encode_message_cursor
+
+
+def test_message_cursor_round_trip():
+    message = SimpleNamespace(created_at=datetime(2024, 5, 1, 12, 30, 15, 123456), id=uuid4())
+    cursor = encode_message_cursor(message)
+    assert "/" not in cursor and "+" not in cursor
+    assert decode_message_cursor(cursor) == (message.created_at, message.id)
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "not base64!",
+        base64.urlsafe_b64encode(b"2024-05-01T12:30:15/not-a-uuid").decode(),
+        base64.urlsafe_b64encode(f"yesterday/{uuid4()}".encode()).decode(),
+    ],
+)
+def test_invalid_message_cursors_raise_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_message_cursor(cursor)
@@ -0,0 +1,33 @@
+import pytest
+
+from chat.custom_sql_query_engine import canonicalize_sql, is_write_sql
+
+
+def test_canonicalize_sql_strips_the_surroundings_only():
+    assert canonicalize_sql("  SELECT * FROM clients ;\n") == "SELECT * FROM clients"
+    assert canonicalize_sql("SELECT 'a  b;' FROM clients") == "SELECT 'a  b;' FROM clients"
+    assert canonicalize_sql("SELECT 1;") == canonicalize_sql("SELECT 1")
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "INSERT INTO clients VALUES (1)",
+        "update transactions set amount = 0",
+        "WITH gone AS (DELETE FROM clients RETURNING id) SELECT count(*) FROM gone",
+        "TRUNCATE transactions",
+    ],
+)
+def test_is_write_sql_detects_writes(sql):
+    assert is_write_sql(sql)
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT * FROM clients",
+        "SELECT created_at, updated_at FROM transactions WHERE deleted_flag = false",
+    ],
+)
+def test_is_write_sql_lets_reads_through(sql):
+    assert not is_write_sql(sql)
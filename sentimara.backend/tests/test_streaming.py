@@ -0,0 +1,142 @@
+import asyncio
+from uuid import uuid4
+
+import schema
+from api.streaming import DELTA_EVENT, MESSAGE_EVENT, Generation, GenerationRegistry, MessageDeltaEncoder
+from chat.messaging import StreamedMessage, StreamedMessageSubProcess, StreamedMessageSubProcessBatch
+from libs.models.chatdb import MessageStatusEnum, MessageSubProcessSourceEnum, MessageSubProcessStatusEnum
+
+
+async def collect(generation, last_seq=None):
+    return [event async for event in generation.subscribe(last_seq)]
+
+
+def finished_generation(stream_mode, buffer_size, count):
+    generation = Generation("g", "c", stream_mode, buffer_size)
+    for i in range(count):
+        generation.publish({"event": "delta", "data": str(i)})
+    generation.finish()
+    return generation
+
+
+def test_generation_replays_the_events_after_the_last_one_received():
+    async def run():
+        generation = finished_generation(schema.StreamModeEnum.DELTA, 10, 5)
+        events = await collect(generation, last_seq=2)
+        assert [event["data"] for event in events] == ["3", "4"]
+        assert [event["id"] for event in events] == ["g:3", "g:4"]
+
+    asyncio.run(run())
+
+
+def test_generation_sends_the_snapshot_when_missed_deltas_were_evicted():
+    async def run():
+        generation = finished_generation(schema.StreamModeEnum.DELTA, 2, 5)
+        generation.snapshot = lambda: "whole message"
+        events = await collect(generation, last_seq=0)
+        assert events == [{"event": MESSAGE_EVENT, "data": "whole message", "id": "g:4"}]
+
+    asyncio.run(run())
+
+
+def test_generation_replays_the_buffer_in_full_mode():
+    async def run():
+        generation = finished_generation(schema.StreamModeEnum.FULL, 2, 5)
+        events = await collect(generation, last_seq=0)
+        assert [event["data"] for event in events] == ["3", "4"]
+
+    asyncio.run(run())
+
+
+def test_generation_subscribers_follow_the_live_events():
+    async def run():
+        generation = Generation("g", "c", schema.StreamModeEnum.DELTA, 10)
+        subscriber = asyncio.create_task(collect(generation))
+        await asyncio.sleep(0)
+        generation.publish({"data": "a"})
+        await asyncio.sleep(0)
+        generation.publish({"data": "b"})
+        generation.finish()
+        assert [event["data"] for event in await subscriber] == ["a", "b"]
+
+    asyncio.run(run())
+
+
+def test_registry_counts_the_running_and_waiting_generations():
+    async def run():
+        registry = GenerationRegistry(buffer_size=10, retention=0, max_running=1, abandon_grace=-1)
+        release = asyncio.Event()
+
+        async def events(generation):
+            await release.wait()
+            yield "done"
+
+        generations = [registry.start(str(i), "c", schema.StreamModeEnum.FULL, events) for i in range(3)]
+        await asyncio.sleep(0)
+        stats = registry.stats()
+        assert (stats["running"], stats["waiting"]) == (1, 2)
+
+        release.set()
+        await asyncio.gather(*[generation.task for generation in generations])
+        stats = registry.stats()
+        assert (stats["running"], stats["waiting"]) == (0, 0)
+
+    asyncio.run(run())
+
+
+def test_registry_measures_the_run_time_of_the_cancelled_generations():
+    async def run():
+        registry = GenerationRegistry(buffer_size=10, retention=0, max_running=1, abandon_grace=-1)
+
+        async def events(generation):
+            await asyncio.sleep(10)
+            yield "never"
+
+        running = registry.start("running", "c", schema.StreamModeEnum.FULL, events)
+        waiting = registry.start("waiting", "c", schema.StreamModeEnum.FULL, events)
+        await asyncio.sleep(0.05)
+
+        # the generation waiting for a slot has not run at all
+        assert registry.cancel(waiting)
+        assert registry.stats()["cancelled_run_seconds"] == 0.0
+        assert registry.cancel(running)
+        assert registry.stats()["cancelled_run_seconds"] >= 0.05
+        await asyncio.gather(running.task, waiting.task, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_delta_encoder_sends_the_appended_content():
+    encoder = MessageDeltaEncoder(uuid4())
+    deltas = [
+        encoder.encode(StreamedMessage(content=content))
+        for content in ["Hel", "Hello", "Hello", "Bye"]
+    ]
+    assert [len(events) for events in deltas] == [1, 1, 0, 1]
+    decoded = [schema.MessageDelta.model_validate_json(events[0]["data"]) for events in deltas if events]
+    assert [(d.seq, d.content, d.replace) for d in decoded] == [
+        (0, "Hel", False),
+        (1, "lo", False),
+        (2, "Bye", True),
+    ]
+    assert all(events[0]["event"] == DELTA_EVENT for events in deltas if events)
+
+
+def test_delta_encoder_sends_the_sub_processes_and_status():
+    encoder = MessageDeltaEncoder(uuid4())
+    status = schema.MessageDelta.model_validate_json(encoder.status(MessageStatusEnum.PENDING)["data"])
+    batch = StreamedMessageSubProcessBatch(
+        sub_processes=[
+            StreamedMessageSubProcess(
+                source=MessageSubProcessSourceEnum.QUERY, has_ended=has_ended, event_id=event_id, metadata_map=None
+            )
+            for event_id, has_ended in [("a", False), ("b", True)]
+        ]
+    )
+    decoded = [schema.MessageDelta.model_validate_json(event["data"]) for event in encoder.encode(batch)]
+
+    assert (status.seq, status.type, status.status) == (0, schema.MessageDeltaTypeEnum.STATUS, MessageStatusEnum.PENDING)
+    assert [(d.seq, d.sub_process.event_id, d.sub_process.status) for d in decoded] == [
+        (1, "a", MessageSubProcessStatusEnum.PENDING),
+        (2, "b", MessageSubProcessStatusEnum.FINISHED),
+    ]
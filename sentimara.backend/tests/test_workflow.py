@@ -0,0 +1,110 @@
+import asyncio
+from types import SimpleNamespace
+
+from llama_index.core.llms import ChatMessage, ChatResponse
+from llama_index.core.tools import FunctionTool, ToolSelection
+
+from chat.workflow import AgentConfig, ConciergeAgent
+
+
+class ScriptedLLM:
+    """A function calling LLM answering with the given tool calls, or content, one response per call."""
+
+    metadata = SimpleNamespace(is_function_calling_model=True)
+
+    def __init__(self, responses):
+        self._responses = list(responses)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ScriptedLLM"
+
+    async def astream_chat_with_tools(self, tools, chat_history):
+        response = self._responses.pop(0)
+        tool_calls = response if isinstance(response, list) else []
+        content = response if isinstance(response, str) else ""
+
+        async def stream():
+            yield ChatResponse(
+                message=ChatMessage(
+                    role="assistant",
+                    content=content,
+                    additional_kwargs={"tool_calls": tool_calls},
+                ),
+                delta=content,
+            )
+
+        return stream()
+
+    def get_tool_calls_from_response(self, response, error_on_no_tool_call=False):
+        return response.message.additional_kwargs["tool_calls"]
+
+
+def test_tool_call_and_transfer_in_one_response():
+    calls = []
+
+    def lookup_clients(name: str) -> str:
+        """Looks up clients by name."""
+        calls.append(name)
+        return f"client {name}"
+
+    def lookup_transactions(client_number: str) -> str:
+        """Looks up the transactions of a client."""
+        return "no transactions"
+
+    agent_configs = [
+        AgentConfig(
+            name="clients",
+            description="Answers about clients",
+            system_prompt="You answer about clients.",
+            tools=[FunctionTool.from_defaults(fn=lookup_clients)],
+        ),
+        AgentConfig(
+            name="transactions",
+            description="Answers about transactions",
+            system_prompt="You answer about transactions.",
+            tools=[FunctionTool.from_defaults(fn=lookup_transactions)],
+        ),
+    ]
+    llm = ScriptedLLM(
+        [
+            [
+                ToolSelection(
+                    tool_id="call-1",
+                    tool_name="lookup_clients",
+                    tool_kwargs={"name": "Thabo"},
+                ),
+                ToolSelection(tool_id="call-2", tool_name="RequestTransfer", tool_kwargs={}),
+            ],
+            [
+                ToolSelection(
+                    tool_id="call-3",
+                    tool_name="TransferToAgent",
+                    tool_kwargs={"agent_name": "transactions"},
+                )
+            ],
+            "Thabo has no transactions.",
+        ]
+    )
+
+    async def run():
+        workflow = ConciergeAgent(timeout=10)
+        return await workflow.run(
+            user_msg="What are the transactions of Thabo?",
+            agent_configs=agent_configs,
+            llm=llm,
+            chat_history=[],
+            active_speaker="clients",
+        )
+
+    result = asyncio.run(run())
+
+    # the tool call ran with the tools of the agent that made it, before the transfer
+    assert calls == ["Thabo"]
+    assert result["response"] == "Thabo has no transactions."
+    tool_messages = [m for m in result["chat_history"] if m.role == "tool"]
+    assert sorted(m.additional_kwargs["tool_call_id"] for m in tool_messages) == [
+        "call-1",
+        "call-2",
+    ]
+    assert "client Thabo" in [m.content for m in tool_messages]